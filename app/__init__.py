@@ -1,9 +1,12 @@
 import os
+import time
 
-from flask import Flask
+from flask import Flask, g, request
 
+from app.api import api
 from app.config import ensure_data_dir
 from app.routes import web
+from app.services.metrics import REQUEST_SECONDS
 
 
 def create_app():
@@ -11,4 +14,21 @@ def create_app():
     templates_path = os.path.join(os.path.dirname(__file__), "..", "templates")
     app = Flask(__name__, template_folder=templates_path)
     app.register_blueprint(web)
+    app.register_blueprint(api)
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.teardown_request
+    def record_latency(exc=None):
+        start = g.pop("request_start", None)
+        if start is None:
+            return
+        # The matched rule keeps label cardinality bounded, unlike the raw path
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        REQUEST_SECONDS.observe(
+            time.perf_counter() - start, method=request.method, route=route
+        )
+
     return app
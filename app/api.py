@@ -0,0 +1,303 @@
+from flask import Blueprint, jsonify, request, url_for
+
+from app.services import ports
+from app.services.backend import reconcile
+from app.services.changes import change_queue
+from app.services.drift import drift_watcher
+from app.services.health import health_checker
+from app.services.interfaces import interface_inventory
+from app.services.iptables import rule_protocols
+from app.services.persistence import restore_progress
+from app.services.reload import rules_watcher
+from app.services.rule import Rule
+from app.services.stats import stats_collector
+from app.services.store import new_rule_id, rule_key, rule_store
+
+api = Blueprint("api", __name__, url_prefix="/api/v1")
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+
+class ApiError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+@api.errorhandler(ApiError)
+def handle_api_error(exc):
+    return jsonify({"error": str(exc)}), exc.status
+
+
+# Normalize a rule the way the HTML forms store it: ports as strings (a port,
+# a range or a list), protocol defaulting to 'both', enabled defaulting to True.
+# With several `backends` the forward is load-balanced and int_ip/int_port
+# name the first backend. A `health_check` turns on probing of the backends,
+# and `max_connections` caps the connections the userspace relay accepts.
+def validate_rule(data):
+    try:
+        rule = Rule.from_dict(data)
+        rule.check_relay_ports()
+        return rule.to_dict()
+    except ValueError as exc:
+        raise ApiError(str(exc))
+
+
+def _json_body(kind):
+    data = request.get_json(silent=True)
+    if not isinstance(data, kind):
+        expected = "array" if kind is list else "object"
+        raise ApiError(f"request body must be a JSON {expected}")
+    return data
+
+
+def _get_rule(rule_id):
+    rule = rule_store.get(rule_id)
+    if rule is None:
+        raise ApiError(f"rule {rule_id} not found", 404)
+    return rule
+
+
+def _check_ids(ids):
+    if not all(isinstance(rule_id, str) for rule_id in ids):
+        raise ApiError("ids must be strings")
+    unknown = [rule_id for rule_id in ids if rule_store.get(rule_id) is None]
+    if unknown:
+        raise ApiError(f"rules not found: {', '.join(unknown)}", 404)
+
+
+def _overlaps(rule, other):
+    return bool(
+        set(rule_protocols(rule)) & set(rule_protocols(other))
+        and ports.overlaps(
+            ports.parse_ports(rule["ext_port"]), ports.parse_ports(other["ext_port"])
+        )
+    )
+
+
+# A forward may not reuse an external port another forward on the same
+# interface and protocol already takes, including inside ranges and lists
+def _check_conflicts(rules, ignore_ids=()):
+    seen = set()
+    batch = {}
+    for rule in rules:
+        key = rule_key(rule)
+        taken = [
+            existing
+            for existing in rule_store.find_all(key)
+            if existing["id"] not in ignore_ids
+        ]
+        if key in seen or taken:
+            raise ApiError(
+                f"a rule for {rule['extif']}:{rule['ext_port']} → "
+                f"{rule['int_ip']}:{rule['int_port']} already exists",
+                409,
+            )
+        seen.add(key)
+        spans = ports.parse_ports(rule["ext_port"])
+        existing, _ = rule_store.query(
+            extif=rule["extif"], port_min=spans[0][0], port_max=spans[-1][1]
+        )
+        for other in existing + batch.get(rule["extif"], []):
+            if other.get("id") not in ignore_ids and _overlaps(rule, other):
+                target = f"{other['int_ip']}:{other['int_port']}"
+                raise ApiError(
+                    f"{rule['extif']}:{rule['ext_port']} overlaps the forward "
+                    f"{other['extif']}:{other['ext_port']} → {target}",
+                    409,
+                )
+        batch.setdefault(rule["extif"], []).append(rule)
+
+
+# All entries are one change, so they reach the kernel and rules.json together.
+# The response is 202 with the job to poll, unless ?wait=1 asks to block until
+# the change is committed; then it carries the final status and any error.
+# Conflicts are checked again when the change is committed, since rules queued
+# meanwhile are not seen by _check_conflicts(); those fail with 409.
+def _submit(entries, result, require_kernel=True, status=200):
+    change = change_queue.submit(entries, require_kernel=require_kernel)
+    if request.args.get("wait", "").lower() not in ("1", "true", "yes"):
+        response = jsonify(dict(result, job=change.to_dict()))
+        response.status_code = 202
+        response.headers["Location"] = url_for("api.get_job", job_id=change.id)
+        return response
+    change.wait()
+    if not change.persisted:
+        raise ApiError(change.error or "change was not applied", 409 if change.conflict else 500)
+    if "error" in result:
+        result = dict(result, error=change.error)
+    return jsonify(dict(result, job=change.to_dict())), status
+
+
+def _int_arg(name, default):
+    value = request.args.get(name, default)
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ApiError(f"{name} must be an integer")
+
+
+@api.route("/rules", methods=["GET"])
+def list_rules():
+    limit = _int_arg("limit", DEFAULT_LIMIT)
+    offset = _int_arg("offset", 0)
+    if not 1 <= limit <= MAX_LIMIT or offset < 0:
+        raise ApiError(f"limit must be between 1 and {MAX_LIMIT}, offset at least 0")
+    enabled = request.args.get("enabled")
+    if enabled is not None:
+        enabled = enabled.lower() in ("1", "true", "yes")
+    port_min = _int_arg("port_min", None) if "port_min" in request.args else None
+    port_max = _int_arg("port_max", None) if "port_max" in request.args else None
+    order = request.args.get("order", "asc")
+    if order not in ("asc", "desc"):
+        raise ApiError("order must be asc or desc")
+    try:
+        rules, total = rule_store.query(
+            extif=request.args.get("extif"),
+            intif=request.args.get("intif"),
+            int_ip=request.args.get("int_ip"),
+            protocol=request.args.get("protocol"),
+            enabled=enabled,
+            port_min=port_min,
+            port_max=port_max,
+            search=request.args.get("q"),
+            sort=request.args.get("sort"),
+            descending=order == "desc",
+            offset=offset,
+            limit=limit,
+        )
+    except ValueError as exc:
+        raise ApiError(str(exc))
+    return jsonify({"rules": rules, "total": total, "limit": limit, "offset": offset})
+
+
+@api.route("/rules/<rule_id>", methods=["GET"])
+def get_rule(rule_id):
+    return jsonify(_get_rule(rule_id))
+
+
+@api.route("/rules/<rule_id>/stats", methods=["GET"])
+def get_rule_stats(rule_id):
+    _get_rule(rule_id)
+    return jsonify(stats_collector.rule_stats(rule_id))
+
+
+@api.route("/stats", methods=["GET"])
+def list_stats():
+    return jsonify(stats_collector.all_stats())
+
+
+@api.route("/rules/<rule_id>/health", methods=["GET"])
+def get_rule_health(rule_id):
+    return jsonify(health_checker.rule_health(_get_rule(rule_id)))
+
+
+@api.route("/drift", methods=["GET"])
+def get_drift():
+    return jsonify(drift_watcher.status())
+
+
+@api.route("/reload", methods=["GET"])
+def get_reload():
+    return jsonify(rules_watcher.status())
+
+
+@api.route("/restore", methods=["GET"])
+def get_restore():
+    return jsonify(restore_progress.to_dict())
+
+
+@api.route("/interfaces", methods=["GET"])
+def list_interfaces():
+    return jsonify(interface_inventory.snapshot())
+
+
+@api.route("/rules", methods=["POST"])
+def create_rule():
+    rule = dict(validate_rule(_json_body(dict)), id=new_rule_id())
+    _check_conflicts([rule])
+    return _submit(
+        [{"op": "put", "rule": rule}], rule, require_kernel=rule["enabled"], status=201
+    )
+
+
+@api.route("/rules/<rule_id>", methods=["PATCH"])
+def patch_rule(rule_id):
+    data = _json_body(dict)
+    if "id" in data and data["id"] != rule_id:
+        raise ApiError("id cannot be changed")
+    existing = _get_rule(rule_id)
+    rule = dict(validate_rule(dict(existing, **data)), id=rule_id)
+    _check_conflicts([rule], ignore_ids={rule_id})
+    return _submit([{"op": "put", "rule": rule}], rule, require_kernel=rule["enabled"])
+
+
+@api.route("/rules/<rule_id>", methods=["DELETE"])
+def delete_rule(rule_id):
+    _get_rule(rule_id)
+    return _submit(
+        [{"op": "remove", "ids": [rule_id]}],
+        {"deleted": [rule_id], "error": None},
+        require_kernel=False,
+    )
+
+
+@api.route("/rules/bulk", methods=["POST"])
+def bulk_create():
+    rules = [
+        dict(validate_rule(data), id=new_rule_id()) for data in _json_body(list)
+    ]
+    _check_conflicts(rules)
+    if not rules:
+        return jsonify({"rules": rules}), 201
+    return _submit([{"op": "put", "rule": rule} for rule in rules], {"rules": rules}, status=201)
+
+
+@api.route("/rules/bulk-delete", methods=["POST"])
+def bulk_delete():
+    ids = _json_body(list)
+    _check_ids(ids)
+    ids = list(dict.fromkeys(ids))
+    result = {"deleted": ids, "error": None}
+    if not ids:
+        return jsonify(result)
+    return _submit([{"op": "remove", "ids": ids}], result, require_kernel=False)
+
+
+@api.route("/rules/bulk-toggle", methods=["POST"])
+def bulk_toggle():
+    data = _json_body(dict)
+    ids = data.get("ids")
+    enabled = data.get("enabled")
+    if not isinstance(ids, list) or not isinstance(enabled, bool):
+        raise ApiError('body must be {"ids": [...], "enabled": true|false}')
+    _check_ids(ids)
+    ids = list(dict.fromkeys(ids))
+    result = {"updated": ids, "enabled": enabled, "error": None}
+    if not ids:
+        return jsonify(result)
+    entries = [
+        {"op": "update", "id": rule_id, "fields": {"enabled": enabled}}
+        for rule_id in ids
+    ]
+    # Like the HTML form, a disable is kept even if the kernel step fails
+    return _submit(entries, result, require_kernel=enabled)
+
+
+@api.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    change = change_queue.job(job_id)
+    if change is None:
+        raise ApiError(f"job {job_id} not found", 404)
+    return jsonify(change.to_dict())
+
+
+@api.route("/resync", methods=["POST"])
+def resync():
+    try:
+        with rule_store.transaction():
+            additions, deletions = reconcile(rule_store.rules())
+    except RuntimeError as exc:
+        raise ApiError(str(exc), 500)
+    return jsonify({"added": len(additions), "removed": len(deletions)})
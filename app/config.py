@@ -9,16 +9,97 @@ DATA_DIR = (
 )
 RULES_FILE = os.path.join(DATA_DIR, "rules.json")
 
+# Backend for forwards: "iptables" (default) or "nftables" in the kernel, or
+# "relay" to forward in userspace without NAT privileges
+FIREWALL_BACKEND = os.environ.get("FIREWALL_BACKEND", "iptables")
+
+# Set to 1 to do what can be done in-process instead of forking a tool: sysctl
+# writes go to /proc/sys and nft commands to libnftables, falling back to the
+# commands. Off by default: it is an optional path that depends on the host's
+# libnftables and a writable /proc/sys.
+NATIVE_KERNEL_CALLS = os.environ.get("NATIVE_KERNEL_CALLS", "0") == "1"
+
+# Append single-rule changes to rules.journal instead of rewriting rules.json;
+# the journal is folded back into rules.json once it reaches this many entries
+RULES_JOURNAL = os.environ.get("RULES_JOURNAL", "0") == "1"
+JOURNAL_COMPACT_ENTRIES = int(os.environ.get("JOURNAL_COMPACT_ENTRIES", "200"))
+
+# How long a batch of rule changes waits for more to arrive before committing
+COALESCE_WINDOW_MS = int(os.environ.get("COALESCE_WINDOW_MS", "0"))
+
+# "background" brings the web UI up at once and restores the kernel rules
+# behind it, reporting progress at /api/v1/restore; "blocking" restores them
+# before serving
+STARTUP_RESTORE = os.environ.get("STARTUP_RESTORE", "background")
+
+# "waitress" serves the GUI with a multi-threaded production server,
+# "dev" falls back to Flask's development server
+SERVER = os.environ.get("SERVER", "waitress")
+WEB_THREADS = int(os.environ.get("WEB_THREADS", "8"))
+WEB_CONNECTION_LIMIT = int(os.environ.get("WEB_CONNECTION_LIMIT", "100"))
+# Seconds an idle keep-alive connection is held open
+WEB_CHANNEL_TIMEOUT = int(os.environ.get("WEB_CHANNEL_TIMEOUT", "120"))
+
+# Seconds between traffic statistics snapshots, and how many to keep per rule
+STATS_INTERVAL = float(os.environ.get("STATS_INTERVAL", "10"))
+STATS_HISTORY = int(os.environ.get("STATS_HISTORY", "60"))
+
+
+# Seconds the interface list is cached; rtnetlink events refresh it sooner
+INTERFACE_TTL = float(os.environ.get("INTERFACE_TTL", "30"))
+# Comma-separated name prefixes of tunnel interfaces offered as internal,
+# and interfaces never offered as external
+INTERNAL_IF_PREFIXES = tuple(
+    prefix.strip()
+    for prefix in os.environ.get("INTERNAL_IF_PREFIXES", "wg,tun,tap,tailscale").split(",")
+    if prefix.strip()
+)
+EXTERNAL_IF_EXCLUDE = tuple(
+    name.strip()
+    for name in os.environ.get("EXTERNAL_IF_EXCLUDE", "lo").split(",")
+    if name.strip()
+)
+
+# Seconds between backend health probes, the probe timeout, and how many
+# probes run at once
+HEALTH_INTERVAL = float(os.environ.get("HEALTH_INTERVAL", "5"))
+HEALTH_TIMEOUT = float(os.environ.get("HEALTH_TIMEOUT", "2"))
+HEALTH_WORKERS = int(os.environ.get("HEALTH_WORKERS", "32"))
+# Consecutive failed probes before a backend leaves the rotation, and
+# consecutive good ones before it comes back
+HEALTH_FALL = int(os.environ.get("HEALTH_FALL", "2"))
+HEALTH_RISE = int(os.environ.get("HEALTH_RISE", "2"))
+
+# Seconds between checks of the kernel for forwards changed or flushed by
+# something else, which are then repaired; 0 turns the watcher off
+DRIFT_INTERVAL = float(os.environ.get("DRIFT_INTERVAL", "5"))
+
+# Seconds between looks at rules.json for edits made outside the service when
+# inotify is unavailable; 0 turns hot reloading off
+RELOAD_INTERVAL = float(os.environ.get("RELOAD_INTERVAL", "2"))
+
+# Userspace relay: addresses to listen on instead of those of the external
+# interface, seconds before an idle TCP connection or UDP session is dropped,
+# and the most connections or sessions per rule unless it sets max_connections
+RELAY_BIND = tuple(
+    address.strip() for address in os.environ.get("RELAY_BIND", "").split(",") if address.strip()
+)
+RELAY_IDLE_TIMEOUT = float(os.environ.get("RELAY_IDLE_TIMEOUT", "300"))
+RELAY_UDP_TIMEOUT = float(os.environ.get("RELAY_UDP_TIMEOUT", "30"))
+RELAY_MAX_CONNECTIONS = int(os.environ.get("RELAY_MAX_CONNECTIONS", "1024"))
+# The relay opens a socket per port and protocol, so forwards with more ports
+# than this are rejected with the relay backend rather than failing to bind
+# once the open-file limit is reached
+RELAY_MAX_PORTS = int(os.environ.get("RELAY_MAX_PORTS", "100"))
+
 
 def ensure_data_dir():
-    # Ensure DATA_DIR exists and is writable
+    # Ensure DATA_DIR exists and is writable; access() answers that without
+    # a file round trip on a slow volume
     try:
         os.makedirs(DATA_DIR, exist_ok=True)
-        # Test if we can write to the directory
-        test_file = os.path.join(DATA_DIR, ".write_test")
-        with open(test_file, "w") as handle:
-            handle.write("test")
-        os.remove(test_file)
+        if not os.access(DATA_DIR, os.W_OK | os.X_OK):
+            raise PermissionError(f"no write permission for {DATA_DIR}")
         print(f"✓ DATA_DIR is writable: {DATA_DIR}")
     except Exception as exc:
         print(f"✗ WARNING: DATA_DIR may not be writable: {DATA_DIR}")
@@ -1,150 +1,189 @@
 import traceback
 
-import netifaces
-from flask import Blueprint, redirect, render_template, request, url_for
+from flask import Blueprint, Response, redirect, render_template, request, url_for
 
-from app.services.iptables import apply_rule, run
-from app.services.persistence import load_persisted_rules, save_persisted_rules
+from app.services import metrics, ports
+from app.services.backend import reconcile
+from app.services.changes import change_queue
+from app.services.health import health_checker
+from app.services.interfaces import interface_inventory
+from app.services.rule import KEY_FIELDS, Rule
+from app.services.stats import stats_collector
+from app.services.store import SORT_KEYS, new_rule_id, rule_key, rule_store
 
 web = Blueprint("web", __name__)
 
 
+# Query arguments of the rule table, carried along by sort and page links
+FILTER_ARGS = (
+    "q",
+    "extif",
+    "intif",
+    "int_ip",
+    "protocol",
+    "enabled",
+    "port_min",
+    "port_max",
+    "sort",
+    "order",
+    "per_page",
+)
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+def arg_int(name, default):
+    try:
+        return int(request.args.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
 @web.route("/")
 def index():
-    # Network interfaces
-    all_if = netifaces.interfaces()
-    externals = [interface for interface in all_if if interface != "lo"]
-    internals = [
-        interface
-        for interface in all_if
-        if interface.startswith(("wg", "tun", "tap", "tailscale"))
-    ]
-    # Display persistent rules
-    rules = load_persisted_rules()
-    edit_index = request.args.get("edit", type=int)
-    edit_rule = None
-    if edit_index is not None and 0 <= edit_index < len(rules):
-        edit_rule = rules[edit_index]
+    # Network interfaces, cached and refreshed on link changes
+    inventory = interface_inventory.snapshot()
+    # Display one page of the persistent rules, filtered and sorted by the store
+    filters = {name: request.args[name] for name in FILTER_ARGS if request.args.get(name)}
+    per_page = min(max(arg_int("per_page", PAGE_SIZE), 1), MAX_PAGE_SIZE)
+    page = max(arg_int("page", 1), 1)
+    sort = filters.get("sort")
+    criteria = {
+        "extif": filters.get("extif"),
+        "intif": filters.get("intif"),
+        "int_ip": filters.get("int_ip"),
+        "protocol": filters.get("protocol"),
+        "enabled": {"1": True, "0": False}.get(filters.get("enabled")),
+        "port_min": arg_int("port_min", None),
+        "port_max": arg_int("port_max", None),
+        "search": filters.get("q"),
+        "sort": sort if sort in SORT_KEYS else None,
+        "descending": filters.get("order") == "desc",
+    }
+    rules, total = rule_store.query(offset=(page - 1) * per_page, limit=per_page, **criteria)
+    pages = max((total + per_page - 1) // per_page, 1)
+    if page > pages:
+        page = pages
+        rules, total = rule_store.query(offset=(page - 1) * per_page, limit=per_page, **criteria)
+    edit_id = request.args.get("edit")
+    edit_rule = rule_store.get(edit_id) if edit_id else None
     return render_template(
         "index.html",
-        externals=externals,
-        internals=internals,
+        externals=inventory["externals"],
+        internals=inventory["internals"],
+        interfaces={interface["name"]: interface for interface in inventory["interfaces"]},
         rules=rules,
+        total=total,
+        page=page,
+        pages=pages,
+        per_page=per_page,
+        filters=filters,
         edit_rule=edit_rule,
-        edit_index=edit_index,
+        stats={rule["id"]: stats_collector.rule_stats(rule["id"]) for rule in rules},
+        health={rule["id"]: health_checker.rule_health(rule) for rule in rules},
+        pending=change_queue.pending_count(),
     )
 
 
-def remove_rule_from_iptables(rule):
-    protocol = rule.get("protocol", "both")
-    protocols = ["tcp", "udp"] if protocol == "both" else [protocol]
+@web.app_template_filter("human_bytes")
+def human_bytes(value):
+    value = float(value)
+    for unit in ("B", "KB", "MB", "GB", "TB"):
+        if value < 1024 or unit == "TB":
+            return f"{value:.0f} {unit}" if unit == "B" else f"{value:.1f} {unit}"
+        value /= 1024
 
-    for proto in protocols:
-        try:
-            run(
-                [
-                    "iptables",
-                    "-t",
-                    "nat",
-                    "-D",
-                    "PREROUTING",
-                    "-i",
-                    rule["extif"],
-                    "-p",
-                    proto,
-                    "--dport",
-                    rule["ext_port"],
-                    "-j",
-                    "DNAT",
-                    "--to-destination",
-                    f"{rule['int_ip']}:{rule['int_port']}",
-                ]
-            )
-        except RuntimeError:
-            pass
 
+def form_key():
+    rule = {field: request.form[field] for field in KEY_FIELDS}
+    for field in ("ext_port", "int_port"):
         try:
-            run(
-                [
-                    "iptables",
-                    "-D",
-                    "FORWARD",
-                    "-i",
-                    rule["extif"],
-                    "-o",
-                    rule["intif"],
-                    "-p",
-                    proto,
-                    "--dport",
-                    rule["int_port"],
-                    "-d",
-                    rule["int_ip"],
-                    "-j",
-                    "ACCEPT",
-                ]
-            )
-        except RuntimeError:
+            rule[field] = ports.normalize_ports(rule[field])
+        except ValueError:
+            # Match whatever an older release stored
             pass
+    return rule_key(rule)
+
+
+# Load-balancing targets besides the main one, one "ip[:port] [weight]" per
+# line; the port defaults to the main target's. Returns the full backend list,
+# or None for a plain forward. Raises ValueError.
+def form_backends(int_ip, int_port):
+    lines = [line.split() for line in request.form.get("backends", "").splitlines()]
+    lines = [parts for parts in lines if parts]
+    if not lines:
+        return None
+    backends = [
+        {"int_ip": int_ip, "int_port": int_port, "weight": int(request.form.get("weight") or 1)}
+    ]
+    for parts in lines:
+        ip, _, port = parts[0].partition(":")
+        weight = int(parts[1]) if len(parts) > 1 else 1
+        backends.append({"int_ip": ip, "int_port": port or int_port, "weight": weight})
+    return backends
+
+
+# Fields of a rule the form has no input for; an edit keeps them
+FORM_KEPT_FIELDS = ("enabled", "max_connections", "down")
+
+
+# The rule described by the add/edit form, parsed and validated before it
+# gets anywhere near the kernel; raises ValueError. When editing, `base` is
+# the rule being edited, whose fields the form does not show are kept.
+def form_rule(base=None):
+    base = base or {}
+    data = {field: base[field] for field in FORM_KEPT_FIELDS if field in base}
+    data.update((field, request.form[field]) for field in KEY_FIELDS)
+    data["protocol"] = request.form["protocol"]  # 'both', 'tcp', or 'udp'
+    data["name"] = request.form.get("name", "")
+    data["backends"] = form_backends(data["int_ip"], data["int_port"])
+    # The probe picked in the form, or none to leave the backends unchecked.
+    # A path or payload set through the API stays while the probe type does.
+    probe = request.form.get("health_check", "")
+    if probe:
+        check = base.get("health_check") or {}
+        data["health_check"] = check if check.get("type") == probe else {"type": probe}
+    rule = Rule.from_dict(data)
+    rule.check_relay_ports()
+    return rule
 
 
 @web.route("/add", methods=["POST"])
 def add():
     try:
-        extif = request.form["extif"]
-        intif = request.form["intif"]
-        ext_port = request.form["ext_port"]
-        int_ip = request.form["int_ip"]
-        int_port = request.form["int_port"]
-        protocol = request.form["protocol"]  # 'both', 'tcp', or 'udp'
-        name = request.form.get("name", "").strip()
-
-        new_rule = {
-            "extif": extif,
-            "intif": intif,
-            "ext_port": ext_port,
-            "int_ip": int_ip,
-            "int_port": int_port,
-            "protocol": protocol,
-        }
-        if name:
-            new_rule["name"] = name
-
         try:
-            apply_rule(new_rule)
-        except RuntimeError as exc:
-            print(f"✗ ERROR applying iptables rule: {exc}")
+            rule = form_rule()
+        except ValueError as exc:
+            print(f"✗ ERROR adding rule: {exc}")
             return redirect(url_for("web.index"))
+        new_rule = rule.to_dict()
+        extif, ext_port = new_rule["extif"], new_rule["ext_port"]
+        int_ip, int_port = new_rule["int_ip"], new_rule["int_port"]
+        protocol = rule.protocol
 
-        # Update persistence
-        rules = load_persisted_rules()
-
-        # Check if the rule already exists (without considering the new protocol field)
-        existing_rule = None
-        for rule in rules:
-            if (
-                rule["extif"] == extif
-                and rule["intif"] == intif
-                and rule["ext_port"] == ext_port
-                and rule["int_ip"] == int_ip
-                and rule["int_port"] == int_port
-            ):
-                existing_rule = rule
-                break
-
+        # The key deliberately ignores the protocol field
+        existing_rule = rule_store.find(rule.key())
         if existing_rule:
             # Update existing rule with the new protocol
-            existing_rule["protocol"] = protocol
-            if name:
-                existing_rule["name"] = name
+            fields = {"protocol": protocol}
+            for field in ("backends", "health_check", "name"):
+                if field in new_rule:
+                    fields[field] = new_rule[field]
+            entry = {"op": "update", "id": existing_rule["id"], "fields": fields}
         else:
             # Add new rule
-            rules.append(new_rule)
-
-        save_persisted_rules(rules)
+            entry = {"op": "put", "rule": dict(new_rule, id=new_rule_id())}
 
         # User-friendly protocol name for the message
         proto_name = "TCP/UDP" if protocol == "both" else protocol.upper()
-        print(f"✓ Rule {proto_name} {extif}:{ext_port} → {int_ip}:{int_port} added.")
+
+        def report(change):
+            if not change.persisted:
+                print(f"✗ ERROR applying iptables rule: {change.error}")
+                return
+            print(f"✓ Rule {proto_name} {extif}:{ext_port} → {int_ip}:{int_port} added.")
+
+        change_queue.submit([entry], on_done=report)
 
     except Exception as exc:
         print(f"✗ ERROR in /add route: {exc}")
@@ -157,49 +196,36 @@ def add():
 @web.route("/edit", methods=["POST"])
 def edit():
     try:
-        rule_index = request.form.get("rule_id", type=int)
-        extif = request.form["extif"]
-        intif = request.form["intif"]
-        ext_port = request.form["ext_port"]
-        int_ip = request.form["int_ip"]
-        int_port = request.form["int_port"]
-        protocol = request.form["protocol"]
-        name = request.form.get("name", "").strip()
-
-        rules = load_persisted_rules()
-        if rule_index is None or rule_index < 0 or rule_index >= len(rules):
-            print("✗ ERROR editing rule: invalid rule index.")
+        rule_id = request.form.get("rule_id")
+        old_rule = rule_store.get(rule_id) if rule_id else None
+        if old_rule is None:
+            print("✗ ERROR editing rule: unknown rule id.")
+            return redirect(url_for("web.index"))
+
+        try:
+            rule = form_rule(old_rule)
+        except ValueError as exc:
+            print(f"✗ ERROR editing rule: {exc}")
             return redirect(url_for("web.index"))
 
-        old_rule = rules[rule_index]
-        enabled = old_rule.get("enabled", True)
-
-        updated_rule = {
-            "extif": extif,
-            "intif": intif,
-            "ext_port": ext_port,
-            "int_ip": int_ip,
-            "int_port": int_port,
-            "protocol": protocol,
-            "enabled": enabled,
-        }
-        if name:
-            updated_rule["name"] = name
-
-        if enabled:
-            remove_rule_from_iptables(old_rule)
-            try:
-                apply_rule(updated_rule)
-            except RuntimeError as exc:
-                print(f"✗ ERROR applying updated rule: {exc}")
-                return redirect(url_for("web.index"))
-
-        rules[rule_index] = updated_rule
-        save_persisted_rules(rules)
+        updated_rule = rule.to_dict()
+        extif, ext_port = updated_rule["extif"], updated_rule["ext_port"]
+        int_ip, int_port = updated_rule["int_ip"], updated_rule["int_port"]
+        protocol = rule.protocol
 
         proto_name = "TCP/UDP" if protocol == "both" else protocol.upper()
-        print(
-            f"✓ Rule {proto_name} {extif}:{ext_port} → {int_ip}:{int_port} updated."
+
+        def report(change):
+            if not change.persisted:
+                print(f"✗ ERROR applying updated rule: {change.error}")
+                return
+            print(
+                f"✓ Rule {proto_name} {extif}:{ext_port} → {int_ip}:{int_port} updated."
+            )
+
+        # Swap the old kernel rules for the updated ones in one transaction
+        change_queue.submit(
+            [{"op": "put", "rule": dict(updated_rule, id=rule_id)}], on_done=report
         )
     except Exception as exc:
         print(f"✗ ERROR in /edit route: {exc}")
@@ -218,132 +244,28 @@ def delete():
     int_port = request.form["int_port"]
     protocol = request.form.get("protocol", "both")  # Default is 'both' for backward compatibility
 
-    # Update persistence first - always remove the rule from the JSON
-    rules = load_persisted_rules()
-    old_rules_count = len(rules)
-    rules = [
-        rule
-        for rule in rules
-        if not (
-            rule["extif"] == extif
-            and rule["intif"] == intif
-            and rule["ext_port"] == ext_port
-            and rule["int_ip"] == int_ip
-            and rule["int_port"] == int_port
-        )
-    ]
-    save_persisted_rules(rules)
-
-    # Determine which protocols to remove
-    protocols = []
-    if protocol == "both":
-        protocols = ["tcp", "udp"]
-    else:
-        protocols = [protocol]  # Only remove the selected protocol
-
-    # Now try to remove the iptables rules
-    errors = []
-    for proto in protocols:
-        try:
-            # Check if the rule exists before we delete it
-            run(
-                [
-                    "iptables",
-                    "-t",
-                    "nat",
-                    "-C",
-                    "PREROUTING",
-                    "-i",
-                    extif,
-                    "-p",
-                    proto,
-                    "--dport",
-                    ext_port,
-                    "-j",
-                    "DNAT",
-                    "--to-destination",
-                    f"{int_ip}:{int_port}",
-                ]
-            )
-            # If yes, remove
-            run(
-                [
-                    "iptables",
-                    "-t",
-                    "nat",
-                    "-D",
-                    "PREROUTING",
-                    "-i",
-                    extif,
-                    "-p",
-                    proto,
-                    "--dport",
-                    ext_port,
-                    "-j",
-                    "DNAT",
-                    "--to-destination",
-                    f"{int_ip}:{int_port}",
-                ]
-            )
-        except RuntimeError:
-            errors.append(f"{proto.upper()}-NAT rule not found")
-
-        try:
-            # Check if the Forward rule exists
-            run(
-                [
-                    "iptables",
-                    "-C",
-                    "FORWARD",
-                    "-i",
-                    extif,
-                    "-o",
-                    intif,
-                    "-p",
-                    proto,
-                    "--dport",
-                    int_port,
-                    "-d",
-                    int_ip,
-                    "-j",
-                    "ACCEPT",
-                ]
-            )
-            # If yes, remove
-            run(
-                [
-                    "iptables",
-                    "-D",
-                    "FORWARD",
-                    "-i",
-                    extif,
-                    "-o",
-                    intif,
-                    "-p",
-                    proto,
-                    "--dport",
-                    int_port,
-                    "-d",
-                    int_ip,
-                    "-j",
-                    "ACCEPT",
-                ]
-            )
-        except RuntimeError:
-            errors.append(f"{proto.upper()}-FORWARD rule not found")
-
     # User-friendly protocol name for the message
     proto_name = "TCP/UDP" if protocol == "both" else protocol.upper()
 
     # Inform the user
-    if old_rules_count > len(rules):
-        if errors:
+    def report(change):
+        if not change.persisted:
+            print(f"✗ ERROR removing rule: {change.error}")
+        elif change.error:
             print(
                 f"Rule {proto_name} {extif}:{ext_port} → {int_ip}:{int_port} removed from "
-                f"configuration, but: {', '.join(errors)}"
+                f"configuration, but: {change.error}"
             )
         else:
             print(f"✓ Rule {proto_name} {extif}:{ext_port} → {int_ip}:{int_port} removed.")
+
+    # The rule is always removed from the JSON, even if the kernel refuses
+    matches = rule_store.find_all(form_key())
+    if matches:
+        ids = [rule["id"] for rule in matches]
+        change_queue.submit(
+            [{"op": "remove", "ids": ids}], require_kernel=False, on_done=report
+        )
     else:
         print(f"✗ Rule {proto_name} {extif}:{ext_port} → {int_ip}:{int_port} not found.")
 
@@ -360,27 +282,23 @@ def enable_rule():
     protocol = request.form.get("protocol", "both")  # Default is 'both' for backward compatibility
 
     # Update the rule in persistent storage
-    rules = load_persisted_rules()
-    for rule in rules:
-        if (
-            rule["extif"] == extif
-            and rule["intif"] == intif
-            and rule["ext_port"] == ext_port
-            and rule["int_ip"] == int_ip
-            and rule["int_port"] == int_port
-        ):
-            # Enable the rule and set status to "enabled"
-            rule["enabled"] = True
-            try:
-                apply_rule(rule)
-                # User-friendly protocol name for the message
-                proto_name = "TCP/UDP" if protocol == "both" else protocol.upper()
+    rule = rule_store.find(form_key())
+    if rule:
+        # User-friendly protocol name for the message
+        proto_name = "TCP/UDP" if protocol == "both" else protocol.upper()
+
+        def report(change):
+            if change.persisted:
                 print(f"✓ Rule {proto_name} {extif}:{ext_port} → {int_ip}:{int_port} enabled.")
-            except RuntimeError as exc:
-                print(f"✗ ERROR enabling rule: {exc}")
-            break
+            else:
+                print(f"✗ ERROR enabling rule: {change.error}")
+
+        # Enable the rule and set status to "enabled"
+        change_queue.submit(
+            [{"op": "update", "id": rule["id"], "fields": {"enabled": True}}],
+            on_done=report,
+        )
 
-    save_persisted_rules(rules)
     return redirect(url_for("web.index"))
 
 
@@ -394,87 +312,103 @@ def disable_rule():
     protocol = request.form.get("protocol", "both")  # Default is 'both' for backward compatibility
 
     # Mark the rule as disabled in persistent storage
-    rules = load_persisted_rules()
-    for rule in rules:
-        if (
-            rule["extif"] == extif
-            and rule["intif"] == intif
-            and rule["ext_port"] == ext_port
-            and rule["int_ip"] == int_ip
-            and rule["int_port"] == int_port
-        ):
-            # Set status to "disabled"
-            rule["enabled"] = False
-
-            # Determine which protocols to remove
-            protocols = []
-            if protocol == "both":
-                protocols = ["tcp", "udp"]
-            else:
-                protocols = [protocol]  # Only remove the selected protocol
-
-            # Remove iptables rules
-            errors = []
-            for proto in protocols:
-                try:
-                    # Remove NAT rule
-                    run(
-                        [
-                            "iptables",
-                            "-t",
-                            "nat",
-                            "-D",
-                            "PREROUTING",
-                            "-i",
-                            extif,
-                            "-p",
-                            proto,
-                            "--dport",
-                            ext_port,
-                            "-j",
-                            "DNAT",
-                            "--to-destination",
-                            f"{int_ip}:{int_port}",
-                        ]
-                    )
-                except RuntimeError:
-                    errors.append(f"{proto.upper()}-NAT rule not found")
-
-                try:
-                    # Remove Forward rule
-                    run(
-                        [
-                            "iptables",
-                            "-D",
-                            "FORWARD",
-                            "-i",
-                            extif,
-                            "-o",
-                            intif,
-                            "-p",
-                            proto,
-                            "--dport",
-                            int_port,
-                            "-d",
-                            int_ip,
-                            "-j",
-                            "ACCEPT",
-                        ]
-                    )
-                except RuntimeError:
-                    errors.append(f"{proto.upper()}-FORWARD rule not found")
-
-            # User-friendly protocol name for the message
-            proto_name = "TCP/UDP" if protocol == "both" else protocol.upper()
-
-            if errors:
+    rule = rule_store.find(form_key())
+    if rule:
+        # User-friendly protocol name for the message
+        proto_name = "TCP/UDP" if protocol == "both" else protocol.upper()
+
+        def report(change):
+            if not change.persisted:
+                print(f"✗ ERROR disabling rule: {change.error}")
+            elif change.error:
                 print(
-                    f"Rule {proto_name} {extif}:{ext_port} → {int_ip}:{int_port} disabled, but: "
-                    f"{', '.join(errors)}"
+                    f"Rule {proto_name} {extif}:{ext_port} → {int_ip}:{int_port} disabled, "
+                    f"but: {change.error}"
                 )
             else:
-                print(f"✓ Rule {proto_name} {extif}:{ext_port} → {int_ip}:{int_port} disabled.")
-            break
+                print(
+                    f"✓ Rule {proto_name} {extif}:{ext_port} → {int_ip}:{int_port} disabled."
+                )
+
+        # Set status to "disabled" and remove the iptables rules
+        change_queue.submit(
+            [{"op": "update", "id": rule["id"], "fields": {"enabled": False}}],
+            require_kernel=False,
+            on_done=report,
+        )
 
-    save_persisted_rules(rules)
     return redirect(url_for("web.index"))
+
+
+@web.route("/resync", methods=["POST"])
+def resync():
+    try:
+        # Hold the store so the queue cannot commit in the middle of a resync
+        with rule_store.transaction():
+            additions, deletions = reconcile(rule_store.rules())
+        print(
+            f"✓ Resync complete: {len(additions)} iptables entries added, "
+            f"{len(deletions)} stale entries removed."
+        )
+    except RuntimeError as exc:
+        print(f"✗ ERROR during resync: {exc}")
+    return redirect(url_for("web.index"))
+
+
+# Scrapes only read values already in memory; the traffic counters are
+# refreshed by the stats collector in the background
+def rule_metric_families():
+    rules = {rule["id"]: rule for rule in rule_store.rules()}
+    stats = stats_collector.all_stats()
+
+    def collect(field):
+        def samples():
+            for rule_id, rule_stats in stats.items():
+                rule = rules.get(rule_id)
+                if rule is None or rule_stats is None:
+                    continue
+                labels = {
+                    "rule_id": rule_id,
+                    "name": rule.get("name", ""),
+                    "extif": rule["extif"],
+                    "ext_port": rule["ext_port"],
+                    "target": f"{rule['int_ip']}:{rule['int_port']}",
+                }
+                yield labels, rule_stats[field]
+
+        return samples
+
+    return [
+        metrics.GaugeFamily(
+            "erpf_rule_bytes_total",
+            "Client bytes forwarded per rule.",
+            "counter",
+            collect("bytes"),
+        ),
+        metrics.GaugeFamily(
+            "erpf_rule_packets_total",
+            "Client packets forwarded per rule.",
+            "counter",
+            collect("packets"),
+        ),
+        metrics.GaugeFamily(
+            "erpf_rule_connections_total",
+            "New connections per rule.",
+            "counter",
+            collect("connections"),
+        ),
+        metrics.GaugeFamily(
+            "erpf_rule_active_flows",
+            "Tracked connections per rule.",
+            "gauge",
+            collect("active_flows"),
+        ),
+    ]
+
+
+@web.route("/metrics")
+def metrics_endpoint():
+    return Response(
+        metrics.render(rule_metric_families()),
+        mimetype="text/plain; version=0.0.4",
+    )
@@ -0,0 +1,29 @@
+"""Dispatch rule application to the configured kernel backend."""
+import importlib
+
+from app.config import FIREWALL_BACKEND
+from app.services.metrics import OPERATION_SECONDS
+
+# Backend name -> module with its reconcile(). Modules are imported on first
+# use, so only the configured backend is ever loaded; the relay alone pulls in
+# asyncio.
+BACKENDS = {
+    "iptables": "app.services.reconciler",
+    "nftables": "app.services.nftables",
+    "relay": "app.services.relay",
+}
+
+
+# reconcile() of a backend
+def get_backend(name=None):
+    name = name or FIREWALL_BACKEND
+    if name not in BACKENDS:
+        raise RuntimeError(
+            f"Unknown firewall backend: {name} (expected one of {', '.join(BACKENDS)})"
+        )
+    return importlib.import_module(BACKENDS[name]).reconcile
+
+
+def reconcile(rules):
+    with OPERATION_SECONDS.time(operation="reconcile"):
+        return get_backend()(rules)
@@ -0,0 +1,267 @@
+"""Single-writer executor that batches rule changes into kernel and file commits."""
+import collections
+import threading
+import time
+import uuid
+
+from app.config import COALESCE_WINDOW_MS
+from app.services import ports
+from app.services.backend import reconcile
+from app.services.iptables import rule_protocols
+from app.services.persistence import apply_journal_entry
+from app.services.store import rule_key, rule_store
+
+# Updated fields that can make a rule collide with another forward
+PLACEMENT_FIELDS = {"extif", "intif", "ext_port", "int_ip", "int_port", "protocol"}
+
+
+class Change:
+    def __init__(self, entries, require_kernel=True, on_done=None):
+        self.id = uuid.uuid4().hex[:16]
+        self.entries = entries
+        # Changes that need the kernel are dropped when it rejects them; the
+        # others are persisted anyway and only report the error
+        self.require_kernel = require_kernel
+        self.on_done = on_done
+        self.status = "pending"
+        self.error = None
+        # Set when the change collides with a rule committed before it
+        self.conflict = False
+        self.persisted = False
+        self.submitted = time.time()
+        self.finished = None
+        self.done = threading.Event()
+
+    def wait(self, timeout=None):
+        self.done.wait(timeout)
+        return self
+
+    def finish(self):
+        self.status = "done" if self.persisted else "failed"
+        self.finished = time.time()
+        self.done.set()
+        if self.on_done:
+            try:
+                self.on_done(self)
+            except Exception as exc:
+                print(f"✗ ERROR in change callback: {exc}")
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "persisted": self.persisted,
+            "conflict": self.conflict,
+            "error": self.error,
+            "submitted": self.submitted,
+            "finished": self.finished,
+        }
+
+
+def _apply(rules, removed, change):
+    for entry in change.entries:
+        if entry["op"] == "remove":
+            ids = set(entry["ids"])
+            removed = removed + [rule for rule in rules if rule.get("id") in ids]
+        rules = apply_journal_entry(rules, entry)
+    return rules, removed
+
+
+# Ids of the rules a change puts in place or moves
+def _placed_ids(change):
+    ids = set()
+    for entry in change.entries:
+        if entry["op"] == "put":
+            ids.add(entry["rule"]["id"])
+        elif entry["op"] == "update" and PLACEMENT_FIELDS.intersection(entry["fields"]):
+            ids.add(entry["id"])
+    return ids
+
+
+def _port_spans(value):
+    try:
+        return ports.parse_ports(value)
+    except ValueError:
+        return []
+
+
+# Why one of the rules `ids` may not be committed next to the others, or None:
+# a forward may neither repeat another one nor reuse an external port another
+# forward on the same interface and protocol takes. Single ports are looked up
+# by port, the few ranges and port lists are compared one by one.
+def find_conflict(rules, ids):
+    singles = {}
+    spanned = {}
+    for rule in rules:
+        spans = _port_spans(rule["ext_port"])
+        if len(spans) == 1 and spans[0][0] == spans[0][1]:
+            singles.setdefault((rule["extif"], spans[0][0]), []).append(rule)
+        else:
+            spanned.setdefault(rule["extif"], []).append((spans, rule))
+    for rule in rules:
+        if rule.get("id") not in ids:
+            continue
+        spans = _port_spans(rule["ext_port"])
+        others = [
+            other
+            for other_spans, other in spanned.get(rule["extif"], ())
+            if ports.overlaps(spans, other_spans)
+        ]
+        for low, high in spans:
+            for port in range(low, high + 1):
+                others.extend(singles.get((rule["extif"], port), ()))
+        for other in others:
+            if other.get("id") == rule["id"]:
+                continue
+            if rule_key(other) == rule_key(rule):
+                return (
+                    f"a rule for {rule['extif']}:{rule['ext_port']} → "
+                    f"{rule['int_ip']}:{rule['int_port']} already exists"
+                )
+            if set(rule_protocols(rule)) & set(rule_protocols(other)):
+                return (
+                    f"{rule['extif']}:{rule['ext_port']} overlaps the forward "
+                    f"{other['extif']}:{other['ext_port']} → "
+                    f"{other['int_ip']}:{other['int_port']}"
+                )
+    return None
+
+
+def _converge(rules, removed):
+    # Removed rules are passed as disabled so that entries left in the
+    # built-in chains by older releases are cleaned up too
+    reconcile(rules + [dict(rule, enabled=False) for rule in removed])
+
+
+# Single writer: every change is committed by one worker thread, which takes
+# whatever queued up since its last commit as one batch. A burst costs one
+# kernel transaction and one write per batch, and submitters get a job back
+# immediately instead of waiting for iptables.
+class ChangeQueue:
+    def __init__(self, store, window_ms=None, max_jobs=1000):
+        self.store = store
+        self.window = (COALESCE_WINDOW_MS if window_ms is None else window_ms) / 1000
+        self.max_jobs = max_jobs
+        self._cond = threading.Condition()
+        self._pending = []
+        self._busy = False
+        self._jobs = collections.OrderedDict()
+        self._worker = None
+        # Bumped after every commit, so readers of the kernel can tell
+        # whether a change of ours landed in between
+        self.generation = 0
+
+    def submit(self, entries, require_kernel=True, on_done=None):
+        change = Change(entries, require_kernel, on_done)
+        with self._cond:
+            self._pending.append(change)
+            self._jobs[change.id] = change
+            # Only the most recent jobs stay queryable
+            while len(self._jobs) > self.max_jobs:
+                self._jobs.popitem(last=False)
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, daemon=True)
+                self._worker.start()
+            self._cond.notify_all()
+        return change
+
+    def job(self, job_id):
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def pending_count(self):
+        with self._cond:
+            return len(self._pending) + (1 if self._busy else 0)
+
+    # Block until everything submitted so far has been committed
+    def join(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._pending or self._busy:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+            if self.window:
+                time.sleep(self.window)
+            with self._cond:
+                batch, self._pending = self._pending, []
+                self._busy = True
+            for change in batch:
+                change.status = "running"
+            try:
+                self._commit(batch)
+            except Exception as exc:
+                for change in batch:
+                    change.error = change.error or str(exc)
+            finally:
+                for change in batch:
+                    change.finish()
+                with self._cond:
+                    self._busy = False
+                    self.generation += 1
+                    self._cond.notify_all()
+
+    def _commit(self, batch):
+        with self.store.transaction():
+            base = self.store.rules()
+            batch = self._drop_conflicts(base, batch)
+            accepted = None
+            if len(batch) > 1:
+                rules, removed = base, []
+                for change in batch:
+                    rules, removed = _apply(rules, removed, change)
+                try:
+                    _converge(rules, removed)
+                    accepted = batch
+                except RuntimeError:
+                    # Fall through to find out which changes the kernel rejects
+                    pass
+            if accepted is None:
+                accepted = self._commit_one_by_one(base, batch)
+
+            entries = [entry for change in accepted for entry in change.entries]
+            if entries:
+                self.store.apply_entries(entries)
+            for change in accepted:
+                change.persisted = True
+
+    # Checks made before a change was queued may be stale by the time it is
+    # committed, so they are repeated here against the rules committed before
+    def _drop_conflicts(self, rules, batch):
+        kept = []
+        for change in batch:
+            candidate, _ = _apply(rules, [], change)
+            error = find_conflict(candidate, _placed_ids(change))
+            if error:
+                change.error = error
+                change.conflict = True
+                continue
+            rules = candidate
+            kept.append(change)
+        return kept
+
+    def _commit_one_by_one(self, rules, batch):
+        accepted = []
+        removed = []
+        for change in batch:
+            candidate, candidate_removed = _apply(rules, removed, change)
+            try:
+                _converge(candidate, candidate_removed)
+            except RuntimeError as exc:
+                change.error = str(exc)
+                if change.require_kernel:
+                    continue
+            rules, removed = candidate, candidate_removed
+            accepted.append(change)
+        return accepted
+
+
+change_queue = ChangeQueue(rule_store)
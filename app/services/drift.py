@@ -0,0 +1,184 @@
+"""Detect forwards removed or changed in the kernel behind our back and repair them."""
+import collections
+import hashlib
+import threading
+import time
+
+from app.config import DRIFT_INTERVAL, FIREWALL_BACKEND
+from app.services import iptables, nftables
+from app.services.changes import change_queue
+from app.services.metrics import DRIFT_EVENTS, OPERATION_SECONDS
+from app.services.reconciler import plan_changes
+from app.services.snapshot import parse_save, spec_fingerprint
+from app.services.store import rule_store
+
+TABLES = ("nat", "filter")
+MAX_EVENTS = 100
+# Changed specs kept per event
+MAX_EVENT_SPECS = 20
+
+
+# Hash only the lines that belong to our chains: their declarations, their
+# rules and the jumps into them. Built-in chain headers carry counters and
+# other tools keep changing their own rules, so neither counts.
+def owned_fingerprint(texts):
+    digest = hashlib.sha1()
+    for text in texts:
+        for line in text.splitlines():
+            if iptables.CHAIN_PREFIX in line and line.startswith((":", "-A ")):
+                digest.update(line.encode())
+                digest.update(b"\n")
+    return digest.hexdigest()
+
+
+def _describe(specs, sign):
+    return [f"{sign} {table} {spec}" for table, spec in specs]
+
+
+# Polls the kernel every `interval` seconds. A poll costs one `iptables-save`
+# per table (or one `nft list table`) and a hash; only when the hash moves is
+# the snapshot parsed and compared to rules.json. Drift is repaired through
+# the change queue, where the reconciler re-applies just the missing pieces.
+class DriftWatcher:
+    def __init__(self, store, queue, backend=None, interval=None):
+        self.store = store
+        self.queue = queue
+        self.backend = backend or FIREWALL_BACKEND
+        self.interval = DRIFT_INTERVAL if interval is None else interval
+        self.lock = threading.Lock()
+        self.events = collections.deque(maxlen=MAX_EVENTS)
+        self.checks = 0
+        self.last_check = None
+        self._fingerprint = None
+        self._generation = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def _read(self):
+        if self.backend == "nftables":
+            try:
+                text = iptables.run(["nft", "list", "table", nftables.TABLE])
+            except RuntimeError:
+                text = ""
+            return hashlib.sha1(text.encode()).hexdigest(), text
+        texts = [iptables.run(["iptables-save", "-t", table]) for table in TABLES]
+        return owned_fingerprint(texts), texts
+
+    # Differences between the kernel and rules.json, as "+ table spec" for
+    # what is missing and "- table spec" for what should not be there, and
+    # the ids of the rules whose tagged kernel rules changed
+    def _iptables_drift(self, texts):
+        parsed = parse_save("".join(texts))
+        snapshot = {name: parsed.get(name, {"chains": {}, "rules": []}) for name in TABLES}
+        rules = self.store.rules()
+        additions, deletions, new_chains, removed_chains = plan_changes(rules, snapshot)
+        changes = (
+            _describe(additions, "+")
+            + _describe(deletions, "-")
+            + [f"+ {table} :{chain}" for table, chain in new_chains]
+            + [f"- {table} :{chain}" for table, chain in removed_chains]
+        )
+        fingerprints = {spec_fingerprint(spec) for _, spec in additions + deletions}
+        drifted = [
+            rule["id"] for rule in rules if iptables.rule_fingerprint(rule) in fingerprints
+        ]
+        return changes, drifted
+
+    # nftables output cannot be matched against the rendered ruleset, since
+    # nft reformats it. The table is ours alone, so any change to it that did
+    # not come with a commit of ours is drift.
+    def _nftables_drift(self, text, generation):
+        if not text:
+            if any(rule.get("enabled", True) for rule in self.store.rules()):
+                return [f"- table {nftables.TABLE}"]
+            return []
+        if self._fingerprint is not None and generation == self._generation:
+            return [f"~ table {nftables.TABLE}"]
+        return []
+
+    # Returns the recorded event, or None when the kernel matches
+    def check(self):
+        if self.backend not in ("iptables", "nftables"):
+            return None
+        # A change of ours is on its way into the kernel
+        if self.queue.pending_count():
+            return None
+        generation = self.queue.generation
+        with OPERATION_SECONDS.time(operation="drift_check"):
+            fingerprint, read = self._read()
+            with self.lock:
+                self.checks += 1
+                self.last_check = time.time()
+            if fingerprint == self._fingerprint:
+                return None
+            if self.backend == "nftables":
+                changes, drifted = self._nftables_drift(read, generation), []
+            else:
+                changes, drifted = self._iptables_drift(read)
+        if generation != self.queue.generation or self.queue.pending_count():
+            # Raced with a commit; look again next time
+            return None
+        # Remember what was seen even when the repair fails, so a kernel that
+        # keeps rejecting it is not retried on every poll
+        self._fingerprint = fingerprint
+        self._generation = generation
+        if not changes:
+            return None
+        return self._record(changes, drifted)
+
+    def _record(self, changes, drifted=()):
+        DRIFT_EVENTS.inc()
+        event = {
+            "time": time.time(),
+            "backend": self.backend,
+            "rules": list(drifted),
+            "changes": len(changes),
+            "specs": changes[:MAX_EVENT_SPECS],
+            "job": None,
+            "repaired": None,
+        }
+        print(f"✗ Kernel rules drifted ({len(changes)} changes), repairing...")
+
+        def report(change):
+            event["repaired"] = change.persisted
+            if change.persisted and not change.error:
+                print("✓ Kernel rules repaired.")
+            else:
+                print(f"✗ ERROR repairing kernel rules: {change.error}")
+
+        # An empty change converges the kernel to rules.json without writing it
+        event["job"] = self.queue.submit([], on_done=report).id
+        with self.lock:
+            self.events.append(event)
+        return event
+
+    def status(self):
+        with self.lock:
+            return {
+                "backend": self.backend,
+                "interval": self.interval,
+                "checks": self.checks,
+                "last_check": self.last_check,
+                "events": list(self.events),
+            }
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.check()
+            except Exception as exc:
+                print(f"✗ ERROR checking kernel rules for drift: {exc}")
+            self._stop.wait(self.interval)
+
+    def start(self):
+        if not self.interval or (self._thread and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+drift_watcher = DriftWatcher(rule_store, change_queue)
@@ -0,0 +1,216 @@
+"""Active backend health checks and failover of load-balanced forwards."""
+import concurrent.futures
+import http.client
+import socket
+import threading
+import time
+
+from app.config import (
+    HEALTH_FALL,
+    HEALTH_INTERVAL,
+    HEALTH_RISE,
+    HEALTH_TIMEOUT,
+    HEALTH_WORKERS,
+)
+from app.services import ports
+from app.services.changes import change_queue
+from app.services.iptables import backend_id, rule_backends
+from app.services.store import rule_store
+
+
+def probe_tcp(ip, port, timeout, check):
+    with socket.create_connection((ip, port), timeout=timeout):
+        pass
+
+
+# Any answer below 500 means the server is up, even when it wants a login
+def probe_http(ip, port, timeout, check):
+    connection = http.client.HTTPConnection(ip, port, timeout=timeout)
+    try:
+        connection.request("GET", check.get("path", "/"))
+        status = connection.getresponse().status
+    finally:
+        connection.close()
+    if status >= 500:
+        raise OSError(f"HTTP {status}")
+
+
+# UDP has no handshake: a backend fails only when the port is closed, which
+# the kernel reports as a refused connection after the ICMP unreachable.
+# Silence is taken as a listener that does not answer this payload.
+def probe_udp(ip, port, timeout, check):
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect((ip, port))
+        sock.send(check.get("payload", "").encode())
+        try:
+            sock.recv(1)
+        except socket.timeout:
+            pass
+
+
+PROBES = {"tcp": probe_tcp, "http": probe_http, "udp": probe_udp}
+
+
+# Run one probe; returns None when the backend answered, else the error.
+# Forwards that keep the original port are probed on their first port.
+def probe(backend, check, timeout):
+    try:
+        port = ports.first_port(backend["int_port"])
+        PROBES[check.get("type", "tcp")](backend["int_ip"], port, timeout, check)
+    except (OSError, http.client.HTTPException) as exc:
+        return str(exc) or type(exc).__name__
+    return None
+
+
+# Probes the backends of every enabled rule with a `health_check` on a bounded
+# thread pool, so a round costs about one timeout however many backends there
+# are. A backend changes state only after `fall` failures or `rise` successes
+# in a row. Backends of load-balanced forwards that are down are listed in the
+# rule's `down` field through the change queue, which takes them out of the
+# rotation in the kernel; single-target forwards are only reported.
+class HealthChecker:
+    def __init__(
+        self, store, queue, interval=None, timeout=None, workers=None, fall=None, rise=None
+    ):
+        self.store = store
+        self.queue = queue
+        self.interval = interval or HEALTH_INTERVAL
+        self.timeout = timeout or HEALTH_TIMEOUT
+        self.workers = workers or HEALTH_WORKERS
+        self.fall = fall or HEALTH_FALL
+        self.rise = rise or HEALTH_RISE
+        self.lock = threading.Lock()
+        self.states = {}
+        self._pool = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def _executor(self):
+        if self._pool is None:
+            self._pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="health"
+            )
+        return self._pool
+
+    def record(self, rule, backend, error, now):
+        key = (rule["id"], backend_id(backend))
+        state = self.states.get(key)
+        if state is None:
+            # Start from what was last persisted, so a restart does not put a
+            # dead backend back into rotation
+            state = self.states[key] = {
+                "healthy": backend_id(backend) not in rule.get("down", ()),
+                "failures": 0,
+                "successes": 0,
+            }
+        if error is None:
+            state["failures"] = 0
+            state["successes"] += 1
+            if state["successes"] >= self.rise:
+                state["healthy"] = True
+        else:
+            state["successes"] = 0
+            state["failures"] += 1
+            if state["failures"] >= self.fall:
+                state["healthy"] = False
+        state["error"] = error
+        state["checked"] = now
+        return key
+
+    def check(self):
+        rules = [
+            rule
+            for rule in self.store.rules()
+            if rule.get("enabled", True) and rule.get("health_check")
+        ]
+        targets = [(rule, backend) for rule in rules for backend in rule_backends(rule)]
+        errors = self._executor().map(
+            lambda target: probe(target[1], target[0]["health_check"], self.timeout), targets
+        )
+        now = time.time()
+        with self.lock:
+            seen = {
+                self.record(rule, backend, error, now)
+                for (rule, backend), error in zip(targets, errors)
+            }
+            # Forget backends that are no longer checked
+            for key in set(self.states) - seen:
+                del self.states[key]
+            entries = self.failover_entries(rules)
+        if entries:
+            self.queue.submit(entries, on_done=self._report)
+
+    # Update entries for the balanced rules whose `down` list is out of date.
+    # With every backend down the list is cleared: spreading traffic over all
+    # of them is no worse than sending it to one.
+    def failover_entries(self, rules):
+        entries = []
+        for rule in rules:
+            backends = rule_backends(rule)
+            if len(backends) < 2:
+                continue
+            down = [
+                backend_id(backend)
+                for backend in backends
+                if not self.states[(rule["id"], backend_id(backend))]["healthy"]
+            ]
+            if len(down) == len(backends):
+                down = []
+            if sorted(down) != sorted(rule.get("down", ())):
+                entries.append({"op": "update", "id": rule["id"], "fields": {"down": down}})
+        return entries
+
+    def _report(self, change):
+        for entry in change.entries:
+            down = entry["fields"]["down"]
+            if not change.persisted:
+                print(f"✗ ERROR failing over rule {entry['id']}: {change.error}")
+            elif down:
+                print(f"✓ Rule {entry['id']}: {', '.join(down)} out of rotation")
+            else:
+                print(f"✓ Rule {entry['id']}: all backends in rotation")
+
+    # [{"int_ip", "int_port", "healthy", "error", "checked"}] per checked
+    # backend of the rule, or None when the rule is not checked (yet)
+    def rule_health(self, rule):
+        with self.lock:
+            results = []
+            for backend in rule_backends(rule):
+                state = self.states.get((rule["id"], backend_id(backend)))
+                if state is None:
+                    return None
+                results.append(
+                    {
+                        "int_ip": backend["int_ip"],
+                        "int_port": backend["int_port"],
+                        "healthy": state["healthy"],
+                        "error": state["error"],
+                        "checked": state["checked"],
+                    }
+                )
+            return results
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.check()
+            except Exception as exc:
+                print(f"✗ ERROR checking backend health: {exc}")
+            self._stop.wait(self.interval)
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+
+
+health_checker = HealthChecker(rule_store, change_queue)
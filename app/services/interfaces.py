@@ -0,0 +1,122 @@
+"""Cached inventory of network interfaces, refreshed on rtnetlink events."""
+import socket
+import threading
+import time
+
+from app.config import EXTERNAL_IF_EXCLUDE, INTERFACE_TTL, INTERNAL_IF_PREFIXES
+
+OPERSTATE_FILE = "/sys/class/net/{}/operstate"
+# rtnetlink multicast groups for link and address changes
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV6_IFADDR = 0x100
+
+
+def link_state(name):
+    try:
+        with open(OPERSTATE_FILE.format(name)) as handle:
+            return handle.read().strip()
+    except OSError:
+        return "unknown"
+
+
+# netifaces is imported where it is used, so processes that never list
+# interfaces (CLI tools, the benchmark, a background worker) do not load it
+def read_interface(name):
+    import netifaces
+
+    try:
+        addresses = netifaces.ifaddresses(name)
+    except ValueError:
+        # The interface went away between listing and reading it
+        addresses = {}
+    return {
+        "name": name,
+        "state": link_state(name),
+        "ipv4": [entry["addr"] for entry in addresses.get(netifaces.AF_INET, [])],
+        # Drop the %scope suffix of link-local addresses
+        "ipv6": [
+            entry["addr"].split("%")[0] for entry in addresses.get(netifaces.AF_INET6, [])
+        ],
+    }
+
+
+# Split interface names into the ones offered as external and as internal
+def classify(names, internal_prefixes, external_exclude):
+    externals = [name for name in names if name not in external_exclude]
+    internals = [name for name in names if name.startswith(tuple(internal_prefixes))]
+    return externals, internals
+
+
+class InterfaceInventory:
+    def __init__(self, ttl=None, internal_prefixes=None, external_exclude=None):
+        self.ttl = INTERFACE_TTL if ttl is None else ttl
+        self.internal_prefixes = tuple(internal_prefixes or INTERNAL_IF_PREFIXES)
+        self.external_exclude = tuple(external_exclude or EXTERNAL_IF_EXCLUDE)
+        self.lock = threading.Lock()
+        self._cache = None
+        self._expires = 0
+        self._thread = None
+        self._stop = threading.Event()
+
+    # Cached {"interfaces": [...], "externals": [...], "internals": [...]}
+    def snapshot(self):
+        with self.lock:
+            if self._cache is None or time.monotonic() >= self._expires:
+                self._cache = self._read()
+                self._expires = time.monotonic() + self.ttl
+            return self._cache
+
+    def invalidate(self):
+        with self.lock:
+            self._expires = 0
+
+    def _read(self):
+        import netifaces
+
+        names = netifaces.interfaces()
+        externals, internals = classify(names, self.internal_prefixes, self.external_exclude)
+        return {
+            "interfaces": [read_interface(name) for name in names],
+            "externals": externals,
+            "internals": internals,
+        }
+
+    # Any link or address event marks the cache stale; the next snapshot()
+    # rereads it, so a burst of events costs one refresh
+    def _listen(self, sock):
+        try:
+            while not self._stop.is_set():
+                try:
+                    if sock.recv(65536):
+                        self.invalidate()
+                except socket.timeout:
+                    continue
+                except OSError as exc:
+                    print(f"✗ WARNING: rtnetlink listener stopped: {exc}")
+                    return
+        finally:
+            sock.close()
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+            sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV6_IFADDR))
+            sock.settimeout(1)
+        except (AttributeError, OSError) as exc:
+            print(
+                f"✗ WARNING: rtnetlink unavailable, refreshing interfaces every "
+                f"{self.ttl:g}s: {exc}"
+            )
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._listen, args=(sock,), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+interface_inventory = InterfaceInventory()
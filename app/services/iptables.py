@@ -1,133 +1,329 @@
+"""iptables ruleset for the forwards: spec rendering, restore payloads and the run() helper."""
+import hashlib
 import subprocess
 
+from app.services import ports
+from app.services.metrics import COMMAND_SECONDS, COMMANDS
+from app.services.native import native_kernel
+from app.services.snapshot import TAG_PREFIX, parse_save
 
-def run(cmd):
+# Every kernel rule this tool manages lives in its own chains. The built-in
+# chains only carry one jump each, and forwards are grouped per external
+# interface so packet classification scales with the rules on that interface.
+CHAIN_PREFIX = "ERPF-"
+NAT_CHAIN = "ERPF-PREROUTING"
+POSTROUTING_CHAIN = "ERPF-POSTROUTING"
+FORWARD_CHAIN = "ERPF-FORWARD"
+BUILTIN_JUMPS = [
+    ("nat", "PREROUTING", NAT_CHAIN),
+    ("nat", "POSTROUTING", POSTROUTING_CHAIN),
+    ("filter", "FORWARD", FORWARD_CHAIN),
+]
+
+
+# Calls served in-process are counted in erpf_native_calls_total instead
+def run(cmd, input=None):
+    output = native_kernel.run(cmd, input)
+    if output is not None:
+        return output
+    COMMANDS.inc(command=cmd[0])
     try:
-        return subprocess.check_output(cmd, stderr=subprocess.STDOUT, text=True)
+        with COMMAND_SECONDS.time(command=cmd[0]):
+            return subprocess.check_output(
+                cmd, stderr=subprocess.STDOUT, text=True, input=input
+            )
     except subprocess.CalledProcessError as exc:
         raise RuntimeError(f"Command failed: {' '.join(cmd)}\n{exc.output}")
 
 
-# Rule application logic (used for both adding and restoring rules)
-def apply_rule(rule):
+def rule_protocols(rule):
+    protocol = rule.get("protocol", "both")  # Default to 'both' for backward compatibility
+    return ["tcp", "udp"] if protocol == "both" else [protocol]
+
+
+# The targets of a rule as [{"int_ip", "int_port", "weight"}]. A rule with
+# several backends spreads new connections across them by weight; its
+# int_ip/int_port always name the first one.
+def rule_backends(rule):
+    return rule.get("backends") or [
+        {"int_ip": rule["int_ip"], "int_port": rule["int_port"], "weight": 1}
+    ]
+
+
+def backend_id(backend):
+    return f"{backend['int_ip']}:{backend['int_port']}"
+
+
+# Backends in rotation: the ones the health checker has not marked down, or
+# all of them when none would be left
+def active_backends(rule):
+    backends = rule_backends(rule)
+    down = set(rule.get("down", ()))
+    return [backend for backend in backends if backend_id(backend) not in down] or backends
+
+
+def is_balanced(rule):
+    return len(active_backends(rule)) > 1
+
+
+def _backend_list(backends):
+    return ",".join(f"{backend_id(backend)}*{backend.get('weight', 1)}" for backend in backends)
+
+
+# Stable hash of everything in a persisted rule that shapes its kernel rules.
+# Names, ids, the enabled flag and health state leave it unchanged, so a
+# rule keeps its fingerprint across renames and failovers.
+def rule_fingerprint(rule):
+    key = "|".join(
+        [
+            rule["extif"],
+            rule["intif"],
+            rule.get("protocol", "both"),
+            rule["ext_port"],
+            _backend_list(rule_backends(rule)),
+        ]
+    )
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+# Comment match carried by every rule a forward puts in the kernel, so its
+# rules are found again by one lookup in a parsed snapshot
+def rule_tag(rule):
+    return f"-m comment --comment {TAG_PREFIX}{rule_fingerprint(rule)}"
+
+
+# Load-balanced forwards jump to their own chain named after the rule and its
+# active backends, so any change to the list builds a fresh chain with the
+# DNAT rules in order instead of appending to a chain where the order decides
+# the weights.
+def balance_chain(rule):
+    key = f"{rule_fingerprint(rule)}|{_backend_list(active_backends(rule))}"
+    return f"ERPF-LB-{hashlib.sha1(key.encode()).hexdigest()[:12]}"
+
+
+# The statistic match keeps the probability as a 31-bit fraction and
+# iptables-save prints it back with 11 decimals
+def statistic_probability(probability):
+    return f"{int(0x80000000 * probability + 0.5) / 0x80000000:.11f}"
+
+
+def nat_subchain(extif):
+    return f"ERPF-PRE-{extif}"
+
+
+def forward_subchain(extif):
+    return f"ERPF-FWD-{extif}"
+
+
+def is_owned_chain(chain):
+    return chain.startswith(CHAIN_PREFIX)
+
+
+def spec_chain(spec):
+    return spec[1].split(" ", 2)[1]
+
+
+# Rule specs are kept in the exact form `iptables-save` prints them, so the
+# live ruleset can be compared line by line without re-parsing options. Port
+# ranges and lists compile to one --dport a:b or multiport rule per protocol.
+def forward_specs(rule, protocols=None):
     extif = rule["extif"]
     intif = rule["intif"]
     ext_port = rule["ext_port"]
-    int_ip = rule["int_ip"]
-    int_port = rule["int_port"]
-    protocol = rule.get("protocol", "both")  # Default to 'both' for backward compatibility
-
-    # Enable IP forwarding
-    run(["sysctl", "-w", "net.ipv4.ip_forward=1"])
+    tag = rule_tag(rule)
 
-    # Determine which protocols to apply
-    protocols = []
-    if protocol == "both":
-        protocols = ["tcp", "udp"]
+    if is_balanced(rule):
+        target = f"-j {balance_chain(rule)}"
     else:
-        protocols = [protocol]  # Only apply the selected protocol
+        backend = active_backends(rule)[0]
+        target = (
+            "-j DNAT --to-destination "
+            f"{ports.dnat_target(backend['int_ip'], backend['int_port'])}"
+        )
 
-    for proto in protocols:
+    specs = []
+    for proto in protocols or rule_protocols(rule):
         # NAT PREROUTING
-        try:
-            run(
-                [
-                    "iptables",
-                    "-t",
-                    "nat",
-                    "-C",
-                    "PREROUTING",
-                    "-i",
-                    extif,
-                    "-p",
-                    proto,
-                    "--dport",
-                    ext_port,
-                    "-j",
-                    "DNAT",
-                    "--to-destination",
-                    f"{int_ip}:{int_port}",
-                ]
+        specs.append(
+            (
+                "nat",
+                f"-A {nat_subchain(extif)} -p {proto} {ports.iptables_match(proto, ext_port)} "
+                f"{tag} {target}",
             )
-        except RuntimeError:
-            run(
-                [
-                    "iptables",
-                    "-t",
+        )
+        # FORWARD
+        for backend in rule_backends(rule):
+            specs.append(
+                (
+                    "filter",
+                    f"-A {forward_subchain(extif)} -d {backend['int_ip']}/32 -o {intif} "
+                    f"-p {proto} {ports.iptables_match(proto, backend['int_port'])} "
+                    f"{tag} -j ACCEPT",
+                )
+            )
+    return specs
+
+
+# DNAT rules of a load-balanced forward. Each backend takes its share of what
+# the backends before it left over, and the last one takes the rest.
+def balance_specs(rule):
+    if not is_balanced(rule):
+        return []
+    chain = balance_chain(rule)
+    tag = rule_tag(rule)
+    backends = active_backends(rule)
+    specs = []
+    for proto in rule_protocols(rule):
+        remaining = sum(backend.get("weight", 1) for backend in backends)
+        for index, backend in enumerate(backends):
+            target = ports.dnat_target(backend["int_ip"], backend["int_port"])
+            weight = backend.get("weight", 1)
+            statistic = ""
+            if index < len(backends) - 1:
+                probability = statistic_probability(weight / remaining)
+                statistic = f"-m statistic --mode random --probability {probability} "
+            specs.append(
+                (
                     "nat",
-                    "-A",
-                    "PREROUTING",
-                    "-i",
-                    extif,
-                    "-p",
-                    proto,
-                    "--dport",
-                    ext_port,
-                    "-j",
-                    "DNAT",
-                    "--to-destination",
-                    f"{int_ip}:{int_port}",
-                ]
+                    f"-A {chain} -p {proto} {statistic}{tag} -j DNAT --to-destination {target}",
+                )
             )
-            # FORWARD
-            run(
-                [
-                    "iptables",
-                    "-A",
-                    "FORWARD",
-                    "-i",
-                    extif,
-                    "-o",
-                    intif,
-                    "-p",
-                    proto,
-                    "--dport",
-                    int_port,
-                    "-d",
-                    int_ip,
-                    "-j",
-                    "ACCEPT",
-                ]
+            remaining -= weight
+    return specs
+
+
+# Per-interface dispatch from the top-level owned chains
+def dispatch_specs(rule):
+    extif = rule["extif"]
+    return [
+        ("nat", f"-A {NAT_CHAIN} -i {extif} -j {nat_subchain(extif)}"),
+        ("filter", f"-A {FORWARD_CHAIN} -i {extif} -j {forward_subchain(extif)}"),
+    ]
+
+
+# Interface-level rules shared by every forward between the same interfaces
+def shared_specs(rule):
+    extif = rule["extif"]
+    intif = rule["intif"]
+    return [
+        # MASQUERADE on internal interface
+        ("nat", f"-A {POSTROUTING_CHAIN} -o {intif} -j MASQUERADE"),
+        # Return route (ESTABLISHED)
+        (
+            "filter",
+            f"-A {FORWARD_CHAIN} -i {intif} -o {extif} -m conntrack "
+            "--ctstate RELATED,ESTABLISHED -j ACCEPT",
+        ),
+    ]
+
+
+def jump_specs():
+    return [(table, f"-A {chain} -j {target}") for table, chain, target in BUILTIN_JUMPS]
+
+
+def rule_specs(rule):
+    return dispatch_specs(rule) + forward_specs(rule) + balance_specs(rule) + shared_specs(rule)
+
+
+# Specs written straight into the built-in chains by older releases; they are
+# only ever looked up to migrate them away. Those releases had no port ranges.
+def legacy_specs(rule):
+    if not (ports.is_single_port(rule["ext_port"]) and ports.is_single_port(rule["int_port"])):
+        return []
+    extif = rule["extif"]
+    intif = rule["intif"]
+    specs = []
+    for proto in ("tcp", "udp"):
+        specs.append(
+            (
+                "nat",
+                f"-A PREROUTING -i {extif} -p {proto} -m {proto} --dport {rule['ext_port']} "
+                f"-j DNAT --to-destination {rule['int_ip']}:{rule['int_port']}",
             )
-    # MASQUERADE on internal interface
-    try:
-        run(["iptables", "-t", "nat", "-C", "POSTROUTING", "-o", intif, "-j", "MASQUERADE"])
-    except RuntimeError:
-        run(["iptables", "-t", "nat", "-A", "POSTROUTING", "-o", intif, "-j", "MASQUERADE"])
-    # Return route (ESTABLISHED)
-    try:
-        run(
-            [
-                "iptables",
-                "-C",
-                "FORWARD",
-                "-i",
-                intif,
-                "-o",
-                extif,
-                "-m",
-                "conntrack",
-                "--ctstate",
-                "ESTABLISHED,RELATED",
-                "-j",
-                "ACCEPT",
-            ]
         )
-    except RuntimeError:
-        run(
-            [
-                "iptables",
-                "-A",
-                "FORWARD",
-                "-i",
-                intif,
-                "-o",
-                extif,
-                "-m",
-                "conntrack",
-                "--ctstate",
-                "ESTABLISHED,RELATED",
-                "-j",
-                "ACCEPT",
-            ]
+        specs.append(
+            (
+                "filter",
+                f"-A FORWARD -d {rule['int_ip']}/32 -i {extif} -o {intif} -p {proto} "
+                f"-m {proto} --dport {rule['int_port']} -j ACCEPT",
+            )
         )
+    return specs
+
+
+# Ordered, de-duplicated list of every spec the enabled rules need
+def desired_specs(rules):
+    desired = []
+    seen = set()
+    for rule in rules:
+        if not rule.get("enabled", True):
+            continue
+        for spec in rule_specs(rule):
+            if spec not in seen:
+                seen.add(spec)
+                desired.append(spec)
+    if desired:
+        desired = jump_specs() + desired
+    return desired
+
+
+def spec_owned_chains(spec):
+    tokens = spec[1].split()
+    chains = [tokens[1]]
+    if "-j" in tokens:
+        chains.append(tokens[tokens.index("-j") + 1])
+    return [(spec[0], chain) for chain in chains if is_owned_chain(chain)]
+
+
+def read_snapshot(tables=("nat", "filter"), counters=False):
+    cmd = ["iptables-save"] + (["-c"] if counters else [])
+    parsed = parse_save(run(cmd))
+    return {name: parsed.get(name, {"chains": {}, "rules": []}) for name in tables}
+
+
+def live_chains(snapshot):
+    return {
+        (table_name, chain)
+        for table_name, table in snapshot.items()
+        for chain in table["chains"]
+    }
+
+
+def spec_counts(snapshot):
+    counts = {}
+    for table_name, table in snapshot.items():
+        for entry in table["rules"]:
+            key = (table_name, entry["spec"])
+            counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+# Within each table: new chains, deletions, additions, then chain removals.
+# Only chains missing from the kernel may be declared, because with
+# --noflush declaring an existing chain flushes it.
+def build_restore_payload(specs, deletions=(), new_chains=(), removed_chains=()):
+    tables = {}
+    for table, chain in new_chains:
+        tables.setdefault(table, []).append(f":{chain} - [0:0]")
+    for table, spec in deletions:
+        tables.setdefault(table, []).append("-D" + spec[2:])
+    for table, spec in specs:
+        tables.setdefault(table, []).append(spec)
+    for table, chain in removed_chains:
+        tables.setdefault(table, []).append(f"-X {chain}")
+    lines = []
+    for table, table_lines in tables.items():
+        lines.append(f"*{table}")
+        lines.extend(table_lines)
+        lines.append("COMMIT")
+    return "\n".join(lines) + "\n" if lines else ""
+
+
+def missing_chains(specs, chains):
+    missing = []
+    for spec in specs:
+        for chain in spec_owned_chains(spec):
+            if chain not in chains:
+                chains.add(chain)
+                missing.append(chain)
+    return missing
@@ -0,0 +1,163 @@
+"""Minimal in-process Prometheus metrics."""
+import bisect
+import contextlib
+import functools
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REGISTRY = []
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        escaped = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{escaped}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+        REGISTRY.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}{labels} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        # label values -> [per-bucket counts..., +Inf count, sum]
+        self.values = {}
+        REGISTRY.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [0] * (len(self.buckets) + 2)
+            state[index] += 1
+            state[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def timed(self, **labels):
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.time(**labels):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            items = sorted((key, list(state)) for key, state in self.values.items())
+        names = self.labelnames + ("le",)
+        for key, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), state[:-1]):
+                cumulative += count
+                labels = _format_labels(names, key + (_format_value(bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(state[-1])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+# Gauges computed at scrape time from values that are already in memory
+class GaugeFamily:
+    def __init__(self, name, documentation, metric_type, collect):
+        self.name = name
+        self.documentation = documentation
+        self.metric_type = metric_type
+        self.collect = collect
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.metric_type}",
+        ]
+        for labels, value in self.collect():
+            names = tuple(labels)
+            label_text = _format_labels(names, tuple(labels[name] for name in names))
+            lines.append(f"{self.name}{label_text} {_format_value(value)}")
+        return lines
+
+
+def render(families=()):
+    lines = []
+    for metric in list(REGISTRY) + list(families):
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+COMMANDS = Counter("erpf_commands_total", "Subprocess invocations by command.", ["command"])
+NATIVE_CALLS = Counter(
+    "erpf_native_calls_total",
+    "Kernel calls served in-process instead of a subprocess.",
+    ["command"],
+)
+COMMAND_SECONDS = Histogram(
+    "erpf_command_duration_seconds", "Subprocess latency by command.", ["command"]
+)
+OPERATION_SECONDS = Histogram(
+    "erpf_operation_duration_seconds",
+    "Time spent in rule application, restore and rules.json I/O.",
+    ["operation"],
+)
+DRIFT_EVENTS = Counter(
+    "erpf_drift_events_total", "Changes to the managed kernel rules made by something else."
+)
+RULE_RELOADS = Counter(
+    "erpf_rule_reloads_total",
+    "Edits to rules.json made outside the service, by whether they were taken up.",
+    ["result"],
+)
+REQUEST_SECONDS = Histogram(
+    "erpf_request_duration_seconds", "HTTP request latency by route.", ["method", "route"]
+)
@@ -0,0 +1,103 @@
+"""In-process kernel calls that spare the fork/exec of a command-line tool."""
+import ctypes
+import ctypes.util
+import os
+import threading
+
+from app.config import NATIVE_KERNEL_CALLS
+from app.services.metrics import NATIVE_CALLS
+
+PROC_SYS = "/proc/sys"
+
+
+# `sysctl -w net.ipv4.ip_forward=1` as a write to /proc/sys
+def write_sysctl(setting, root=PROC_SYS):
+    key, _, value = setting.partition("=")
+    with open(os.path.join(root, *key.strip().split(".")), "w") as handle:
+        handle.write(value.strip() + "\n")
+
+
+# libnftables is the library behind the nft command, so a ruleset is parsed
+# and committed in one netlink transaction exactly as `nft -f -` would.
+class Libnftables:
+    def __init__(self, library):
+        library.nft_ctx_new.argtypes = [ctypes.c_uint32]
+        library.nft_ctx_new.restype = ctypes.c_void_p
+        for name in ("nft_ctx_buffer_output", "nft_ctx_buffer_error"):
+            getattr(library, name).argtypes = [ctypes.c_void_p]
+        for name in ("nft_ctx_get_output_buffer", "nft_ctx_get_error_buffer"):
+            getattr(library, name).argtypes = [ctypes.c_void_p]
+            getattr(library, name).restype = ctypes.c_char_p
+        library.nft_run_cmd_from_buffer.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
+        library.nft_run_cmd_from_buffer.restype = ctypes.c_int
+        self.library = library
+        self.lock = threading.Lock()
+        self.context = library.nft_ctx_new(0)
+        library.nft_ctx_buffer_output(self.context)
+        library.nft_ctx_buffer_error(self.context)
+
+    @classmethod
+    def load(cls):
+        try:
+            return cls(ctypes.CDLL(ctypes.util.find_library("nftables") or "libnftables.so.1"))
+        except (OSError, AttributeError):
+            return None
+
+    # Returns (status, output, error); buffers belong to the context and are
+    # only valid until its next command, hence the lock
+    def run(self, commands):
+        with self.lock:
+            status = self.library.nft_run_cmd_from_buffer(self.context, commands.encode())
+            output = self.library.nft_ctx_get_output_buffer(self.context) or b""
+            error = self.library.nft_ctx_get_error_buffer(self.context) or b""
+        return status, output.decode(), error.decode()
+
+
+# Serves the commands it can in-process: sysctl writes go to /proc/sys and
+# nft commands to libnftables. Everything else, and anything that cannot be
+# done in-process on this host, is left to the subprocess path.
+class NativeKernel:
+    def __init__(self, enabled=None, loader=Libnftables.load, proc_sys=PROC_SYS):
+        self.enabled = NATIVE_KERNEL_CALLS if enabled is None else enabled
+        self.loader = loader
+        self.proc_sys = proc_sys
+        self.lock = threading.Lock()
+        self._nft = None
+        self._nft_loaded = False
+
+    def nft(self):
+        with self.lock:
+            if not self._nft_loaded:
+                self._nft = self.loader()
+                self._nft_loaded = True
+                if self._nft is None:
+                    print("✗ WARNING: libnftables not found, running the nft command instead")
+            return self._nft
+
+    # The command's output, or None when it has to run as a subprocess.
+    # Failures raise the same RuntimeError as the subprocess path.
+    def run(self, cmd, input=None):
+        if not self.enabled:
+            return None
+        if cmd[:2] == ["sysctl", "-w"] and len(cmd) == 3:
+            try:
+                write_sysctl(cmd[2], self.proc_sys)
+            except OSError:
+                # Read-only /proc/sys, e.g. in an unprivileged container
+                return None
+            NATIVE_CALLS.inc(command="sysctl")
+            return f"{cmd[2].replace('=', ' = ')}\n"
+        if cmd[0] == "nft":
+            nft = self.nft()
+            if nft is None:
+                return None
+            commands = (input or "") if cmd[1:] == ["-f", "-"] else " ".join(cmd[1:])
+            status, output, error = nft.run(commands)
+            NATIVE_CALLS.inc(command="nft")
+            if status != 0:
+                raise RuntimeError(f"Command failed: {' '.join(cmd)}\n{error}")
+            return output
+        return None
+
+
+native_kernel = NativeKernel()
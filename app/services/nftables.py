@@ -0,0 +1,192 @@
+"""nftables backend rendering forwards into verdict maps."""
+from app.services import ports
+from app.services.iptables import (
+    active_backends,
+    is_balanced,
+    rule_backends,
+    rule_protocols,
+    run,
+)
+
+# All forwards live in one table. DNAT targets are looked up in a map keyed on
+# (iif, proto, dport), so classification is a hash hit instead of a chain walk.
+# The maps are interval maps, so a port range is one element. Forwards that
+# keep the original port (port lists and ranges onto the same range) look up
+# only the address in fwd_dnat_keep. Load-balanced forwards are one rule each
+# ahead of the lookups, picking a backend with a numgen map.
+TABLE = "ip erpf"
+
+RULESET_TEMPLATE = """table {table} {{
+    map fwd_dnat {{
+        type ifname . inet_proto . inet_service : ipv4_addr . inet_service
+        flags interval
+{dnat_elements}    }}
+
+    map fwd_dnat_keep {{
+        type ifname . inet_proto . inet_service : ipv4_addr
+        flags interval
+{keep_elements}    }}
+
+    set fwd_allow {{
+        type ifname . ifname . ipv4_addr . inet_proto . inet_service
+        flags interval
+{allow_elements}    }}
+
+    set masq_oifs {{
+        type ifname
+{masq_elements}    }}
+
+    set return_paths {{
+        type ifname . ifname
+{return_elements}    }}
+
+    chain prerouting {{
+        type nat hook prerouting priority dstnat; policy accept;
+{balance_rules}        dnat ip to iifname . meta l4proto . th dport map @fwd_dnat
+        dnat ip to iifname . meta l4proto . th dport map @fwd_dnat_keep
+    }}
+
+    chain postrouting {{
+        type nat hook postrouting priority srcnat; policy accept;
+        oifname @masq_oifs masquerade
+    }}
+
+    chain forward {{
+        type filter hook forward priority filter; policy accept;
+        iifname . oifname . ip daddr . meta l4proto . th dport @fwd_allow accept
+        ct state related,established iifname . oifname @return_paths accept
+    }}
+}}
+"""
+
+
+def _append_unique(elements, seen, name, item):
+    if item not in seen[name]:
+        seen[name].add(item)
+        elements[name].append(item)
+
+
+# Return {"fwd_dnat": [...], "fwd_dnat_keep": [...], "fwd_allow": [...],
+# "masq_oifs": [...], "return_paths": [...]} with every element the enabled
+# rules need, in order.
+def map_elements(rules):
+    elements = {
+        "fwd_dnat": [],
+        "fwd_dnat_keep": [],
+        "fwd_allow": [],
+        "masq_oifs": [],
+        "return_paths": [],
+    }
+    seen = {name: set() for name in elements}
+    dnat_keys = set()
+    for rule in rules:
+        if not rule.get("enabled", True):
+            continue
+        extif = rule["extif"]
+        intif = rule["intif"]
+        target = active_backends(rule)[0]
+        int_ip = target["int_ip"]
+        int_port = ports.normalize_ports(target["int_port"])
+        keep_port = not ports.is_single_port(int_port)
+        for proto in rule_protocols(rule):
+            for ext_port in ports.nft_elements(rule["ext_port"]):
+                # A key is unique across both maps, so a later rule cannot
+                # shadow an earlier one
+                key = f'"{extif}" . {proto} . {ext_port}'
+                if key in dnat_keys:
+                    continue
+                dnat_keys.add(key)
+                if is_balanced(rule):
+                    # Rendered by balance_rules instead
+                    continue
+                if keep_port:
+                    elements["fwd_dnat_keep"].append(f"{key} : {int_ip}")
+                else:
+                    elements["fwd_dnat"].append(f"{key} : {int_ip} . {int_port}")
+            for backend in rule_backends(rule):
+                for allowed in ports.nft_elements(backend["int_port"]):
+                    _append_unique(
+                        elements,
+                        seen,
+                        "fwd_allow",
+                        f'"{extif}" . "{intif}" . {backend["int_ip"]} . {proto} . {allowed}',
+                    )
+        _append_unique(elements, seen, "masq_oifs", f'"{intif}"')
+        _append_unique(elements, seen, "return_paths", f'"{intif}" . "{extif}"')
+    return elements
+
+
+def _set_expression(items):
+    return items[0] if len(items) == 1 else f"{{ {', '.join(items)} }}"
+
+
+# One prerouting rule per enabled load-balanced forward. numgen draws a slot
+# below the total weight and each backend owns as many slots as its weight.
+def balance_rules(rules):
+    statements = []
+    for rule in rules:
+        if not rule.get("enabled", True) or not is_balanced(rule):
+            continue
+        backends = active_backends(rule)
+        # Backends either all have one port or all keep the original port,
+        # which means DNAT to the address alone
+        keep_port = not ports.is_single_port(backends[0]["int_port"])
+        slots = []
+        start = 0
+        for backend in backends:
+            end = start + backend.get("weight", 1) - 1
+            target = backend["int_ip"]
+            if not keep_port:
+                target += f" . {ports.normalize_ports(backend['int_port'])}"
+            slots.append(f"{start if start == end else f'{start}-{end}'} : {target}")
+            start = end + 1
+        protocols = _set_expression(rule_protocols(rule))
+        dports = _set_expression(ports.nft_elements(rule["ext_port"]))
+        nat = "dnat ip to" if keep_port else "dnat ip addr . port to"
+        statements.append(
+            f'iifname "{rule["extif"]}" meta l4proto {protocols} th dport {dports} '
+            f"{nat} numgen random mod {start} map {{ {', '.join(slots)} }}"
+        )
+    return statements
+
+
+def _render_elements(items):
+    if not items:
+        return ""
+    body = ",\n".join(f"            {item}" for item in items)
+    return f"        elements = {{\n{body}\n        }}\n"
+
+
+def render_ruleset(rules):
+    elements = map_elements(rules)
+    return RULESET_TEMPLATE.format(
+        table=TABLE,
+        balance_rules="".join(f"        {rule}\n" for rule in balance_rules(rules)),
+        dnat_elements=_render_elements(elements["fwd_dnat"]),
+        keep_elements=_render_elements(elements["fwd_dnat_keep"]),
+        allow_elements=_render_elements(elements["fwd_allow"]),
+        masq_elements=_render_elements(elements["masq_oifs"]),
+        return_elements=_render_elements(elements["return_paths"]),
+    )
+
+
+# Declaring the table first makes the delete safe when it does not exist yet,
+# so the whole replacement is a single atomic `nft -f` transaction.
+def build_replace_payload(rules):
+    payload = f"table {TABLE}\ndelete table {TABLE}\n"
+    if any(rule.get("enabled", True) for rule in rules):
+        payload += render_ruleset(rules)
+    return payload
+
+
+# The whole table is replaced, so every desired DNAT element counts as written
+# and nothing is left behind to delete.
+def reconcile(rules):
+    rules = list(rules)
+    if any(rule.get("enabled", True) for rule in rules):
+        # Enable IP forwarding
+        run(["sysctl", "-w", "net.ipv4.ip_forward=1"])
+
+    run(["nft", "-f", "-"], input=build_replace_payload(rules))
+    elements = map_elements(rules)
+    return elements["fwd_dnat"] + elements["fwd_dnat_keep"] + balance_rules(rules), []
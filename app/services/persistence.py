@@ -1,95 +1,254 @@
+import contextlib
+import fcntl
 import json
 import os
+import tempfile
+import threading
+import time
 
 from app.config import RULES_FILE
-from app.services.iptables import apply_rule, run
+from app.services.backend import reconcile
+from app.services.metrics import OPERATION_SECONDS
+from app.services.rule import Rule
+
+
+def journal_path(path=None):
+    return os.path.splitext(path or RULES_FILE)[0] + ".journal"
+
+
+# Exclusive advisory lock next to rules.json, so separate processes serving
+# the same data directory never interleave their kernel and file commits
+@contextlib.contextmanager
+def file_lock(path=None):
+    lock_path = os.path.splitext(path or RULES_FILE)[0] + ".lock"
+    with open(lock_path, "a") as handle:
+        fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+        try:
+            yield handle
+        finally:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+
+
+# Journal entries are single JSON lines: {"op": "put", "rule": {...}},
+# {"op": "update", "id": ..., "fields": {...}} or {"op": "remove", "ids": [...]}.
+# Replaying an entry twice gives the same result, so a crash between writing
+# a snapshot and truncating the journal loses nothing.
+def apply_journal_entry(rules, entry):
+    op = entry["op"]
+    if op == "put":
+        rule = entry["rule"]
+        if any(existing.get("id") == rule["id"] for existing in rules):
+            return [
+                rule if existing.get("id") == rule["id"] else existing
+                for existing in rules
+            ]
+        return rules + [rule]
+    if op == "update":
+        return [
+            dict(rule, **entry["fields"]) if rule.get("id") == entry["id"] else rule
+            for rule in rules
+        ]
+    if op == "remove":
+        ids = set(entry["ids"])
+        return [rule for rule in rules if rule.get("id") not in ids]
+    raise ValueError(f"Unknown journal operation: {op}")
+
+
+# Check of a rules.json written by something other than this service, before
+# it replaces the rules in use. Returns the rules in canonical form (see
+# Rule.to_dict), or raises ValueError naming the first broken rule; rules
+# without an id are fine and get one on load.
+def validate_rules(rules):
+    if not isinstance(rules, list):
+        raise ValueError("rules.json must hold a JSON array of rules")
+    ids = set()
+    canonical = []
+    for position, data in enumerate(rules):
+        try:
+            rule = Rule.from_dict(data)
+        except ValueError as exc:
+            raise ValueError(f"rule {position + 1}: {exc}")
+        if rule.id is not None:
+            if rule.id in ids:
+                raise ValueError(f"rule {position + 1} repeats the id {rule.id}")
+            ids.add(rule.id)
+        canonical.append(rule.to_dict())
+    return canonical
+
+
+# Splits loaded rules into (valid rules in canonical form, invalid rules as
+# they are). One broken rule would fail every kernel transaction, so those are
+# logged and kept out of the kernel, but not dropped from rules.json.
+def split_rules(rules):
+    if not isinstance(rules, list):
+        raise ValueError("rules.json must hold a JSON array of rules")
+    usable = []
+    invalid = []
+    for data in rules:
+        try:
+            usable.append(Rule.from_dict(data).to_dict())
+        except ValueError as exc:
+            rule_id = data.get("id", data) if isinstance(data, dict) else data
+            print(f"✗ Rule kept out of the kernel (invalid): {rule_id}: {exc}")
+            invalid.append(data)
+    return usable, invalid
+
+
+def read_journal(path=None):
+    entries = []
+    try:
+        with open(journal_path(path), "r") as handle:
+            for line in handle:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # A torn final line from a crash mid-append
+                    break
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+@OPERATION_SECONDS.timed(operation="append_journal")
+def append_journal(entries, path=None):
+    lines = "".join(json.dumps(entry, separators=(",", ":")) + "\n" for entry in entries)
+    try:
+        with open(journal_path(path), "a") as handle:
+            handle.write(lines)
+            handle.flush()
+            os.fsync(handle.fileno())
+    except OSError as exc:
+        print(f"✗ ERROR appending to {journal_path(path)}: {exc}")
+        raise RuntimeError(f"Failed to save rules: {exc}")
 
 
 # Persistence functions
-def load_persisted_rules():
-    if os.path.exists(RULES_FILE):
-        with open(RULES_FILE, "r") as handle:
-            return json.load(handle)
-    return []
+@OPERATION_SECONDS.timed(operation="load_rules")
+def load_snapshot_and_journal(path=None):
+    path = path or RULES_FILE
+    rules = []
+    if os.path.exists(path):
+        with open(path, "r") as handle:
+            rules = json.load(handle)
+    entries = read_journal(path)
+    for entry in entries:
+        rules = apply_journal_entry(rules, entry)
+    return rules, len(entries)
 
 
-def save_persisted_rules(rules):
+def load_persisted_rules(path=None):
+    return load_snapshot_and_journal(path)[0]
+
+
+def _fsync_dir(directory):
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
     try:
-        with open(RULES_FILE, "w") as handle:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+# The snapshot is written to a temp file, fsynced and renamed into place, so a
+# crash leaves either the old or the new rules.json, never a truncated one.
+@OPERATION_SECONDS.timed(operation="save_rules")
+def save_persisted_rules(rules, path=None):
+    path = path or RULES_FILE
+    directory = os.path.dirname(os.path.abspath(path))
+    tmp_path = None
+    try:
+        with tempfile.NamedTemporaryFile(
+            "w", dir=directory, prefix=".rules-", suffix=".tmp", delete=False
+        ) as handle:
+            tmp_path = handle.name
             json.dump(rules, handle, indent=2)
-        print(f"✓ Rules saved successfully to {RULES_FILE}")
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(tmp_path, path)
+        tmp_path = None
+        _fsync_dir(directory)
+        # Everything in the journal is now part of the snapshot
+        if os.path.exists(journal_path(path)):
+            os.remove(journal_path(path))
+        print(f"✓ Rules saved successfully to {path}")
     except Exception as exc:
-        print(f"✗ ERROR saving rules to {RULES_FILE}: {exc}")
+        print(f"✗ ERROR saving rules to {path}: {exc}")
         raise RuntimeError(f"Failed to save rules: {exc}")
+    finally:
+        if tmp_path:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+
+# Where the startup restore is: "idle" until it starts, then "loading",
+# "checking" (rule by rule), "applying", and "done" or "failed"
+class RestoreProgress:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._state = {"state": "idle"}
 
+    def start(self):
+        with self.lock:
+            self._state = {"state": "loading", "started": time.time(), "finished": None}
 
-def restore_persistent_rules():
+    def update(self, **fields):
+        with self.lock:
+            self._state.update(fields)
+
+    def finish(self, state, **fields):
+        self.update(state=state, finished=time.time(), **fields)
+
+    def to_dict(self):
+        with self.lock:
+            return dict(self._state)
+
+
+restore_progress = RestoreProgress()
+
+
+# Rules are read through `store`, the RuleStore the service writes with, so
+# rules saved without an id get one first and those that do not validate stay
+# held there, out of the kernel. The restore runs in its transaction, so
+# changes made meanwhile wait for it and the kernel never ends up with an
+# older rules.json than the one being served. Reads go on throughout.
+@OPERATION_SECONDS.timed(operation="restore")
+def restore_persistent_rules(store, progress=restore_progress):
+    progress.start()
     print("Restoring persistent rules...")
-    rules = load_persisted_rules()
-    print(f"Found rules: {len(rules)}")
-    for rule in rules:
-        # Only restore active rules
-        if rule.get("enabled", True):  # Default is active for backward compatibility
-            try:
-                # First delete any existing rules to avoid duplicates
-                try:
-                    for proto in ("tcp", "udp"):
-                        # Delete NAT rule
-                        run(
-                            [
-                                "iptables",
-                                "-t",
-                                "nat",
-                                "-D",
-                                "PREROUTING",
-                                "-i",
-                                rule["extif"],
-                                "-p",
-                                proto,
-                                "--dport",
-                                rule["ext_port"],
-                                "-j",
-                                "DNAT",
-                                "--to-destination",
-                                f"{rule['int_ip']}:{rule['int_port']}",
-                            ]
-                        )
-                        # Delete Forward rule
-                        run(
-                            [
-                                "iptables",
-                                "-D",
-                                "FORWARD",
-                                "-i",
-                                rule["extif"],
-                                "-o",
-                                rule["intif"],
-                                "-p",
-                                proto,
-                                "--dport",
-                                rule["int_port"],
-                                "-d",
-                                rule["int_ip"],
-                                "-j",
-                                "ACCEPT",
-                            ]
-                        )
-                except RuntimeError:
-                    # Ignore if the rules do not exist
-                    pass
-
-                # Then add new rules
-                apply_rule(rule)
+    with store.transaction():
+        valid = store.rules()
+        invalid = len(store.invalid_rules())
+        total = len(valid) + invalid
+        print(f"Found rules: {total}")
+        progress.update(state="checking", rules=total, checked=0, invalid=invalid)
+        for position, rule in enumerate(valid, 1):
+            # Only restore active rules
+            if not rule["enabled"]:
                 print(
-                    "Rule restored: "
+                    "Rule skipped (disabled): "
                     f"{rule['extif']}:{rule['ext_port']} → "
                     f"{rule['int_ip']}:{rule['int_port']}"
                 )
-            except RuntimeError as exc:
-                print(f"Error restoring rule: {str(exc)}")
-        else:
-            print(
-                "Rule skipped (disabled): "
-                f"{rule['extif']}:{rule['ext_port']} → "
-                f"{rule['int_ip']}:{rule['int_port']}"
-            )
+            if position % 1000 == 0:
+                progress.update(checked=invalid + position)
+        progress.update(checked=total)
+
+        # Converge the kernel to rules.json with one read and one write
+        progress.update(state="applying")
+        try:
+            additions, deletions = reconcile(valid)
+        except RuntimeError as exc:
+            print(f"Error restoring rules: {str(exc)}")
+            progress.finish("failed", error=str(exc))
+            return
+    print(
+        f"Rules restored: {len(additions)} iptables entries added, "
+        f"{len(deletions)} stale entries removed."
+    )
+    progress.finish("done", added=len(additions), removed=len(deletions))
@@ -0,0 +1,99 @@
+"""Port specs: a single port ("443"), a range ("27000-29000") or a list ("80,443")."""
+
+# iptables' multiport match takes at most 15 ports, a range counting as two
+MULTIPORT_LIMIT = 15
+
+
+# Parse a port spec into sorted (low, high) spans; raises ValueError
+def parse_ports(value):
+    spans = []
+    for part in str(value).replace(" ", "").split(","):
+        low, sep, high = part.partition("-")
+        try:
+            low = int(low)
+            high = int(high) if sep else low
+        except ValueError:
+            raise ValueError(f"invalid port spec: {value}")
+        if not 1 <= low <= high <= 65535:
+            raise ValueError(f"ports must be between 1 and 65535 and ranges ascending: {value}")
+        spans.append((low, high))
+    spans.sort()
+    for (_, previous_high), (low, _) in zip(spans, spans[1:]):
+        if low <= previous_high:
+            raise ValueError(f"port list overlaps itself: {value}")
+    if len(spans) > 1 and sum(1 if low == high else 2 for low, high in spans) > MULTIPORT_LIMIT:
+        raise ValueError(f"a port list may hold at most {MULTIPORT_LIMIT} ports: {value}")
+    return spans
+
+
+def format_ports(spans):
+    return ",".join(str(low) if low == high else f"{low}-{high}" for low, high in spans)
+
+
+# Canonical form stored in rules.json
+def normalize_ports(value):
+    return format_ports(parse_ports(value))
+
+
+def is_single_port(value):
+    spans = parse_ports(value)
+    return len(spans) == 1 and spans[0][0] == spans[0][1]
+
+
+def first_port(value):
+    try:
+        return parse_ports(value)[0][0]
+    except ValueError:
+        return -1
+
+
+def contains(spans, port):
+    return any(low <= port <= high for low, high in spans)
+
+
+def overlaps(spans, other):
+    return any(
+        low <= other_high and other_low <= high
+        for low, high in spans
+        for other_low, other_high in other
+    )
+
+
+# The target port is either one port every external port is sent to, or the
+# external spec itself, in which case each connection keeps its port
+def check_target(ext_port, int_port):
+    if not is_single_port(int_port) and parse_ports(int_port) != parse_ports(ext_port):
+        raise ValueError("int_port must be a single port or the same ports as ext_port")
+
+
+# Load-balanced backends must all map ports the same way, since one lookup
+# hands out their targets
+def check_targets(ext_port, int_ports):
+    for int_port in int_ports:
+        check_target(ext_port, int_port)
+    if len({is_single_port(int_port) for int_port in int_ports}) > 1:
+        raise ValueError("backends must all use a single port or all keep the external ports")
+
+
+# Destination port match in the form `iptables-save` prints it
+def iptables_match(proto, value):
+    spans = parse_ports(value)
+    if len(spans) == 1:
+        low, high = spans[0]
+        return f"-m {proto} --dport {low if low == high else f'{low}:{high}'}"
+    ports = ",".join(str(low) if low == high else f"{low}:{high}" for low, high in spans)
+    return f"-m multiport --dports {ports}"
+
+
+# DNAT target: a port list cannot be written as a target, so those keep the
+# original port by leaving it out
+def dnat_target(int_ip, int_port):
+    spans = parse_ports(int_port)
+    if len(spans) > 1:
+        return int_ip
+    return f"{int_ip}:{format_ports(spans)}"
+
+
+# One nftables element per span, as an interval where needed
+def nft_elements(value):
+    return [str(low) if low == high else f"{low}-{high}" for low, high in parse_ports(value)]
@@ -0,0 +1,61 @@
+"""Converge the live iptables state to the persisted rules in one pass."""
+from app.services import iptables
+
+
+# Return (additions, deletions, new_chains, removed_chains) needed to make the
+# kernel match `rules`. Everything inside the owned chains is ours, so any
+# spec there that is not desired is removed; outside them only the legacy
+# built-in chain specs of persisted rules are ever touched.
+def plan_changes(rules, snapshot):
+    desired = iptables.desired_specs(rules)
+    desired_set = set(desired)
+    live = iptables.spec_counts(snapshot)
+
+    additions = [spec for spec in desired if not live.get(spec)]
+
+    deletions = []
+    kept = set()
+    for table_name, table in snapshot.items():
+        for entry in table["rules"]:
+            spec = (table_name, entry["spec"])
+            if not iptables.spec_owned_chains(spec):
+                continue
+            # Stale rules are removed entirely, duplicates down to a single copy
+            if spec in desired_set and spec not in kept:
+                kept.add(spec)
+            else:
+                deletions.append(spec)
+
+    legacy_seen = set()
+    for rule in rules:
+        for spec in iptables.legacy_specs(rule):
+            if spec not in legacy_seen:
+                legacy_seen.add(spec)
+                deletions.extend([spec] * live.get(spec, 0))
+
+    chains = iptables.live_chains(snapshot)
+    new_chains = iptables.missing_chains(additions, set(chains))
+    needed = {chain for spec in desired for chain in iptables.spec_owned_chains(spec)}
+    removed_chains = sorted(
+        chain
+        for chain in chains
+        if iptables.is_owned_chain(chain[1]) and chain not in needed
+    )
+    return additions, deletions, new_chains, removed_chains
+
+
+def reconcile(rules):
+    rules = list(rules)
+    if any(rule.get("enabled", True) for rule in rules):
+        # Enable IP forwarding
+        iptables.run(["sysctl", "-w", "net.ipv4.ip_forward=1"])
+
+    additions, deletions, new_chains, removed_chains = plan_changes(
+        rules, iptables.read_snapshot()
+    )
+    payload = iptables.build_restore_payload(
+        additions, deletions, new_chains=new_chains, removed_chains=removed_chains
+    )
+    if payload:
+        iptables.run(["iptables-restore", "--noflush"], input=payload)
+    return additions, deletions
@@ -0,0 +1,433 @@
+"""Userspace TCP/UDP relay for hosts where the kernel NAT cannot be changed."""
+import asyncio
+import collections
+import os
+import random
+import socket
+import threading
+import time
+
+from app.config import (
+    RELAY_BIND,
+    RELAY_IDLE_TIMEOUT,
+    RELAY_MAX_CONNECTIONS,
+    RELAY_MAX_PORTS,
+    RELAY_UDP_TIMEOUT,
+)
+from app.services import ports
+from app.services.interfaces import read_interface
+from app.services.iptables import active_backends, rule_protocols
+
+CHUNK = 65536
+# Copy buffers kept for reuse by the next connection
+FREE_BUFFERS = 256
+# splice() moves TCP payload between the sockets through a pipe inside the
+# kernel; without it data is copied through a reused userspace buffer
+SPLICE = hasattr(os, "splice")
+SPLICE_FLAGS = getattr(os, "SPLICE_F_MOVE", 0) | getattr(os, "SPLICE_F_NONBLOCK", 0)
+LISTEN_BACKLOG = 1024
+
+
+class IdleTimeout(Exception):
+    pass
+
+
+# The listening sockets the enabled rules need, as {(proto, address, port):
+# rule id}. `addresses(extif)` names the local addresses of an interface.
+# Every port of a range or list gets its own listener; rules with more than
+# RELAY_MAX_PORTS ports, saved before the cap or under another backend, are
+# skipped rather than opening thousands of sockets.
+def relay_listeners(rules, addresses):
+    listeners = {}
+    for rule in rules:
+        if not rule.get("enabled", True):
+            continue
+        spans = ports.parse_ports(rule["ext_port"])
+        count = sum(high - low + 1 for low, high in spans)
+        if count > RELAY_MAX_PORTS:
+            print(
+                f"✗ Rule skipped by the relay: {rule['id']} listens on {count} ports, "
+                f"more than RELAY_MAX_PORTS ({RELAY_MAX_PORTS})"
+            )
+            continue
+        for proto in rule_protocols(rule):
+            for address in addresses(rule["extif"]):
+                for low, high in spans:
+                    for port in range(low, high + 1):
+                        listeners.setdefault((proto, address, port), rule["id"])
+    return listeners
+
+
+# New connections pick a backend in rotation at random, by weight
+def pick_backend(rule):
+    backends = active_backends(rule)
+    return random.choices(backends, [backend.get("weight", 1) for backend in backends])[0]
+
+
+# Port-preserving targets get the port the client connected to
+def target_port(backend, port):
+    if ports.is_single_port(backend["int_port"]):
+        return ports.first_port(backend["int_port"])
+    return port
+
+
+def describe(key):
+    proto, address, port = key
+    return f"{proto} {address}:{port}"
+
+
+class _Listener:
+    def __init__(self, key, rule_id):
+        self.key = key
+        self.rule_id = rule_id
+        self.sock = None
+        self.task = None
+        self.transport = None
+        self.sessions = {}
+
+    @property
+    def port(self):
+        return self.key[2]
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        if self.sock is not None:
+            self.sock.close()
+        if self.transport is not None:
+            self.transport.close()
+        for session in list(self.sessions.values()):
+            session.close()
+
+
+class _UdpSession:
+    def __init__(self, relay, listener, client, rule_id, sock):
+        self.relay = relay
+        self.listener = listener
+        self.client = client
+        self.rule_id = rule_id
+        self.sock = sock
+        self.last = time.monotonic()
+
+    # Replies from the backend go back out of the listening socket
+    def readable(self):
+        buffer = self.relay._datagram
+        while True:
+            try:
+                count = self.sock.recv_into(buffer)
+            except BlockingIOError:
+                return
+            except OSError:
+                # ICMP unreachable from the backend; the session expires
+                return
+            self.last = time.monotonic()
+            self.listener.transport.sendto(memoryview(buffer)[:count], self.client)
+
+    def close(self):
+        if self.listener.sessions.pop(self.client, None) is None:
+            return
+        self.relay.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+        self.relay._active[self.rule_id] -= 1
+
+
+class _UdpProtocol(asyncio.DatagramProtocol):
+    def __init__(self, relay, listener):
+        self.relay = relay
+        self.listener = listener
+
+    def datagram_received(self, data, addr):
+        self.relay._udp_received(self.listener, data, addr)
+
+
+# Forwards the enabled rules in userspace on an asyncio loop in its own
+# thread. reconcile() is the backend entry point and runs on the caller's
+# thread: it opens the listeners that are missing before closing the ones no
+# longer wanted, so a failed bind leaves everything as it was. Changing a
+# rule's targets needs no rebind, since each new connection looks its rule up.
+class Relay:
+    def __init__(self, bind=None, idle_timeout=None, udp_timeout=None, max_connections=None):
+        self.bind = tuple(bind or RELAY_BIND)
+        self.idle_timeout = idle_timeout or RELAY_IDLE_TIMEOUT
+        self.udp_timeout = udp_timeout or RELAY_UDP_TIMEOUT
+        self.max_connections = max_connections or RELAY_MAX_CONNECTIONS
+        self.lock = threading.Lock()
+        self.loop = None
+        self._thread = None
+        self._sweeper = None
+        self._rules = {}
+        self._listeners = {}
+        self._active = collections.Counter()
+        self._buffers = []
+        self._datagram = bytearray(CHUNK)
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self.loop is None:
+            return
+        self._call(self._close_all())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+        self.loop = None
+
+    def _call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    # Returns (added, removed) listeners, described as "tcp 10.0.0.1:443"
+    def reconcile(self, rules):
+        self.start()
+        with self.lock:
+            return self._call(self._reconcile(list(rules)))
+
+    def connections(self, rule_id):
+        return self._active[rule_id]
+
+    def _addresses(self, extif):
+        if self.bind:
+            return self.bind
+        addresses = read_interface(extif)["ipv4"]
+        if not addresses:
+            raise RuntimeError(f"{extif} has no IPv4 address to listen on")
+        return addresses
+
+    async def _reconcile(self, rules):
+        enabled = {rule["id"]: rule for rule in rules if rule.get("enabled", True)}
+        addresses = {}
+
+        def lookup(extif):
+            if extif not in addresses:
+                addresses[extif] = self._addresses(extif)
+            return addresses[extif]
+
+        wanted = relay_listeners(enabled.values(), lookup)
+        added = []
+        try:
+            for key, rule_id in wanted.items():
+                if key not in self._listeners:
+                    added.append(await self._open(key, rule_id))
+        except OSError as exc:
+            for listener in added:
+                listener.close()
+            raise RuntimeError(f"Cannot listen on {describe(key)}: {exc}")
+        removed = [key for key in self._listeners if key not in wanted]
+        for key in removed:
+            self._listeners.pop(key).close()
+        for key, listener in self._listeners.items():
+            listener.rule_id = wanted[key]
+        for listener in added:
+            self._listeners[listener.key] = listener
+        self._rules = enabled
+        if self._sweeper is None:
+            self._sweeper = asyncio.get_running_loop().create_task(self._sweep())
+        return [describe(listener.key) for listener in added], [describe(key) for key in removed]
+
+    async def _close_all(self):
+        for listener in self._listeners.values():
+            listener.close()
+        self._listeners = {}
+        self._rules = {}
+        self._sweeper = None
+        # Open connections end with the relay
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _open(self, key, rule_id):
+        proto, address, port = key
+        listener = _Listener(key, rule_id)
+        loop = asyncio.get_running_loop()
+        if proto == "udp":
+            listener.transport, _ = await loop.create_datagram_endpoint(
+                lambda: _UdpProtocol(self, listener), local_addr=(address, port)
+            )
+            return listener
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((address, port))
+            sock.listen(LISTEN_BACKLOG)
+            sock.setblocking(False)
+        except OSError:
+            sock.close()
+            raise
+        listener.sock = sock
+        listener.task = loop.create_task(self._accept(listener))
+        return listener
+
+    def _limit(self, rule):
+        return rule.get("max_connections") or self.max_connections
+
+    async def _accept(self, listener):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                client, _ = await loop.sock_accept(listener.sock)
+            except OSError as exc:
+                # Out of file descriptors and the like; back off briefly
+                print(f"✗ ERROR accepting on {describe(listener.key)}: {exc}")
+                await asyncio.sleep(0.1)
+                continue
+            rule = self._rules.get(listener.rule_id)
+            if rule is None or self._active[rule["id"]] >= self._limit(rule):
+                client.close()
+                continue
+            self._active[rule["id"]] += 1
+            loop.create_task(self._relay_tcp(client, rule, listener.port))
+
+    async def _relay_tcp(self, client, rule, port):
+        loop = asyncio.get_running_loop()
+        backend = pick_backend(rule)
+        upstream = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        upstream.setblocking(False)
+        client.setblocking(False)
+        pumps = []
+        try:
+            await asyncio.wait_for(
+                loop.sock_connect(upstream, (backend["int_ip"], target_port(backend, port))),
+                self.idle_timeout,
+            )
+            for sock in (client, upstream):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            activity = [time.monotonic()]
+            pumps = [
+                loop.create_task(self._pump(client, upstream, activity)),
+                loop.create_task(self._pump(upstream, client, activity)),
+            ]
+            # Either side failing or going idle ends the connection; a clean
+            # close of one side only half-closes it
+            await asyncio.wait(pumps, return_when=asyncio.FIRST_EXCEPTION)
+        except (OSError, asyncio.TimeoutError):
+            pass
+        finally:
+            for pump in pumps:
+                pump.cancel()
+            await asyncio.gather(*pumps, return_exceptions=True)
+            client.close()
+            upstream.close()
+            self._active[rule["id"]] -= 1
+
+    async def _pump(self, src, dst, activity):
+        if SPLICE:
+            await self._splice(src, dst, activity)
+        else:
+            await self._copy(src, dst, activity)
+        try:
+            dst.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+    # Wait until the socket is ready, giving up once neither direction of
+    # the connection has moved data for the idle timeout
+    async def _ready(self, sock, activity, writable=False):
+        loop = asyncio.get_running_loop()
+        add, remove = (
+            (loop.add_writer, loop.remove_writer)
+            if writable
+            else (loop.add_reader, loop.remove_reader)
+        )
+        while True:
+            remaining = activity[0] + self.idle_timeout - time.monotonic()
+            if remaining <= 0:
+                raise IdleTimeout()
+            ready = loop.create_future()
+            add(sock.fileno(), lambda: ready.done() or ready.set_result(None))
+            try:
+                await asyncio.wait_for(ready, remaining)
+                return
+            except asyncio.TimeoutError:
+                continue
+            finally:
+                remove(sock.fileno())
+
+    async def _splice(self, src, dst, activity):
+        read_end, write_end = os.pipe()
+        try:
+            while True:
+                try:
+                    count = os.splice(src.fileno(), write_end, CHUNK, flags=SPLICE_FLAGS)
+                except BlockingIOError:
+                    await self._ready(src, activity)
+                    continue
+                if not count:
+                    return
+                activity[0] = time.monotonic()
+                while count:
+                    try:
+                        count -= os.splice(read_end, dst.fileno(), count, flags=SPLICE_FLAGS)
+                    except BlockingIOError:
+                        await self._ready(dst, activity, writable=True)
+        finally:
+            os.close(read_end)
+            os.close(write_end)
+
+    async def _copy(self, src, dst, activity):
+        loop = asyncio.get_running_loop()
+        buffer = self._buffers.pop() if self._buffers else bytearray(CHUNK)
+        view = memoryview(buffer)
+        try:
+            while True:
+                try:
+                    count = src.recv_into(buffer)
+                except BlockingIOError:
+                    await self._ready(src, activity)
+                    continue
+                if not count:
+                    return
+                activity[0] = time.monotonic()
+                await loop.sock_sendall(dst, view[:count])
+        finally:
+            view.release()
+            if len(self._buffers) < FREE_BUFFERS:
+                self._buffers.append(buffer)
+
+    # Each client address gets its own connected socket to a backend, so
+    # replies find their way back without a lookup
+    def _udp_received(self, listener, data, client):
+        session = listener.sessions.get(client)
+        if session is None:
+            rule = self._rules.get(listener.rule_id)
+            if rule is None or self._active[rule["id"]] >= self._limit(rule):
+                return
+            backend = pick_backend(rule)
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            try:
+                sock.connect((backend["int_ip"], target_port(backend, listener.port)))
+            except OSError:
+                sock.close()
+                return
+            session = _UdpSession(self, listener, client, rule["id"], sock)
+            listener.sessions[client] = session
+            self._active[rule["id"]] += 1
+            self.loop.add_reader(sock.fileno(), session.readable)
+        session.last = time.monotonic()
+        try:
+            session.sock.send(data)
+        except OSError:
+            # Full socket buffer or an unreachable backend: drop, like UDP does
+            pass
+
+    async def _sweep(self):
+        interval = min(max(self.udp_timeout / 4, 0.05), 5)
+        while True:
+            await asyncio.sleep(interval)
+            expired = time.monotonic() - self.udp_timeout
+            for listener in list(self._listeners.values()):
+                for session in list(listener.sessions.values()):
+                    if session.last < expired:
+                        session.close()
+
+
+userspace_relay = Relay()
+
+
+def reconcile(rules):
+    return userspace_relay.reconcile(rules)
@@ -0,0 +1,202 @@
+"""Pick up edits to rules.json made outside the service and apply them."""
+import collections
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+
+from app.config import RELOAD_INTERVAL
+from app.services import persistence
+from app.services.changes import change_queue
+from app.services.metrics import RULE_RELOADS
+from app.services.store import rule_store
+
+# inotify(7) events of a file written in place or renamed over
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+# struct inotify_event without the name that follows it
+EVENT = struct.Struct("iIII")
+# How long a burst of writes may take before the file is read
+SETTLE_SECONDS = 0.05
+MAX_EVENTS = 100
+
+
+# Watch on one directory through the libc inotify calls, since a file that is
+# renamed over loses any watch placed on the file itself
+class Inotify:
+    def __init__(self, fd):
+        self.fd = fd
+
+    @classmethod
+    def open(cls, directory):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        if libc.inotify_add_watch(fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            os.close(fd)
+            return None
+        return cls(fd)
+
+    # Names of the files changed, waiting at most `timeout` seconds for one
+    def read(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        names = []
+        offset = 0
+        while offset + EVENT.size <= len(data):
+            _, _, _, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            names.append(os.fsdecode(data[offset:offset + length].rstrip(b"\0")))
+            offset += length
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+# Rule ids (added, removed, changed) from one list of rules to the next
+def diff_rules(previous, current):
+    before = {rule["id"]: rule for rule in previous}
+    after = {rule["id"]: rule for rule in current}
+    added = [rule_id for rule_id in after if rule_id not in before]
+    removed = [rule_id for rule_id in before if rule_id not in after]
+    changed = [
+        rule_id for rule_id in after if rule_id in before and after[rule_id] != before[rule_id]
+    ]
+    return added, removed, changed
+
+
+# Watches the data directory and, when rules.json or its journal is replaced
+# by someone else, lets the store load and validate it, then converges the
+# kernel through the change queue. The reconciler only writes what differs
+# from the live ruleset, so a large push is one small kernel transaction and
+# the web UI keeps serving throughout. Our own writes leave the store's view
+# of the file current and are skipped without reading it.
+class RulesWatcher:
+    def __init__(self, store, queue, path=None, interval=None):
+        self.store = store
+        self.queue = queue
+        self.path = path
+        self.interval = RELOAD_INTERVAL if interval is None else interval
+        self.lock = threading.Lock()
+        self.events = collections.deque(maxlen=MAX_EVENTS)
+        self.mode = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def _file_path(self):
+        return self.path or self.store.path or persistence.RULES_FILE
+
+    # Returns the recorded event, or None when nothing changed
+    def check(self):
+        change = self.store.external_change()
+        if change is None:
+            return None
+        added, removed, changed = diff_rules(*change)
+        if not (added or removed or changed):
+            return None
+        return self._record(added, removed, changed)
+
+    def _record(self, added, removed, changed):
+        RULE_RELOADS.inc(result="applied")
+        event = {
+            "time": time.time(),
+            "added": added,
+            "removed": removed,
+            "changed": changed,
+            "job": None,
+            "applied": None,
+        }
+        print(
+            f"✓ rules.json changed on disk ({len(added)} added, {len(removed)} removed, "
+            f"{len(changed)} changed), applying..."
+        )
+
+        def report(change):
+            event["applied"] = change.persisted and not change.error
+            if event["applied"]:
+                print("✓ Reloaded rules applied.")
+            else:
+                print(f"✗ ERROR applying reloaded rules: {change.error}")
+
+        with self.lock:
+            self.events.append(event)
+        # An empty change converges the kernel to the rules now in the store
+        event["job"] = self.queue.submit([], on_done=report).id
+        return event
+
+    def status(self):
+        with self.lock:
+            return {
+                "mode": self.mode,
+                "error": self.store.reload_error,
+                "invalid": len(self.store.invalid_rules()),
+                "events": list(self.events),
+            }
+
+    def _check(self):
+        try:
+            self.check()
+        except Exception as exc:
+            print(f"✗ ERROR reloading rules: {exc}")
+
+    def _watch(self, inotify):
+        path = self._file_path()
+        names = {os.path.basename(path), os.path.basename(persistence.journal_path(path))}
+        try:
+            while not self._stop.is_set():
+                if not names.intersection(inotify.read(1)):
+                    continue
+                # Wait for the rest of the burst, so it is read once
+                deadline = time.monotonic() + 1
+                while inotify.read(SETTLE_SECONDS) and time.monotonic() < deadline:
+                    pass
+                self._check()
+        finally:
+            inotify.close()
+
+    def _poll(self):
+        while not self._stop.is_set():
+            self._check()
+            self._stop.wait(self.interval)
+
+    def start(self):
+        if not self.interval or (self._thread and self._thread.is_alive()):
+            return
+        # Pick up what the store has not seen yet and take the current file
+        # as the starting point
+        self.store.external_change()
+        self._stop.clear()
+        directory = os.path.dirname(os.path.abspath(self._file_path()))
+        inotify = Inotify.open(directory)
+        if inotify is None:
+            print(
+                f"✗ WARNING: inotify unavailable, checking rules.json every "
+                f"{self.interval:g}s"
+            )
+            self.mode = "polling"
+            self._thread = threading.Thread(target=self._poll, daemon=True)
+        else:
+            self.mode = "inotify"
+            self._thread = threading.Thread(target=self._watch, args=(inotify,), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+rules_watcher = RulesWatcher(rule_store, change_queue)
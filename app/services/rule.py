@@ -0,0 +1,301 @@
+"""Typed, validated form of a forward as stored in rules.json."""
+import ipaddress
+import re
+
+from app import config
+from app.services import ports
+
+# Canonical identity of a forward; the protocol is deliberately not part of it
+KEY_FIELDS = ("extif", "intif", "ext_port", "int_ip", "int_port")
+PROTOCOLS = ("both", "tcp", "udp")
+# Probe types the health checker knows
+HEALTH_CHECKS = ("tcp", "http", "udp")
+MAX_BACKENDS = 32
+MAX_WEIGHT = 100
+MAX_CONNECTIONS = 1000000
+MAX_NAME = 64
+MAX_PROBE_FIELD = 256
+# Interface names as the kernel allows them (IFNAMSIZ less the NUL) and in a
+# charset that cannot break out of the iptables-restore and nft scripts
+INTERFACE_RE = re.compile(r"[A-Za-z0-9_.+-]{1,15}")
+
+
+def _ports(value, field):
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(
+            f"{field} must be a port, a range like 27000-29000 or a list like 80,443"
+        )
+    try:
+        return tuple(ports.parse_ports(value))
+    except ValueError as exc:
+        raise ValueError(f"{field}: {exc}")
+
+
+def _ipv4(value, field):
+    if not isinstance(value, str):
+        raise ValueError(f"{field} must be an IPv4 address")
+    try:
+        return ipaddress.IPv4Address(value)
+    except ValueError:
+        raise ValueError(f"{field} must be an IPv4 address")
+
+
+def _bounded_int(value, field, low, high):
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise ValueError(f"{field} must be an integer")
+    if not low <= value <= high:
+        raise ValueError(f"{field} must be between {low} and {high}")
+    return value
+
+
+def _health_check(value):
+    if not isinstance(value, dict) or value.get("type", "tcp") not in HEALTH_CHECKS:
+        raise ValueError(
+            f"health_check must be an object with a type of {', '.join(HEALTH_CHECKS)}"
+        )
+    check = {"type": value.get("type", "tcp")}
+    for field in ("path", "payload"):
+        if value.get(field) is not None:
+            if not isinstance(value[field], str) or len(value[field]) > MAX_PROBE_FIELD:
+                raise ValueError(
+                    f"health_check {field} must be a string of at most "
+                    f"{MAX_PROBE_FIELD} characters"
+                )
+            check[field] = value[field]
+    if "path" in check and not check["path"].startswith("/"):
+        raise ValueError("health_check path must start with /")
+    return check
+
+
+# One target of a forward: an address, its port spans and a weight
+class Backend:
+    __slots__ = ("ip", "port", "weight")
+
+    def __init__(self, ip, port, weight=1):
+        self.ip = ip
+        self.port = port
+        self.weight = weight
+
+    @classmethod
+    def from_dict(cls, data):
+        if not isinstance(data, dict) or data.get("int_ip") in (None, ""):
+            raise ValueError(
+                'each backend must be {"int_ip": ..., "int_port": ..., "weight": ...}'
+            )
+        return cls(
+            _ipv4(data["int_ip"], "int_ip"),
+            _ports(data.get("int_port"), "int_port"),
+            _bounded_int(data.get("weight", 1), "weight", 1, MAX_WEIGHT),
+        )
+
+    def to_dict(self):
+        return {
+            "int_ip": str(self.ip),
+            "int_port": ports.format_ports(self.port),
+            "weight": self.weight,
+        }
+
+    def __eq__(self, other):
+        if not isinstance(other, Backend):
+            return NotImplemented
+        return (self.ip, self.port, self.weight) == (other.ip, other.port, other.weight)
+
+    def __hash__(self):
+        return hash((self.ip, self.port, self.weight))
+
+
+# A forward with its addresses and ports parsed. Rules are built from the dict
+# form kept in rules.json and turned back into it with to_dict(), which is
+# also the canonical form: ports as "80", "27000-29000" or "80,443", the
+# protocol and enabled flag always present. from_dict() raises ValueError
+# with a message fit for the user on anything the kernel would reject.
+class Rule:
+    __slots__ = (
+        "id",
+        "name",
+        "extif",
+        "intif",
+        "ext_port",
+        "backends",
+        "protocol",
+        "enabled",
+        "health_check",
+        "max_connections",
+        "down",
+    )
+
+    def __init__(
+        self,
+        extif,
+        intif,
+        ext_port,
+        backends,
+        protocol="both",
+        enabled=True,
+        id=None,
+        name=None,
+        health_check=None,
+        max_connections=None,
+        down=(),
+    ):
+        self.id = id
+        self.name = name
+        self.extif = extif
+        self.intif = intif
+        self.ext_port = ext_port
+        self.backends = tuple(backends)
+        self.protocol = protocol
+        self.enabled = enabled
+        self.health_check = health_check
+        self.max_connections = max_connections
+        self.down = tuple(down)
+
+    @classmethod
+    def from_dict(cls, data):
+        if not isinstance(data, dict):
+            raise ValueError("rule must be a JSON object")
+        backends = None
+        if data.get("backends") is not None:
+            if not isinstance(data["backends"], list) or not (
+                1 <= len(data["backends"]) <= MAX_BACKENDS
+            ):
+                raise ValueError(f"backends must be a list of 1 to {MAX_BACKENDS} targets")
+            backends = [Backend.from_dict(backend) for backend in data["backends"]]
+            if len({(backend.ip, backend.port) for backend in backends}) < len(backends):
+                raise ValueError("backends must be distinct")
+        # With backends, int_ip/int_port are the first of them
+        required = KEY_FIELDS[:3] if backends else KEY_FIELDS
+        missing = [field for field in required if data.get(field) in (None, "")]
+        if missing:
+            raise ValueError(f"missing fields: {', '.join(missing)}")
+        for field in ("extif", "intif"):
+            if not isinstance(data[field], str) or not INTERFACE_RE.fullmatch(data[field]):
+                raise ValueError(
+                    f"{field} must be an interface name of at most 15 letters, digits "
+                    "or _ . + -"
+                )
+        int_ip = None if backends else _ipv4(data["int_ip"], "int_ip")
+        protocol = data.get("protocol", "both")
+        if protocol not in PROTOCOLS:
+            raise ValueError(f"protocol must be one of {', '.join(PROTOCOLS)}")
+        enabled = data.get("enabled", True)
+        if not isinstance(enabled, bool):
+            raise ValueError("enabled must be a boolean")
+
+        ext_port = _ports(data["ext_port"], "ext_port")
+        if backends is None:
+            backends = [Backend(int_ip, _ports(data["int_port"], "int_port"))]
+        ports.check_targets(
+            ports.format_ports(ext_port),
+            [ports.format_ports(backend.port) for backend in backends],
+        )
+
+        rule_id = data.get("id")
+        if rule_id is not None and not isinstance(rule_id, str):
+            raise ValueError("id must be a string")
+        name = data.get("name")
+        if name is not None:
+            if not isinstance(name, str) or len(name) > MAX_NAME:
+                raise ValueError(f"name must be a string of at most {MAX_NAME} characters")
+            name = name.strip() or None
+        health_check = None
+        if data.get("health_check") is not None:
+            health_check = _health_check(data["health_check"])
+        max_connections = data.get("max_connections")
+        if max_connections is not None:
+            _bounded_int(max_connections, "max_connections", 1, MAX_CONNECTIONS)
+        down = data.get("down") or []
+        if not isinstance(down, list) or not all(isinstance(item, str) for item in down):
+            raise ValueError("down must be a list of backends")
+        # Health state only ever names backends the rule still has
+        targets = {f"{backend.ip}:{ports.format_ports(backend.port)}" for backend in backends}
+        return cls(
+            data["extif"],
+            data["intif"],
+            ext_port,
+            backends,
+            protocol=protocol,
+            enabled=enabled,
+            id=rule_id,
+            name=name,
+            health_check=health_check,
+            max_connections=max_connections,
+            down=[item for item in down if item in targets],
+        )
+
+    @property
+    def int_ip(self):
+        return self.backends[0].ip
+
+    @property
+    def int_port(self):
+        return self.backends[0].port
+
+    @property
+    def protocols(self):
+        return ("tcp", "udp") if self.protocol == "both" else (self.protocol,)
+
+    def to_dict(self):
+        first = self.backends[0].to_dict()
+        rule = {} if self.id is None else {"id": self.id}
+        rule.update(
+            extif=self.extif,
+            intif=self.intif,
+            ext_port=ports.format_ports(self.ext_port),
+            int_ip=first["int_ip"],
+            int_port=first["int_port"],
+            protocol=self.protocol,
+            enabled=self.enabled,
+        )
+        if len(self.backends) > 1:
+            rule["backends"] = [backend.to_dict() for backend in self.backends]
+        if self.health_check is not None:
+            rule["health_check"] = dict(self.health_check)
+        if self.max_connections is not None:
+            rule["max_connections"] = self.max_connections
+        if self.name:
+            rule["name"] = self.name
+        if self.down:
+            rule["down"] = list(self.down)
+        return rule
+
+    # The relay backend opens a listener for every port, so it takes at most
+    # RELAY_MAX_PORTS per forward. Checked when a rule is created or edited; a
+    # wider rule already in rules.json is left alone and skipped by the relay.
+    def check_relay_ports(self):
+        if config.FIREWALL_BACKEND != "relay":
+            return
+        count = sum(high - low + 1 for low, high in self.ext_port)
+        if count > config.RELAY_MAX_PORTS:
+            raise ValueError(
+                f"ext_port: the relay backend listens on every port separately and "
+                f"takes at most {config.RELAY_MAX_PORTS} per forward, not {count}"
+            )
+
+    # Same tuple as store.rule_key() of the canonical dict
+    def key(self):
+        return (
+            self.extif,
+            self.intif,
+            ports.format_ports(self.ext_port),
+            str(self.int_ip),
+            ports.format_ports(self.int_port),
+        )
+
+    def _values(self):
+        return tuple(
+            tuple(value.items()) if isinstance(value, dict) else value
+            for value in (getattr(self, slot) for slot in self.__slots__)
+        )
+
+    def __eq__(self, other):
+        if not isinstance(other, Rule):
+            return NotImplemented
+        return self._values() == other._values()
+
+    # Equal rules share a key, so hashing the key keeps them in one bucket
+    def __hash__(self):
+        return hash(self.key())
+
+    def __repr__(self):
+        return f"Rule({self.extif}:{ports.format_ports(self.ext_port)} → {self.int_ip})"
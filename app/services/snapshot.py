@@ -0,0 +1,63 @@
+"""Parser for `iptables-save` output."""
+import re
+
+COUNTERS_RE = re.compile(r"^\[(\d+):(\d+)\]\s+")
+# Every kernel rule this tool emits is tagged with the fingerprint of the
+# persisted rule it came from, using only characters iptables-save does not
+# quote, so the tag reads back exactly as written.
+TAG_PREFIX = "erpf-"
+TAG_RE = re.compile(r"-m comment --comment " + TAG_PREFIX + r"([0-9a-f]+)(?: |$)")
+
+
+def spec_fingerprint(spec):
+    match = TAG_RE.search(spec)
+    return match.group(1) if match else None
+
+
+# A snapshot maps table name -> {"chains": {chain: policy}, "rules": [...]},
+# where each rule is {"chain", "spec", "counters", "fingerprint"} and spec is
+# the `-A` line exactly as iptables-save printed it (without the optional
+# counters). Untagged rules have no fingerprint.
+def parse_save(text):
+    tables = {}
+    table = None
+    for raw_line in text.splitlines():
+        line = raw_line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if line.startswith("*"):
+            table = tables.setdefault(line[1:], {"chains": {}, "rules": []})
+        elif line == "COMMIT":
+            table = None
+        elif table is None:
+            continue
+        elif line.startswith(":"):
+            name, _, rest = line[1:].partition(" ")
+            table["chains"][name] = rest.split(" ", 1)[0] if rest else "-"
+        else:
+            counters = None
+            match = COUNTERS_RE.match(line)
+            if match:
+                counters = (int(match.group(1)), int(match.group(2)))
+                line = line[match.end():]
+            if line.startswith("-A "):
+                chain = line.split(" ", 2)[1]
+                table["rules"].append(
+                    {
+                        "chain": chain,
+                        "spec": line,
+                        "counters": counters,
+                        "fingerprint": spec_fingerprint(line),
+                    }
+                )
+    return tables
+
+
+# fingerprint -> [(table name, rule)] over the tagged rules of a snapshot
+def fingerprint_index(snapshot):
+    index = {}
+    for table_name, table in snapshot.items():
+        for entry in table["rules"]:
+            if entry["fingerprint"]:
+                index.setdefault(entry["fingerprint"], []).append((table_name, entry))
+    return index
@@ -0,0 +1,229 @@
+"""Per-rule traffic counters, active flows and rates."""
+import collections
+import re
+import threading
+import time
+
+from app.config import STATS_HISTORY, STATS_INTERVAL
+from app.services import iptables, ports
+from app.services.snapshot import fingerprint_index, parse_save
+from app.services.store import rule_store
+
+CONNTRACK_FILE = "/proc/net/nf_conntrack"
+CONNTRACK_PROTOCOLS = ("tcp", "udp")
+STATE_RE = re.compile(r"^[A-Z_]+$")
+
+
+# Parse `/proc/net/nf_conntrack` or `conntrack -L` output into flows of
+# {"proto", "state", "original": {...}, "reply": {...}}, where each direction
+# holds the src/dst/sport/dport of that tuple.
+def parse_conntrack(text):
+    flows = []
+    for line in text.splitlines():
+        tokens = line.split()
+        proto = next((token for token in tokens[:3] if token in CONNTRACK_PROTOCOLS), None)
+        if proto is None:
+            continue
+        state = None
+        tuples = [{}, {}]
+        direction = 0
+        for token in tokens:
+            if state is None and STATE_RE.match(token):
+                state = token
+            key, sep, value = token.partition("=")
+            if not sep or key not in ("src", "dst", "sport", "dport"):
+                continue
+            # The second src= starts the reply tuple
+            if key in tuples[direction] and direction == 0:
+                direction = 1
+            tuples[direction].setdefault(key, value)
+        flows.append({"proto": proto, "state": state, "original": tuples[0], "reply": tuples[1]})
+    return flows
+
+
+def read_conntrack():
+    try:
+        with open(CONNTRACK_FILE, "r") as handle:
+            return handle.read()
+    except OSError:
+        pass
+    try:
+        return iptables.run(["conntrack", "-L"])
+    except (OSError, RuntimeError):
+        return ""
+
+
+# Count flows per rule id. A flow belongs to a forward when it arrived on the
+# external port and its reply comes from the internal target.
+def count_flows(rules, flows):
+    # Single-port forwards are found by exact key; ranges and port lists are
+    # checked against the forwards to the same target address. A flow to any
+    # backend of a load-balanced forward counts for that forward.
+    owners = {}
+    spanned = {}
+    for rule in rules:
+        ext_spans = ports.parse_ports(rule["ext_port"])
+        for backend in iptables.rule_backends(rule):
+            int_ip = backend["int_ip"]
+            int_spans = ports.parse_ports(backend["int_port"])
+            single = ports.is_single_port(rule["ext_port"]) and ports.is_single_port(
+                backend["int_port"]
+            )
+            for proto in iptables.rule_protocols(rule):
+                if single:
+                    key = (proto, str(ext_spans[0][0]), int_ip, str(int_spans[0][0]))
+                    owners.setdefault(key, rule["id"])
+                else:
+                    spanned.setdefault((proto, int_ip), []).append(
+                        (ext_spans, int_spans, rule["id"])
+                    )
+    counts = {}
+    for flow in flows:
+        proto = flow["proto"]
+        dport = flow["original"].get("dport")
+        src = flow["reply"].get("src")
+        sport = flow["reply"].get("sport")
+        rule_id = owners.get((proto, dport, src, sport))
+        if rule_id is None and dport and sport:
+            rule_id = next(
+                (
+                    candidate
+                    for ext_spans, int_spans, candidate in spanned.get((proto, src), ())
+                    if ports.contains(ext_spans, int(dport))
+                    and ports.contains(int_spans, int(sport))
+                ),
+                None,
+            )
+        if rule_id is not None:
+            counts[rule_id] = counts.get(rule_id, 0) + 1
+    return counts
+
+
+# Sum packet/byte counters per rule id from one `iptables-save -c` snapshot,
+# finding each rule's kernel rules by its fingerprint tag. DNAT only sees the
+# first packet of a connection, so the packet counter of the rule in the
+# interface chain is the number of connections; the FORWARD accept counts the
+# client's traffic. The DNAT rules of a balance chain see the same packets
+# as the jump into it and are left out.
+def count_traffic(rules, snapshot):
+    index = fingerprint_index(snapshot)
+    totals = {}
+    seen = set()
+    for rule in rules:
+        if not rule.get("enabled", True):
+            continue
+        fingerprint = iptables.rule_fingerprint(rule)
+        if fingerprint in seen:
+            continue
+        seen.add(fingerprint)
+        nat_chain = iptables.nat_subchain(rule["extif"])
+        for table_name, entry in index.get(fingerprint, ()):
+            if entry["counters"] is None:
+                continue
+            if table_name == "nat" and entry["chain"] != nat_chain:
+                continue
+            packets, byte_count = entry["counters"]
+            total = totals.setdefault(rule["id"], {"connections": 0, "packets": 0, "bytes": 0})
+            if table_name == "nat":
+                total["connections"] += packets
+            else:
+                total["packets"] += packets
+                total["bytes"] += byte_count
+    return totals
+
+
+def collect_samples(rules, save_text, conntrack_text, now):
+    traffic = count_traffic(rules, parse_save(save_text))
+    flows = count_flows(rules, parse_conntrack(conntrack_text))
+    samples = {}
+    for rule in rules:
+        sample = {"time": now, "connections": 0, "packets": 0, "bytes": 0}
+        sample.update(traffic.get(rule["id"], {}))
+        sample["active_flows"] = flows.get(rule["id"], 0)
+        samples[rule["id"]] = sample
+    return samples
+
+
+def _rate(newer, older, field):
+    elapsed = newer["time"] - older["time"]
+    delta = newer[field] - older[field]
+    # Counters restart when the kernel rules are recreated
+    if elapsed <= 0 or delta < 0:
+        return 0.0
+    return delta / elapsed
+
+
+# Keeps the last `history` samples per rule in a ring buffer. Reads never
+# touch the kernel; they only see what the last collection stored.
+class StatsCollector:
+    def __init__(self, store, history=None, interval=None):
+        self.store = store
+        self.history = history or STATS_HISTORY
+        self.interval = interval or STATS_INTERVAL
+        self.lock = threading.Lock()
+        self.samples = {}
+        self._thread = None
+        self._stop = threading.Event()
+
+    def record(self, samples):
+        with self.lock:
+            for rule_id, sample in samples.items():
+                ring = self.samples.get(rule_id)
+                if ring is None:
+                    ring = self.samples[rule_id] = collections.deque(maxlen=self.history)
+                ring.append(sample)
+            # Forget rules that no longer exist
+            for rule_id in set(self.samples) - set(samples):
+                del self.samples[rule_id]
+
+    def collect(self):
+        rules = self.store.rules()
+        save_text = iptables.run(["iptables-save", "-c"])
+        self.record(collect_samples(rules, save_text, read_conntrack(), time.time()))
+
+    def rule_stats(self, rule_id):
+        with self.lock:
+            ring = self.samples.get(rule_id)
+            if not ring:
+                return None
+            latest = ring[-1]
+            previous = ring[-2] if len(ring) > 1 else latest
+            return {
+                "active_flows": latest["active_flows"],
+                "connections": latest["connections"],
+                "packets": latest["packets"],
+                "bytes": latest["bytes"],
+                "connections_per_second": _rate(latest, previous, "connections"),
+                "packets_per_second": _rate(latest, previous, "packets"),
+                "bytes_per_second": _rate(latest, previous, "bytes"),
+                "history": [
+                    {"time": sample["time"], "bytes": sample["bytes"]} for sample in ring
+                ],
+                "updated": latest["time"],
+            }
+
+    def all_stats(self):
+        with self.lock:
+            rule_ids = list(self.samples)
+        return {rule_id: self.rule_stats(rule_id) for rule_id in rule_ids}
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.collect()
+            except Exception as exc:
+                print(f"✗ ERROR collecting rule statistics: {exc}")
+            self._stop.wait(self.interval)
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+stats_collector = StatsCollector(rule_store)
@@ -0,0 +1,400 @@
+"""In-memory rule store backed by rules.json."""
+import bisect
+import contextlib
+import ipaddress
+import os
+import re
+import threading
+import uuid
+
+from app import config
+from app.services import persistence, ports
+from app.services.metrics import RULE_RELOADS
+from app.services.rule import KEY_FIELDS
+
+
+# Canonical identity of a forward; see Rule.key() for the parsed form
+def rule_key(rule):
+    return tuple(rule[field] for field in KEY_FIELDS)
+
+
+def new_rule_id():
+    return uuid.uuid4().hex[:12]
+
+
+# Fields with an exact-match index, and how each is read from a rule
+INDEXED_FIELDS = {
+    "extif": lambda rule: rule["extif"],
+    "intif": lambda rule: rule["intif"],
+    "int_ip": lambda rule: rule["int_ip"],
+    "protocol": lambda rule: rule.get("protocol", "both"),
+    "enabled": lambda rule: rule.get("enabled", True),
+}
+
+
+def _ip_sort_key(value):
+    try:
+        address = ipaddress.ip_address(value)
+    except ValueError:
+        return (2, 0, value)
+    return (address.version, int(address), value)
+
+
+# Sortable columns; ports (by their first port) and addresses sort numerically
+SORT_KEYS = {
+    "name": lambda rule: rule.get("name", "").lower(),
+    "extif": lambda rule: rule["extif"],
+    "intif": lambda rule: rule["intif"],
+    "ext_port": lambda rule: ports.first_port(rule["ext_port"]),
+    "int_ip": lambda rule: _ip_sort_key(rule["int_ip"]),
+    "int_port": lambda rule: ports.first_port(rule["int_port"]),
+    "protocol": lambda rule: rule.get("protocol", "both"),
+    "enabled": lambda rule: not rule.get("enabled", True),
+}
+
+
+def _port_spans(value):
+    try:
+        return ports.parse_ports(value)
+    except ValueError:
+        return []
+
+
+# Punctuation within a word; the parts between are searchable on their own
+SEARCH_SPLIT = re.compile(r"[\s.:,_+-]+")
+
+
+# Words matched by free-text search: name, interfaces, ports and target IPs,
+# whole and split at punctuation, so both "10.0" and "2" find 10.0.0.2
+def _search_words(rule):
+    words = [rule.get("name", "")] + [str(rule[field]) for field in KEY_FIELDS]
+    words += [backend["int_ip"] for backend in rule.get("backends", ())]
+    text = " ".join(words).lower()
+    return (set(text.split()) | set(SEARCH_SPLIT.split(text))) - {""}
+
+
+def _stat_signature(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+# Loads rules.json once and serves reads from memory. Every write goes straight
+# to disk, and the cache is dropped whenever the file changes underneath us;
+# a changed file that does not validate is ignored and the last good rules
+# stay in use. Broken rules found on first load are only kept out of use, and
+# stay in rules.json. With the journal enabled a change appends one line instead of
+# rewriting the snapshot, and the journal is compacted on a background thread.
+class RuleStore:
+    def __init__(self, path=None, journal=None, compact_entries=None):
+        self.path = path
+        self.journal = config.RULES_JOURNAL if journal is None else journal
+        self.compact_entries = compact_entries or config.JOURNAL_COMPACT_ENTRIES
+        # Guards the rules and indexes; held briefly by reads and by the swap
+        # at the end of a write, never across a kernel call
+        self.lock = threading.RLock()
+        # Serializes writers; always taken before `lock`, never while holding it
+        self.writer_lock = threading.RLock()
+        self._rules = []
+        self._by_id = {}
+        self._by_key = {}
+        self._by_field = {}
+        self._ports = []
+        self._spanned_ports = []
+        self._search = {}
+        self._search_words = []
+        self._orders = {}
+        self._signature = None
+        self._loaded = False
+        self._journal_entries = 0
+        self._compactor = None
+        self._lock_handle = None
+        # Rules in use before the file last changed underneath us
+        self._previous = None
+        # Rules from the file that do not validate: kept out of the kernel and
+        # the indexes, and written back as they are so nothing is lost
+        self._held = []
+        self.reload_error = None
+
+    def _file_path(self):
+        return self.path or persistence.RULES_FILE
+
+    def _file_signature(self):
+        return (
+            _stat_signature(self._file_path()),
+            _stat_signature(persistence.journal_path(self._file_path())),
+        )
+
+    def _index(self, rules):
+        self._rules = rules
+        self._by_id = {rule["id"]: rule for rule in rules}
+        self._by_key = {}
+        self._by_field = {field: {} for field in INDEXED_FIELDS}
+        for position, rule in enumerate(rules):
+            self._by_key.setdefault(rule_key(rule), []).append(rule)
+            for field, read in INDEXED_FIELDS.items():
+                self._by_field[field].setdefault(read(rule), set()).add(position)
+        # Single external ports are bisected; the few ranges and port lists
+        # are checked one by one
+        self._ports = []
+        self._spanned_ports = []
+        for position, rule in enumerate(rules):
+            spans = _port_spans(rule["ext_port"])
+            if len(spans) == 1 and spans[0][0] == spans[0][1]:
+                self._ports.append((spans[0][0], position))
+            else:
+                self._spanned_ports.append((spans, position))
+        self._ports.sort()
+        # Positions by search word, and the words sorted for prefix lookups
+        self._search = {}
+        for position, rule in enumerate(rules):
+            for word in _search_words(rule):
+                self._search.setdefault(word, []).append(position)
+        self._search_words = sorted(self._search)
+        # Sort orders are built on first use and kept until the next change
+        self._orders = {}
+
+    def _refresh(self):
+        signature = self._file_signature()
+        if self._loaded and signature == self._signature:
+            return
+        try:
+            rules, journal_entries = persistence.load_snapshot_and_journal(self._file_path())
+            # Rules are kept in canonical form, whatever the file holds
+            if self._loaded:
+                # A pushed file may only repeat the broken rules already held
+                held = [data for data in rules if data in self._held]
+                rules = persistence.validate_rules(
+                    [data for data in rules if data not in self._held]
+                )
+            else:
+                rules, held = persistence.split_rules(rules)
+        except ValueError as exc:
+            if not self._loaded:
+                raise
+            self.reload_error = str(exc)
+            self._signature = signature
+            RULE_RELOADS.inc(result="rejected")
+            print(f"✗ ERROR reloading {self._file_path()}, keeping the rules in use: {exc}")
+            return
+        self.reload_error = None
+        if self._loaded and self._previous is None:
+            self._previous = self._rules
+        self._journal_entries = journal_entries
+        self._held = held
+        missing_ids = [rule for rule in rules if "id" not in rule]
+        if missing_ids:
+            self._assign_ids(missing_ids, rules)
+        self._index(rules)
+        self._loaded = True
+        self._signature = signature
+        if missing_ids:
+            # Persist the new IDs so links stay valid across restarts
+            self._write()
+
+    # A file pushed without ids keeps the ids of the forwards it still has, so
+    # a reload diffs against them and their statistics and health stay put
+    def _assign_ids(self, missing_ids, rules):
+        taken = {rule["id"] for rule in rules if "id" in rule}
+        known = {}
+        for rule in self._rules:
+            known.setdefault(rule_key(rule), rule["id"])
+        for rule in missing_ids:
+            rule_id = known.get(rule_key(rule)) if known else None
+            if rule_id is None or rule_id in taken:
+                rule_id = new_rule_id()
+            taken.add(rule_id)
+            rule["id"] = rule_id
+
+    def _write(self):
+        try:
+            persistence.save_persisted_rules(self._rules + self._held, self._file_path())
+        except RuntimeError:
+            # Drop the cache so the next read reflects what is really on disk
+            self._loaded = False
+            raise
+        self._journal_entries = 0
+        self._signature = self._file_signature()
+
+    def _commit(self, rules, entries):
+        self._index(rules)
+        if not self.journal:
+            self._write()
+            return
+        try:
+            persistence.append_journal(entries, self._file_path())
+        except RuntimeError:
+            self._loaded = False
+            raise
+        self._journal_entries += len(entries)
+        self._signature = self._file_signature()
+        if self._journal_entries >= self.compact_entries:
+            self._schedule_compaction()
+
+    def _schedule_compaction(self):
+        if self._compactor and self._compactor.is_alive():
+            return
+        self._compactor = threading.Thread(target=self.compact, daemon=True)
+        self._compactor.start()
+
+    # Hold the writer lock and the file lock for a read-modify-write that
+    # spans the kernel and rules.json. Reads go on meanwhile and see the rules
+    # from before until apply_entries() swaps them. Re-entrant within one thread.
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.writer_lock:
+            if self._lock_handle is not None:
+                yield
+                return
+            with persistence.file_lock(self._file_path()) as handle:
+                self._lock_handle = handle
+                try:
+                    yield
+                finally:
+                    self._lock_handle = None
+
+    # Fold the journal into a fresh rules.json snapshot
+    def compact(self):
+        with self.transaction(), self.lock:
+            if not self._loaded or not self._journal_entries:
+                return
+            try:
+                self._write()
+            except RuntimeError as exc:
+                print(f"✗ ERROR compacting rules journal: {exc}")
+
+    # (rules before, rules after) the file was changed by someone else since
+    # the last call, or None
+    def external_change(self):
+        with self.lock:
+            self._refresh()
+            previous, self._previous = self._previous, None
+            if previous is None:
+                return None
+            return previous, list(self._rules)
+
+    def rules(self):
+        with self.lock:
+            self._refresh()
+            return list(self._rules)
+
+    # Rules from the file that failed validation and are not in use
+    def invalid_rules(self):
+        with self.lock:
+            self._refresh()
+            return list(self._held)
+
+    def get(self, rule_id):
+        with self.lock:
+            self._refresh()
+            return self._by_id.get(rule_id)
+
+    # First match wins, as with the old linear scans
+    def find(self, key):
+        matches = self.find_all(key)
+        return matches[0] if matches else None
+
+    def find_all(self, key):
+        with self.lock:
+            self._refresh()
+            return list(self._by_key.get(key, ()))
+
+    # Positions in sort order, and each position's rank within that order
+    def _order(self, sort, descending):
+        cached = self._orders.get((sort, descending))
+        if cached is None:
+            if sort is None:
+                order = list(range(len(self._rules)))
+            else:
+                read = SORT_KEYS[sort]
+                order = sorted(range(len(self._rules)), key=lambda pos: read(self._rules[pos]))
+            if descending:
+                order.reverse()
+            rank = [0] * len(order)
+            for index, position in enumerate(order):
+                rank[position] = index
+            cached = self._orders[(sort, descending)] = (order, rank)
+        return cached
+
+    # Filter, sort and page through the rules using the indexes, so a page
+    # costs no more than the rules matching its filters. Criteria left as None
+    # are ignored; `port_min`/`port_max` select rules with an external port in
+    # that range and every word of `search` has to start a word of the name,
+    # interfaces, ports or target IPs, case-insensitively.
+    # Returns (rules on the page, total number of matches).
+    def query(
+        self,
+        extif=None,
+        intif=None,
+        int_ip=None,
+        protocol=None,
+        enabled=None,
+        port_min=None,
+        port_max=None,
+        search=None,
+        sort=None,
+        descending=False,
+        offset=0,
+        limit=None,
+    ):
+        if sort is not None and sort not in SORT_KEYS:
+            raise ValueError(f"cannot sort by {sort}, expected one of {', '.join(SORT_KEYS)}")
+        with self.lock:
+            self._refresh()
+            candidates = None
+            criteria = {
+                "extif": extif,
+                "intif": intif,
+                "int_ip": int_ip,
+                "protocol": protocol,
+                "enabled": enabled,
+            }
+            for field, value in criteria.items():
+                if value is None:
+                    continue
+                positions = self._by_field[field].get(value, set())
+                candidates = positions if candidates is None else candidates & positions
+            if port_min is not None or port_max is not None:
+                low = 0 if port_min is None else bisect.bisect_left(self._ports, (port_min, -1))
+                high = (
+                    len(self._ports)
+                    if port_max is None
+                    else bisect.bisect_left(self._ports, (port_max + 1, -1))
+                )
+                positions = {position for _, position in self._ports[low:high]}
+                wanted = [(port_min or 1, 65535 if port_max is None else port_max)]
+                positions.update(
+                    position
+                    for spans, position in self._spanned_ports
+                    if ports.overlaps(spans, wanted)
+                )
+                candidates = positions if candidates is None else candidates & positions
+            for term in (search or "").lower().split():
+                low = bisect.bisect_left(self._search_words, term)
+                high = bisect.bisect_left(self._search_words, term + "\uffff")
+                positions = set()
+                for word in self._search_words[low:high]:
+                    positions.update(self._search[word])
+                candidates = positions if candidates is None else candidates & positions
+
+            order, rank = self._order(sort, descending)
+            if candidates is not None:
+                order = sorted(candidates, key=rank.__getitem__)
+            end = None if limit is None else offset + limit
+            page = [self._rules[position] for position in order[offset:end]]
+            return page, len(order)
+
+    # Apply journal-style entries (see persistence.apply_journal_entry) with a
+    # single write, however many there are
+    def apply_entries(self, entries):
+        with self.writer_lock, self.lock:
+            self._refresh()
+            rules = self._rules
+            for entry in entries:
+                rules = persistence.apply_journal_entry(rules, entry)
+            self._commit(rules, entries)
+
+
+rule_store = RuleStore()
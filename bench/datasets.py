@@ -0,0 +1,53 @@
+"""Synthetic rules.json datasets of a given size."""
+import json
+import random
+
+EXTERNAL_INTERFACES = ("eth0", "eth1", "eth2", "eth3")
+INTERNAL_INTERFACES = ("wg0", "wg1")
+PROTOCOLS = ("both", "tcp", "udp")
+
+
+# `count` distinct forwards spread over a few interfaces: mostly single ports,
+# every 20th a port range, every 25th load-balanced and every 10th disabled
+def generate_rules(count, seed=0):
+    rng = random.Random(seed)
+    next_port = {extif: 1024 for extif in EXTERNAL_INTERFACES}
+    rules = []
+    for index in range(count):
+        extif = EXTERNAL_INTERFACES[index % len(EXTERNAL_INTERFACES)]
+        low = next_port[extif]
+        if index % 20 == 19:
+            ext_port = f"{low}-{low + 9}"
+            int_port = ext_port
+            next_port[extif] += 10
+        else:
+            ext_port = str(low)
+            int_port = str(rng.randrange(1024, 65536))
+            next_port[extif] += 1
+        host = index + 2
+        rule = {
+            "id": f"r{index:06d}",
+            "name": f"service-{index}",
+            "extif": extif,
+            "intif": INTERNAL_INTERFACES[index % len(INTERNAL_INTERFACES)],
+            "ext_port": ext_port,
+            "int_ip": f"10.{host // 65536 % 256}.{host // 256 % 256}.{host % 256}",
+            "int_port": int_port,
+            "protocol": PROTOCOLS[index % len(PROTOCOLS)],
+            "enabled": index % 10 != 9,
+        }
+        if index % 25 == 24 and "-" not in int_port:
+            second = f"10.200.{host // 256 % 256}.{host % 256}"
+            rule["backends"] = [
+                {"int_ip": rule["int_ip"], "int_port": int_port, "weight": 2},
+                {"int_ip": second, "int_port": int_port, "weight": 1},
+            ]
+        rules.append(rule)
+    return rules
+
+
+def write_rules_file(path, count, seed=0):
+    rules = generate_rules(count, seed)
+    with open(path, "w") as handle:
+        json.dump(rules, handle, indent=2)
+    return rules
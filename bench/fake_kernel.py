@@ -0,0 +1,148 @@
+"""Stand-ins for iptables-save, iptables-restore, iptables and sysctl.
+
+`install(directory)` writes one executable per command into `directory`; put
+it first on PATH. Every call is appended to $FAKE_KERNEL_LOG, sleeps for
+$FAKE_KERNEL_LATENCY_MS and works on the ruleset kept in $FAKE_KERNEL_STATE,
+so iptables-save prints back what iptables-restore committed.
+"""
+import json
+import os
+import stat
+import sys
+import time
+
+COMMANDS = ("iptables", "iptables-save", "iptables-restore", "sysctl", "conntrack")
+BUILTIN_CHAINS = {
+    "nat": ["PREROUTING", "INPUT", "OUTPUT", "POSTROUTING"],
+    "filter": ["INPUT", "FORWARD", "OUTPUT"],
+}
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WRAPPER = """#!{python}
+import sys
+sys.path.insert(0, {repo!r})
+from bench.fake_kernel import main
+sys.exit(main())
+"""
+
+
+def install(directory):
+    os.makedirs(directory, exist_ok=True)
+    for command in COMMANDS:
+        path = os.path.join(directory, command)
+        with open(path, "w") as handle:
+            handle.write(WRAPPER.format(python=sys.executable, repo=REPO))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+
+def empty_state():
+    return {
+        table: {"chains": {chain: "ACCEPT" for chain in chains}, "rules": []}
+        for table, chains in BUILTIN_CHAINS.items()
+    }
+
+
+def load_state():
+    try:
+        with open(os.environ["FAKE_KERNEL_STATE"]) as handle:
+            return json.load(handle)
+    except FileNotFoundError:
+        return empty_state()
+
+
+def save_state(state):
+    with open(os.environ["FAKE_KERNEL_STATE"], "w") as handle:
+        json.dump(state, handle)
+
+
+def reset_state():
+    save_state(empty_state())
+
+
+# Calls logged so far, one command line each
+def read_log():
+    try:
+        with open(os.environ["FAKE_KERNEL_LOG"]) as handle:
+            return handle.read().splitlines()
+    except FileNotFoundError:
+        return []
+
+
+def iptables_save(args, state):
+    tables = [args[args.index("-t") + 1]] if "-t" in args else list(state)
+    counters = "-c" in args
+    lines = ["# Generated by fake iptables-save"]
+    for name in tables:
+        table = state.get(name)
+        if table is None:
+            continue
+        lines.append(f"*{name}")
+        for chain, policy in table["chains"].items():
+            lines.append(f":{chain} {policy} [0:0]")
+        for _, spec in table["rules"]:
+            lines.append(f"[0:0] {spec}" if counters else spec)
+        lines.append("COMMIT")
+    sys.stdout.write("\n".join(lines) + "\n")
+    return 0
+
+
+# Applies the whole input or nothing, like the real command
+def iptables_restore(args, state, text):
+    noflush = "--noflush" in args
+    table = None
+    for number, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if line.startswith("*"):
+            table = state.setdefault(line[1:], {"chains": {}, "rules": []})
+            if not noflush:
+                table["rules"] = []
+            continue
+        if line == "COMMIT":
+            table = None
+            continue
+        if table is None:
+            return _fail(number, line)
+        if line.startswith(":"):
+            chain, policy = line[1:].split()[:2]
+            # Declaring a chain flushes it
+            table["chains"][chain] = policy
+            table["rules"] = [rule for rule in table["rules"] if rule[0] != chain]
+            continue
+        option, chain = line.split()[:2]
+        if chain not in table["chains"]:
+            return _fail(number, line)
+        if option == "-A":
+            table["rules"].append([chain, line])
+        elif option == "-D":
+            spec = "-A" + line[2:]
+            if [chain, spec] not in table["rules"]:
+                return _fail(number, line)
+            table["rules"].remove([chain, spec])
+        elif option == "-X":
+            del table["chains"][chain]
+        else:
+            return _fail(number, line)
+    save_state(state)
+    return 0
+
+
+def _fail(number, line):
+    sys.stderr.write(f"iptables-restore: line {number} failed: {line}\n")
+    return 1
+
+
+def main(argv=None):
+    argv = sys.argv if argv is None else argv
+    command = os.path.basename(argv[0])
+    args = argv[1:]
+    with open(os.environ["FAKE_KERNEL_LOG"], "a") as handle:
+        handle.write(" ".join([command] + args) + "\n")
+    time.sleep(float(os.environ.get("FAKE_KERNEL_LATENCY_MS", "0")) / 1000)
+    if command == "iptables-save":
+        return iptables_save(args, load_state())
+    if command == "iptables-restore":
+        return iptables_restore(args, load_state(), sys.stdin.read())
+    # iptables, sysctl and conntrack only need to succeed
+    return 0
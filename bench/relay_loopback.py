@@ -0,0 +1,163 @@
+"""Loopback throughput and latency of the userspace relay against a direct connection.
+
+Run from the repository root:
+
+    python -m bench.relay_loopback --megabytes 256 --roundtrips 2000
+"""
+import argparse
+import socket
+import statistics
+import sys
+import threading
+import time
+
+from app.services import relay as relay_module
+from app.services.relay import Relay
+
+CHUNK = 65536
+
+
+class EchoServer:
+    def __init__(self):
+        self.tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp.bind(("127.0.0.1", 0))
+        self.tcp.listen(128)
+        self.port = self.tcp.getsockname()[1]
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind(("127.0.0.1", self.port))
+        threading.Thread(target=self._serve_tcp, daemon=True).start()
+        threading.Thread(target=self._serve_udp, daemon=True).start()
+
+    def _serve_tcp(self):
+        while True:
+            try:
+                conn, _ = self.tcp.accept()
+            except OSError:
+                return
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self._echo, args=(conn,), daemon=True).start()
+
+    def _echo(self, conn):
+        buffer = bytearray(CHUNK)
+        with conn:
+            while True:
+                count = conn.recv_into(buffer)
+                if not count:
+                    return
+                conn.sendall(memoryview(buffer)[:count])
+
+    def _serve_udp(self):
+        while True:
+            try:
+                data, addr = self.udp.recvfrom(CHUNK)
+            except OSError:
+                return
+            self.udp.sendto(data, addr)
+
+    def close(self):
+        self.tcp.close()
+        self.udp.close()
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# MB/s of a bulk transfer echoed back through `port`
+def tcp_throughput(port, megabytes):
+    total = megabytes * 1024 * 1024
+    payload = b"\0" * CHUNK
+    with socket.create_connection(("127.0.0.1", port)) as sock:
+
+        def send():
+            sent = 0
+            while sent < total:
+                sent += sock.send(payload[: min(CHUNK, total - sent)])
+            sock.shutdown(socket.SHUT_WR)
+
+        start = time.perf_counter()
+        sender = threading.Thread(target=send)
+        sender.start()
+        buffer = bytearray(CHUNK)
+        received = 0
+        while received < total:
+            count = sock.recv_into(buffer)
+            if not count:
+                break
+            received += count
+        sender.join()
+        elapsed = time.perf_counter() - start
+    return received / elapsed / 1024 / 1024
+
+
+def tcp_latencies(port, roundtrips):
+    samples = []
+    with socket.create_connection(("127.0.0.1", port)) as sock:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        for _ in range(roundtrips):
+            start = time.perf_counter()
+            sock.sendall(b"x")
+            sock.recv(1)
+            samples.append(time.perf_counter() - start)
+    return samples
+
+
+def udp_latencies(port, roundtrips):
+    samples = []
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(2)
+        sock.connect(("127.0.0.1", port))
+        for _ in range(roundtrips):
+            start = time.perf_counter()
+            sock.send(b"x")
+            sock.recv(64)
+            samples.append(time.perf_counter() - start)
+    return samples
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    return f"p50 {statistics.median(samples) * 1e6:7.1f} µs  p99 {p99 * 1e6:7.1f} µs"
+
+
+def run(megabytes, roundtrips):
+    echo = EchoServer()
+    relay = Relay(bind=("127.0.0.1",))
+    port = free_port()
+    relay.reconcile(
+        [
+            {
+                "id": "bench",
+                "extif": "lo",
+                "intif": "lo",
+                "ext_port": str(port),
+                "int_ip": "127.0.0.1",
+                "int_port": str(echo.port),
+                "protocol": "both",
+            }
+        ]
+    )
+    try:
+        print(f"splice: {'yes' if relay_module.SPLICE else 'no'}")
+        for label, target in (("direct", echo.port), ("relay", port)):
+            print(f"{label:>6}  TCP {tcp_throughput(target, megabytes):9.1f} MB/s")
+            print(f"{label:>6}  TCP {summarize(tcp_latencies(target, roundtrips))}")
+            print(f"{label:>6}  UDP {summarize(udp_latencies(target, roundtrips))}")
+    finally:
+        relay.stop()
+        echo.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--megabytes", type=int, default=256, help="bulk transfer size")
+    parser.add_argument("--roundtrips", type=int, default=2000, help="latency samples")
+    args = parser.parse_args(argv)
+    run(args.megabytes, args.roundtrips)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
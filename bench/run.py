@@ -0,0 +1,177 @@
+"""Time rule apply, restore, persistence and page render at growing rule counts.
+
+Every iptables call goes to the stand-ins from bench.fake_kernel, which add a
+fixed latency per call. Run from the repository root:
+
+    python -m bench.run --sizes 10,100,1000,10000 --latency-ms 5 --json results.json
+    python -m bench.run --baseline results.json   # exit 1 on a regression
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from bench import datasets, fake_kernel
+
+DEFAULT_SIZES = (10, 100, 1000, 10000)
+# A new forward that no dataset contains
+NEW_RULE = {
+    "id": "benchnew",
+    "extif": "eth9",
+    "intif": "wg9",
+    "ext_port": "443",
+    "int_ip": "10.250.0.1",
+    "int_port": "8443",
+    "protocol": "both",
+}
+
+
+def _quiet(operation):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return operation()
+
+
+# Wall time from a plain run, peak Python allocations from a traced repeat,
+# since tracing slows the code down; each run gets a fresh setup
+def measure(setup, operation):
+    _quiet(setup)
+    calls_before = len(fake_kernel.read_log())
+    start = time.perf_counter()
+    _quiet(operation)
+    seconds = time.perf_counter() - start
+    subprocesses = len(fake_kernel.read_log()) - calls_before
+
+    _quiet(setup)
+    tracemalloc.start()
+    try:
+        _quiet(operation)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"seconds": seconds, "subprocesses": subprocesses, "peak_kib": peak / 1024}
+
+
+def operations(rules, path, client):
+    from app.services import persistence
+    from app.services.changes import change_queue
+    from app.services.store import rule_store
+
+    def restored_kernel():
+        fake_kernel.reset_state()
+        persistence.save_persisted_rules(rules, path)
+        persistence.restore_persistent_rules(rule_store)
+
+    # A new forward through the change queue, as the GUI and API add one
+    def apply_rule():
+        change_queue.submit([{"op": "put", "rule": NEW_RULE}]).wait()
+
+    def save():
+        persistence.save_persisted_rules(rules, path)
+
+    def render():
+        client.get("/")
+
+    def restore():
+        persistence.restore_persistent_rules(rule_store)
+
+    # (name, setup, operation); rendering is measured with the store warm
+    return [
+        ("save_persisted_rules", lambda: None, save),
+        ("restore_persistent_rules", fake_kernel.reset_state, restore),
+        ("apply_rule", restored_kernel, apply_rule),
+        ("render_index", render, render),
+    ]
+
+
+def run(sizes, latency_ms, workdir):
+    bin_dir = os.path.join(workdir, "bin")
+    fake_kernel.install(bin_dir)
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ.get("PATH", "")
+    os.environ["FAKE_KERNEL_STATE"] = os.path.join(workdir, "kernel.json")
+    os.environ["FAKE_KERNEL_LOG"] = os.path.join(workdir, "calls.log")
+    os.environ["FAKE_KERNEL_LATENCY_MS"] = str(latency_ms)
+    os.environ["FIREWALL_BACKEND"] = "iptables"
+    os.environ["RULES_JOURNAL"] = "0"
+    # Every call goes to the stand-ins, none to the host's /proc/sys
+    os.environ["NATIVE_KERNEL_CALLS"] = "0"
+
+    from app import create_app
+    from app.services import persistence
+
+    client = _quiet(create_app).test_client()
+    results = []
+    for size in sizes:
+        path = os.path.join(workdir, f"rules-{size}.json")
+        rules = datasets.write_rules_file(path, size)
+        persistence.RULES_FILE = path
+        for name, setup, operation in operations(rules, path, client):
+            result = dict(measure(setup, operation), rules=size, operation=name)
+            results.append(result)
+            print(
+                f"{size:>6}  {name:<26} {result['seconds'] * 1000:10.1f} ms "
+                f"{result['subprocesses']:12d} {result['peak_kib']:10.0f} KiB",
+                flush=True,
+            )
+    return results
+
+
+# Rows that got slower by more than `tolerance` times or fork more often
+def regressions(results, baseline, tolerance):
+    previous = {(row["rules"], row["operation"]): row for row in baseline}
+    found = []
+    for row in results:
+        before = previous.get((row["rules"], row["operation"]))
+        if before is None:
+            continue
+        if row["subprocesses"] > before["subprocesses"]:
+            found.append(
+                f"{row['operation']} at {row['rules']} rules: "
+                f"{before['subprocesses']} -> {row['subprocesses']} subprocesses"
+            )
+        if row["seconds"] > before["seconds"] * tolerance:
+            found.append(
+                f"{row['operation']} at {row['rules']} rules: "
+                f"{before['seconds'] * 1000:.1f} -> {row['seconds'] * 1000:.1f} ms"
+            )
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes",
+        default=",".join(str(size) for size in DEFAULT_SIZES),
+        help="comma-separated rule counts",
+    )
+    parser.add_argument("--latency-ms", type=float, default=5, help="delay per fake call")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="results file to compare against")
+    parser.add_argument(
+        "--tolerance", type=float, default=1.5, help="allowed slowdown against the baseline"
+    )
+    args = parser.parse_args(argv)
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+
+    print(f"{'rules':>6}  {'operation':<26} {'wall':>13} {'subprocesses':>12} {'peak memory':>14}")
+    with tempfile.TemporaryDirectory(prefix="erpf-bench-") as workdir:
+        results = run(sizes, args.latency_ms, workdir)
+
+    if args.json:
+        with open(args.json, "w") as handle:
+            json.dump(results, handle, indent=2)
+    if args.baseline:
+        with open(args.baseline) as handle:
+            found = regressions(results, json.load(handle), args.tolerance)
+        for line in found:
+            print(f"✗ Regression: {line}")
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,7 +1,70 @@
+import signal
 import sys
+import threading
 
 from app import create_app
-from app.services.persistence import restore_persistent_rules
+from app.config import (
+    FIREWALL_BACKEND,
+    SERVER,
+    STARTUP_RESTORE,
+    WEB_CHANNEL_TIMEOUT,
+    WEB_CONNECTION_LIMIT,
+    WEB_THREADS,
+)
+from app.services.drift import drift_watcher
+from app.services.health import health_checker
+from app.services.interfaces import interface_inventory
+from app.services.persistence import restore_persistent_rules, restore_progress
+from app.services.reload import rules_watcher
+from app.services.stats import stats_collector
+from app.services.store import rule_store
+
+HOST = "0.0.0.0"
+PORT = 5000
+
+
+def raise_system_exit(signum, frame):
+    raise SystemExit(0)
+
+
+def serve(app):
+    if SERVER == "dev":
+        app.run(host=HOST, port=PORT, threaded=True)
+        return
+    if SERVER != "waitress":
+        print(f"✗ Unknown SERVER '{SERVER}', expected 'waitress' or 'dev'.")
+        sys.exit(1)
+
+    from waitress import create_server
+
+    server = create_server(
+        app,
+        host=HOST,
+        port=PORT,
+        threads=WEB_THREADS,
+        connection_limit=WEB_CONNECTION_LIMIT,
+        channel_timeout=WEB_CHANNEL_TIMEOUT,
+    )
+    # waitress finishes in-flight requests when the loop exits with SystemExit
+    signal.signal(signal.SIGTERM, raise_system_exit)
+    print(f"✓ Serving on http://{HOST}:{PORT} with {WEB_THREADS} threads")
+    server.run()
+
+
+# Restore rules and start what reads or changes the kernel afterwards, so the
+# watchers never report rules that are still being restored as drift
+def startup():
+    try:
+        restore_persistent_rules(rule_store)
+    except Exception as exc:
+        print(f"✗ ERROR restoring rules: {exc}")
+        restore_progress.finish("failed", error=str(exc))
+    # Traffic statistics are read from kernel counters, which the relay has none of
+    if FIREWALL_BACKEND != "relay":
+        stats_collector.start()
+    health_checker.start()
+    drift_watcher.start()
+    rules_watcher.start()
 
 
 def main():
@@ -9,11 +72,28 @@ def main():
         print("Only runs on Linux.")
         sys.exit(1)
 
+    interface_inventory.start()
     # Restore rules at startup, not just at the first request
-    restore_persistent_rules()
+    if STARTUP_RESTORE == "blocking":
+        startup()
+    else:
+        threading.Thread(target=startup, name="startup-restore", daemon=True).start()
 
     app = create_app()
-    app.run(host="0.0.0.0", port=5000)
+    try:
+        serve(app)
+    finally:
+        stats_collector.stop()
+        interface_inventory.stop()
+        health_checker.stop()
+        drift_watcher.stop()
+        rules_watcher.stop()
+        if FIREWALL_BACKEND == "relay":
+            from app.services.relay import userspace_relay
+
+            userspace_relay.stop()
+        # Leave a compact rules.json behind for the next start
+        rule_store.compact()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,215 @@
+import json
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from app import create_app
+from app.services.changes import ChangeQueue
+from app.services.store import RuleStore
+
+
+def make_rule(port, **fields):
+    rule = {
+        "extif": "eth0",
+        "intif": "wg0",
+        "ext_port": str(port),
+        "int_ip": "10.0.0.2",
+        "int_port": str(port),
+        "protocol": "both",
+    }
+    rule.update(fields)
+    return rule
+
+
+class TestApi(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app()
+        self.client = self.app.test_client()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.rules_path = f"{self.tmpdir.name}/rules.json"
+        self.store = RuleStore(self.rules_path)
+        self.queue = ChangeQueue(self.store)
+        for target, value in (
+            ("app.api.rule_store", self.store),
+            ("app.api.change_queue", self.queue),
+        ):
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch("app.services.changes.reconcile", return_value=([], []))
+        self.reconcile = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def saved_rules(self):
+        with open(self.rules_path) as handle:
+            return json.load(handle)
+
+    def test_create_get_patch_delete(self):
+        response = self.client.post("/api/v1/rules?wait=1", json=make_rule(443, int_port=8443))
+        self.assertEqual(201, response.status_code)
+        rule_id = response.get_json()["id"]
+
+        rule = self.client.get(f"/api/v1/rules/{rule_id}").get_json()
+        self.assertEqual("8443", rule["int_port"])
+
+        response = self.client.patch(
+            f"/api/v1/rules/{rule_id}?wait=1", json={"enabled": False}
+        )
+        self.assertEqual(200, response.status_code)
+        self.assertFalse(self.saved_rules()[0]["enabled"])
+
+        response = self.client.delete(f"/api/v1/rules/{rule_id}?wait=1")
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([], self.saved_rules())
+        self.assertEqual(404, self.client.get(f"/api/v1/rules/{rule_id}").status_code)
+
+    def test_create_rejects_invalid_and_duplicate_rules(self):
+        response = self.client.post("/api/v1/rules?wait=1", json=make_rule(70000))
+        self.assertEqual(400, response.status_code)
+        self.assertIn("ext_port", response.get_json()["error"])
+
+        self.client.post("/api/v1/rules?wait=1", json=make_rule(443))
+        response = self.client.post(
+            "/api/v1/rules?wait=1", json=make_rule(443, protocol="tcp")
+        )
+        self.assertEqual(409, response.status_code)
+
+    def test_conflicts_are_checked_again_at_commit(self):
+        release = threading.Event()
+        self.reconcile.side_effect = lambda rules: release.wait(5) and ([], [])
+
+        first = self.client.post("/api/v1/rules", json=make_rule(443)).get_json()
+        second = self.client.post("/api/v1/rules", json=make_rule(443)).get_json()
+        release.set()
+        self.assertTrue(self.queue.join(timeout=5))
+
+        jobs = [
+            self.client.get(f"/api/v1/jobs/{rule['job']['id']}").get_json()
+            for rule in (first, second)
+        ]
+        self.assertEqual(["done", "failed"], [job["status"] for job in jobs])
+        self.assertTrue(jobs[1]["conflict"])
+        self.assertIn("already exists", jobs[1]["error"])
+        self.assertEqual([first["id"]], [rule["id"] for rule in self.saved_rules()])
+
+        with mock.patch("app.api._check_conflicts"):
+            response = self.client.post(
+                "/api/v1/rules?wait=1", json=make_rule("400-500", int_port="400-500")
+            )
+        self.assertEqual(409, response.status_code)
+        self.assertIn("overlaps the forward eth0:443", response.get_json()["error"])
+
+    def test_port_ranges_are_validated_and_checked_for_overlap(self):
+        response = self.client.post(
+            "/api/v1/rules?wait=1",
+            json=make_rule("27000-29000", int_port="27000-29000", protocol="udp"),
+        )
+        self.assertEqual(201, response.status_code)
+        self.assertEqual("27000-29000", self.saved_rules()[0]["ext_port"])
+
+        response = self.client.post(
+            "/api/v1/rules?wait=1", json=make_rule("28000", int_port="28000")
+        )
+        self.assertEqual(409, response.status_code)
+        response = self.client.post(
+            "/api/v1/rules?wait=1", json=make_rule("28000", int_port="28000", protocol="tcp")
+        )
+        self.assertEqual(201, response.status_code)
+        response = self.client.post(
+            "/api/v1/rules?wait=1", json=make_rule("100-200", int_port="300-400")
+        )
+        self.assertEqual(400, response.status_code)
+
+    def test_relay_backend_refuses_wide_forwards_on_save(self):
+        with (
+            mock.patch("app.config.FIREWALL_BACKEND", "relay"),
+            mock.patch("app.config.RELAY_MAX_PORTS", 100),
+        ):
+            response = self.client.post(
+                "/api/v1/rules?wait=1", json=make_rule("27000-29000", int_port="27000-29000")
+            )
+        self.assertEqual(400, response.status_code)
+        self.assertIn("at most 100", response.json["error"])
+        self.reconcile.assert_not_called()
+
+    def test_create_load_balanced_rule(self):
+        backends = [
+            {"int_ip": "10.0.0.2", "int_port": 8443, "weight": 2},
+            {"int_ip": "10.0.0.3", "int_port": "8443"},
+        ]
+        rule = {"extif": "eth0", "intif": "wg0", "ext_port": 443, "backends": backends}
+
+        response = self.client.post("/api/v1/rules?wait=1", json=rule)
+
+        self.assertEqual(201, response.status_code)
+        saved = self.saved_rules()[0]
+        self.assertEqual(("10.0.0.2", "8443"), (saved["int_ip"], saved["int_port"]))
+        self.assertEqual([2, 1], [backend["weight"] for backend in saved["backends"]])
+        response = self.client.post(
+            "/api/v1/rules?wait=1",
+            json=dict(rule, ext_port=80, backends=backends + [backends[1]]),
+        )
+        self.assertEqual(400, response.status_code)
+
+    def test_create_reports_kernel_failure(self):
+        self.reconcile.side_effect = RuntimeError("boom")
+
+        response = self.client.post("/api/v1/rules?wait=1", json=make_rule(443))
+
+        self.assertEqual(500, response.status_code)
+        self.assertEqual("boom", response.get_json()["error"])
+        self.assertEqual([], self.store.rules())
+
+    def test_mutation_returns_job_to_poll(self):
+        response = self.client.post("/api/v1/rules", json=make_rule(443))
+        self.assertEqual(202, response.status_code)
+        job = response.get_json()["job"]
+        self.assertEqual(f"/api/v1/jobs/{job['id']}", response.headers["Location"])
+        self.assertTrue(self.queue.join(timeout=5))
+
+        status = self.client.get(response.headers["Location"]).get_json()
+        self.assertEqual("done", status["status"])
+        self.assertTrue(status["persisted"])
+        self.assertEqual(1, len(self.saved_rules()))
+        self.assertEqual(404, self.client.get("/api/v1/jobs/missing").status_code)
+
+    def test_bulk_endpoints_use_one_transaction(self):
+        response = self.client.post(
+            "/api/v1/rules/bulk?wait=1", json=[make_rule(port) for port in range(1000, 1300)]
+        )
+        self.assertEqual(201, response.status_code)
+        self.assertEqual(1, self.reconcile.call_count)
+        ids = [rule["id"] for rule in response.get_json()["rules"]]
+
+        response = self.client.post(
+            "/api/v1/rules/bulk-toggle?wait=1", json={"ids": ids[:100], "enabled": False}
+        )
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(2, self.reconcile.call_count)
+        self.assertEqual(100, sum(not rule["enabled"] for rule in self.saved_rules()))
+
+        response = self.client.post("/api/v1/rules/bulk-delete?wait=1", json=ids[:250])
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(3, self.reconcile.call_count)
+        self.assertEqual(50, len(self.saved_rules()))
+
+    def test_bulk_delete_rejects_unknown_ids(self):
+        response = self.client.post("/api/v1/rules/bulk-delete?wait=1", json=["missing"])
+
+        self.assertEqual(404, response.status_code)
+
+    def test_list_filters_and_paginates(self):
+        rules = [make_rule(port) for port in range(1000, 1030)]
+        rules.append(make_rule(22, extif="eth1", name="ssh"))
+        self.client.post("/api/v1/rules/bulk?wait=1", json=rules)
+
+        page = self.client.get("/api/v1/rules?extif=eth0&limit=10&offset=20").get_json()
+        self.assertEqual(30, page["total"])
+        ports = [rule["ext_port"] for rule in page["rules"]]
+        self.assertEqual([str(port) for port in range(1020, 1030)], ports)
+
+        page = self.client.get("/api/v1/rules?q=SSH").get_json()
+        self.assertEqual(["22"], [rule["ext_port"] for rule in page["rules"]])
+        self.assertEqual(400, self.client.get("/api/v1/rules?limit=0").status_code)
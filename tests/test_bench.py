@@ -0,0 +1,72 @@
+import io
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from app.api import validate_rule
+from app.services import iptables, reconciler
+from app.services.snapshot import parse_save
+from app.services.store import rule_key
+from bench import datasets, fake_kernel
+
+
+class TestBench(unittest.TestCase):
+    def setUp(self):
+        workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(workdir.cleanup)
+        environ = mock.patch.dict(
+            os.environ,
+            {
+                "FAKE_KERNEL_STATE": os.path.join(workdir.name, "kernel.json"),
+                "FAKE_KERNEL_LOG": os.path.join(workdir.name, "calls.log"),
+                "FAKE_KERNEL_LATENCY_MS": "0",
+            },
+        )
+        environ.start()
+        self.addCleanup(environ.stop)
+
+    def call(self, argv, stdin=""):
+        stdout = io.StringIO()
+        with (
+            mock.patch("sys.stdin", io.StringIO(stdin)),
+            mock.patch("sys.stdout", stdout),
+            mock.patch("sys.stderr", io.StringIO()),
+        ):
+            status = fake_kernel.main(argv)
+        return status, stdout.getvalue()
+
+    def test_generated_rules_are_valid_and_distinct(self):
+        rules = datasets.generate_rules(500)
+
+        for rule in rules:
+            validate_rule(dict(rule))
+        self.assertEqual(500, len({rule_key(rule) for rule in rules}))
+        self.assertTrue(any(rule.get("backends") for rule in rules))
+
+    def test_fake_kernel_saves_what_was_restored(self):
+        rules = datasets.generate_rules(50)
+        specs = iptables.desired_specs(rules)
+        payload = iptables.build_restore_payload(
+            specs, new_chains=iptables.missing_chains(specs, set())
+        )
+
+        self.assertEqual(0, self.call(["iptables-restore", "--noflush"], payload)[0])
+        status, saved = self.call(["iptables-save"])
+
+        self.assertEqual(0, status)
+        plan = reconciler.plan_changes(rules, parse_save(saved))
+        self.assertEqual(([], [], [], []), plan)
+        self.assertEqual(
+            ["iptables-restore --noflush", "iptables-save"], fake_kernel.read_log()
+        )
+
+    def test_fake_restore_is_all_or_nothing(self):
+        payload = "*nat\n:ERPF-PREROUTING - [0:0]\n-D ERPF-PREROUTING -j ACCEPT\nCOMMIT\n"
+
+        self.assertEqual(1, self.call(["iptables-restore", "--noflush"], payload)[0])
+        self.assertNotIn("ERPF-PREROUTING", self.call(["iptables-save", "-t", "nat"])[1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,142 @@
+import json
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from app.services import persistence
+from app.services.changes import Change, ChangeQueue
+from app.services.store import RuleStore
+
+
+def make_rule(port):
+    return {
+        "id": f"r{port}",
+        "extif": "eth0",
+        "intif": "wg0",
+        "ext_port": str(port),
+        "int_ip": "10.0.0.2",
+        "int_port": str(port),
+        "protocol": "both",
+        "enabled": True,
+    }
+
+
+def disable(port):
+    return [{"op": "update", "id": f"r{port}", "fields": {"enabled": False}}]
+
+
+class TestChangeQueue(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.path = f"{self.tmpdir.name}/rules.json"
+        with open(self.path, "w") as handle:
+            json.dump([make_rule(port) for port in range(1000, 1020)], handle)
+        self.store = RuleStore(self.path)
+
+    def saved_rules(self):
+        with open(self.path) as handle:
+            return json.load(handle)
+
+    def test_burst_is_committed_in_batches(self):
+        queue = ChangeQueue(self.store, window_ms=50)
+        results = {}
+
+        def submit(port):
+            results[port] = queue.submit(disable(port))
+
+        with (
+            mock.patch("app.services.changes.reconcile") as reconcile,
+            mock.patch.object(
+                persistence, "save_persisted_rules", wraps=persistence.save_persisted_rules
+            ) as save,
+        ):
+            threads = [
+                threading.Thread(target=submit, args=(port,)) for port in range(1000, 1020)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertTrue(queue.join(timeout=5))
+
+        self.assertTrue(all(change.persisted for change in results.values()))
+        self.assertLess(reconcile.call_count, 20)
+        self.assertEqual(reconcile.call_count, save.call_count)
+        self.assertFalse(any(rule["enabled"] for rule in self.saved_rules()))
+
+    def test_rejected_change_does_not_block_the_batch(self):
+        queue = ChangeQueue(self.store)
+        rules = self.store.rules()
+
+        def fake_reconcile(rules):
+            if any(rule["ext_port"] == "1001" and not rule["enabled"] for rule in rules):
+                raise RuntimeError("boom")
+            return [], []
+
+        with mock.patch("app.services.changes.reconcile", side_effect=fake_reconcile):
+            batch = [Change(disable(1000)), Change(disable(1001)), Change(disable(1002))]
+            queue._commit(batch)
+
+        self.assertEqual([True, False, True], [change.persisted for change in batch])
+        self.assertEqual("boom", batch[1].error)
+        enabled = {rule["id"]: rule["enabled"] for rule in self.saved_rules()}
+        self.assertTrue(enabled["r1001"])
+        self.assertFalse(enabled["r1000"] or enabled["r1002"])
+        self.assertEqual(len(rules), len(self.saved_rules()))
+
+    def test_change_without_kernel_requirement_is_persisted_with_error(self):
+        queue = ChangeQueue(self.store)
+
+        with mock.patch("app.services.changes.reconcile", side_effect=RuntimeError("boom")):
+            change = queue.submit([{"op": "remove", "ids": ["r1000"]}], require_kernel=False)
+            change.wait(timeout=5)
+
+        self.assertEqual("done", change.status)
+        self.assertTrue(change.persisted)
+        self.assertEqual("boom", change.error)
+        self.assertEqual(19, len(self.saved_rules()))
+
+    def test_submit_returns_before_commit_and_reports_status(self):
+        queue = ChangeQueue(self.store)
+        release = threading.Event()
+        finished = []
+
+        def slow_reconcile(rules):
+            release.wait(timeout=5)
+            return [], []
+
+        with mock.patch("app.services.changes.reconcile", side_effect=slow_reconcile):
+            change = queue.submit(disable(1000), on_done=finished.append)
+            self.assertIs(change, queue.job(change.id))
+            self.assertIn(change.status, ("pending", "running"))
+            self.assertEqual(1, queue.pending_count())
+            release.set()
+            self.assertTrue(queue.join(timeout=5))
+
+        self.assertEqual("done", change.to_dict()["status"])
+        self.assertEqual([change], finished)
+        self.assertEqual(0, queue.pending_count())
+
+    def test_reads_do_not_wait_for_the_kernel(self):
+        queue = ChangeQueue(self.store)
+        converging = threading.Event()
+        release = threading.Event()
+
+        def slow_reconcile(rules):
+            converging.set()
+            release.wait(timeout=5)
+            return [], []
+
+        with mock.patch("app.services.changes.reconcile", side_effect=slow_reconcile):
+            change = queue.submit(disable(1000))
+            self.assertTrue(converging.wait(timeout=5))
+            # Served from the rules before the change while iptables runs
+            page, total = self.store.query(enabled=True)
+            self.assertEqual(20, total)
+            self.assertTrue(self.store.get("r1000")["enabled"])
+            release.set()
+            change.wait(timeout=5)
+
+        self.assertFalse(self.store.get("r1000")["enabled"])
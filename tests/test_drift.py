@@ -0,0 +1,108 @@
+import unittest
+from unittest import mock
+
+from app.services import drift, iptables
+from app.services.drift import DriftWatcher, owned_fingerprint
+
+RULE = {
+    "id": "web",
+    "extif": "eth0",
+    "intif": "wg0",
+    "ext_port": "443",
+    "int_ip": "10.0.0.2",
+    "int_port": "8443",
+    "protocol": "tcp",
+}
+
+
+# iptables-save output per table holding exactly what the rules need, with a
+# built-in chain header whose counters keep moving
+def save_texts(rules, packets=0):
+    specs = iptables.desired_specs(rules)
+    chains = iptables.missing_chains(specs, set())
+    texts = []
+    for table, builtin in (("nat", "PREROUTING"), ("filter", "FORWARD")):
+        lines = [f"*{table}", f":{builtin} ACCEPT [{packets}:{packets * 60}]"]
+        lines += [f":{chain} - [0:0]" for chain_table, chain in chains if chain_table == table]
+        lines += [spec for spec_table, spec in specs if spec_table == table]
+        lines.append("COMMIT")
+        texts.append("\n".join(lines) + "\n")
+    return texts
+
+
+class TestDrift(unittest.TestCase):
+    def watcher(self, texts, backend="iptables"):
+        store = mock.Mock()
+        store.rules.return_value = [RULE]
+        queue = mock.Mock(generation=0)
+        queue.pending_count.return_value = 0
+        queue.submit.return_value.id = "job1"
+        watcher = DriftWatcher(store, queue, backend=backend, interval=5)
+        run = mock.patch.object(drift.iptables, "run", side_effect=lambda cmd: texts.pop(0))
+        run.start()
+        self.addCleanup(run.stop)
+        return watcher, queue
+
+    def test_fingerprint_ignores_builtin_counters_and_foreign_rules(self):
+        texts = save_texts([RULE])
+        busy = save_texts([RULE], packets=1234)
+        busy[0] = busy[0].replace("COMMIT", "-A PREROUTING -p tcp --dport 22 -j ACCEPT\nCOMMIT")
+
+        self.assertEqual(owned_fingerprint(texts), owned_fingerprint(busy))
+        self.assertNotEqual(owned_fingerprint(texts), owned_fingerprint(save_texts([])))
+
+    def test_unchanged_kernel_is_only_hashed(self):
+        watcher, queue = self.watcher(save_texts([RULE]) + save_texts([RULE], packets=9))
+
+        self.assertIsNone(watcher.check())
+        with mock.patch.object(drift, "plan_changes") as plan:
+            self.assertIsNone(watcher.check())
+        plan.assert_not_called()
+        queue.submit.assert_not_called()
+        self.assertEqual(2, watcher.status()["checks"])
+
+    def test_flushed_chain_is_recorded_and_repaired_once(self):
+        dnat = (
+            f"-A ERPF-PRE-eth0 -p tcp -m tcp --dport 443 {iptables.rule_tag(RULE)} "
+            "-j DNAT --to-destination 10.0.0.2:8443"
+        )
+        flushed = save_texts([RULE])
+        flushed[0] = flushed[0].replace(dnat + "\n", "")
+        watcher, queue = self.watcher(save_texts([RULE]) + flushed + list(flushed))
+
+        watcher.check()
+        event = watcher.check()
+
+        self.assertEqual(1, event["changes"])
+        self.assertEqual([f"+ nat {dnat}"], event["specs"])
+        self.assertEqual(["web"], event["rules"])
+        queue.submit.assert_called_once()
+        self.assertEqual([], queue.submit.call_args[0][0])
+        self.assertEqual("job1", event["job"])
+        # The same broken state is not repaired again on every poll
+        self.assertIsNone(watcher.check())
+        self.assertEqual(1, queue.submit.call_count)
+
+    def test_checks_wait_for_pending_changes(self):
+        watcher, queue = self.watcher([])
+        queue.pending_count.return_value = 1
+
+        self.assertIsNone(watcher.check())
+        self.assertEqual(0, watcher.status()["checks"])
+
+    def test_nftables_change_without_commit_is_drift(self):
+        table = "table ip erpf {\n}\n"
+        watcher, queue = self.watcher(
+            [table, table + "# edited\n", table + "# ours\n", ""], backend="nftables"
+        )
+
+        self.assertIsNone(watcher.check())
+        self.assertEqual(["~ table ip erpf"], watcher.check()["specs"])
+        # Our own commit changing the table is not drift
+        queue.generation = 1
+        self.assertIsNone(watcher.check())
+        self.assertEqual(["- table ip erpf"], watcher.check()["specs"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,129 @@
+import socket
+import unittest
+from unittest import mock
+
+from app.services import iptables
+from app.services.health import HealthChecker, probe
+
+
+def listener(kind=socket.SOCK_STREAM):
+    sock = socket.socket(socket.AF_INET, kind)
+    sock.bind(("127.0.0.1", 0))
+    if kind == socket.SOCK_STREAM:
+        sock.listen()
+    return sock
+
+
+def closed_port():
+    sock = listener()
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def balanced_rule(up_port, dead_port, **fields):
+    rule = {
+        "id": "web",
+        "extif": "eth0",
+        "intif": "lo",
+        "ext_port": "443",
+        "int_ip": "127.0.0.1",
+        "int_port": str(up_port),
+        "protocol": "tcp",
+        "backends": [
+            {"int_ip": "127.0.0.1", "int_port": str(up_port), "weight": 1},
+            {"int_ip": "127.0.0.1", "int_port": str(dead_port), "weight": 1},
+        ],
+        "health_check": {"type": "tcp"},
+    }
+    rule.update(fields)
+    return rule
+
+
+class TestHealth(unittest.TestCase):
+    def setUp(self):
+        self.up = listener()
+        self.addCleanup(self.up.close)
+        self.up_port = self.up.getsockname()[1]
+        self.dead_port = closed_port()
+
+    def checker(self, rules, fall=1, rise=1):
+        store = mock.Mock()
+        store.rules.return_value = rules
+        queue = mock.Mock()
+        checker = HealthChecker(store, queue, timeout=1, workers=4, fall=fall, rise=rise)
+        self.addCleanup(checker.stop)
+        return checker, queue
+
+    def test_tcp_probe_against_local_listener(self):
+        up = {"int_ip": "127.0.0.1", "int_port": str(self.up_port)}
+        dead = {"int_ip": "127.0.0.1", "int_port": str(self.dead_port)}
+
+        self.assertIsNone(probe(up, {}, 1))
+        self.assertIsNotNone(probe(dead, {}, 1))
+
+    def test_udp_probe_fails_only_on_closed_port(self):
+        udp = listener(socket.SOCK_DGRAM)
+        self.addCleanup(udp.close)
+        check = {"type": "udp", "payload": "ping"}
+        open_backend = {"int_ip": "127.0.0.1", "int_port": str(udp.getsockname()[1])}
+
+        self.assertIsNone(probe(open_backend, check, 0.2))
+        closed = {"int_ip": "127.0.0.1", "int_port": str(self.dead_port)}
+        self.assertIsNotNone(probe(closed, check, 0.2))
+
+    def test_dead_backend_leaves_rotation_after_fall_failures(self):
+        rule = balanced_rule(self.up_port, self.dead_port)
+        checker, queue = self.checker([rule], fall=2)
+
+        checker.check()
+        queue.submit.assert_not_called()
+        checker.check()
+
+        queue.submit.assert_called_once()
+        entries = queue.submit.call_args[0][0]
+        dead = f"127.0.0.1:{self.dead_port}"
+        self.assertEqual([{"op": "update", "id": "web", "fields": {"down": [dead]}}], entries)
+        health = checker.rule_health(rule)
+        self.assertEqual([True, False], [backend["healthy"] for backend in health])
+
+    def test_recovered_backend_returns_and_unchecked_rules_are_skipped(self):
+        dead = f"127.0.0.1:{self.dead_port}"
+        rule = balanced_rule(self.up_port, self.dead_port, down=[dead])
+        unchecked = balanced_rule(self.up_port, self.dead_port, id="plain", health_check=None)
+        checker, queue = self.checker([rule, unchecked])
+
+        checker.check()
+        # Still down, as persisted
+        queue.submit.assert_not_called()
+        self.assertIsNone(checker.rule_health(unchecked))
+
+        revived = listener()
+        self.addCleanup(revived.close)
+        rule["backends"][1]["int_port"] = str(revived.getsockname()[1])
+        rule["down"] = [f"127.0.0.1:{revived.getsockname()[1]}"]
+        checker.check()
+
+        entries = queue.submit.call_args[0][0]
+        self.assertEqual({"down": []}, entries[0]["fields"])
+
+    def test_down_backends_are_left_out_of_the_kernel_rules(self):
+        rule = balanced_rule(8443, 9443, int_ip="10.0.0.2")
+        rule["backends"][0]["int_ip"] = "10.0.0.2"
+        rule["backends"][1]["int_ip"] = "10.0.0.3"
+
+        self.assertTrue(iptables.is_balanced(rule))
+        rule["down"] = ["10.0.0.3:9443"]
+        self.assertFalse(iptables.is_balanced(rule))
+        dnat = (
+            f"-A ERPF-PRE-eth0 -p tcp -m tcp --dport 443 {iptables.rule_tag(rule)} "
+            "-j DNAT --to-destination 10.0.0.2:8443"
+        )
+        self.assertIn(("nat", dnat), iptables.forward_specs(rule))
+        # Nothing healthy left: every backend stays in rotation
+        rule["down"] = ["10.0.0.2:8443", "10.0.0.3:9443"]
+        self.assertTrue(iptables.is_balanced(rule))
+
+
+if __name__ == "__main__":
+    unittest.main()
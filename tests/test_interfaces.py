@@ -0,0 +1,55 @@
+import unittest
+from unittest import mock
+
+import netifaces
+
+from app.services import interfaces
+from app.services.interfaces import InterfaceInventory, classify
+
+
+class TestInterfaces(unittest.TestCase):
+    def test_classify_uses_configured_prefixes(self):
+        names = ["lo", "eth0", "wg0", "veth12", "zt0"]
+
+        externals, internals = classify(names, ("wg", "zt"), ("lo", "veth12"))
+
+        self.assertEqual(["eth0", "wg0", "zt0"], externals)
+        self.assertEqual(["wg0", "zt0"], internals)
+
+    def test_snapshot_is_cached_until_ttl_or_event(self):
+        inventory = InterfaceInventory(ttl=60, internal_prefixes=("wg",))
+        with (
+            mock.patch.object(
+                netifaces, "interfaces", return_value=["lo", "eth0", "wg0"]
+            ) as list_interfaces,
+            mock.patch.object(
+                netifaces,
+                "ifaddresses",
+                return_value={netifaces.AF_INET: [{"addr": "10.0.0.1"}]},
+            ),
+            mock.patch.object(interfaces, "link_state", return_value="up"),
+        ):
+            first = inventory.snapshot()
+            inventory.snapshot()
+            self.assertEqual(1, list_interfaces.call_count)
+
+            inventory.invalidate()
+            inventory.snapshot()
+            self.assertEqual(2, list_interfaces.call_count)
+
+        self.assertEqual(["eth0", "wg0"], first["externals"])
+        self.assertEqual(["wg0"], first["internals"])
+        self.assertEqual(
+            {"name": "wg0", "state": "up", "ipv4": ["10.0.0.1"], "ipv6": []},
+            first["interfaces"][2],
+        )
+
+    def test_vanished_interface_has_no_addresses(self):
+        with (
+            mock.patch.object(netifaces, "ifaddresses", side_effect=ValueError),
+            mock.patch.object(interfaces, "link_state", return_value="unknown"),
+        ):
+            interface = interfaces.read_interface("veth0")
+
+        self.assertEqual([], interface["ipv4"])
+        self.assertEqual("unknown", interface["state"])
@@ -1,51 +1,102 @@
 import unittest
 
-from app.services import iptables
+from app.services import iptables, reconciler
 
 
-class TestIptablesApplyRule(unittest.TestCase):
-    def test_apply_rule_uses_both_protocols(self):
+RULE = {
+    "extif": "eth0",
+    "intif": "wg0",
+    "ext_port": "443",
+    "int_ip": "10.0.0.2",
+    "int_port": "8443",
+    "protocol": "both",
+}
+
+
+class TestIptablesReconcile(unittest.TestCase):
+    def run_with_fake(self, rules, live=""):
         calls = []
 
-        def fake_run(cmd):
-            calls.append(cmd)
+        def fake_run(cmd, input=None):
+            calls.append((cmd, input))
+            if cmd == ["iptables-save"]:
+                return live
             return ""
 
         original_run = iptables.run
         iptables.run = fake_run
         try:
-            iptables.apply_rule(
-                {
-                    "extif": "eth0",
-                    "intif": "wg0",
-                    "ext_port": "443",
-                    "int_ip": "10.0.0.2",
-                    "int_port": "8443",
-                    "protocol": "both",
-                }
-            )
+            reconciler.reconcile(rules)
         finally:
             iptables.run = original_run
+        return calls
+
+    def test_forward_uses_both_protocols(self):
+        calls = self.run_with_fake([RULE])
+
+        self.assertTrue(any(cmd[:2] == ["sysctl", "-w"] for cmd, _ in calls))
+        payload = calls[-1][1]
+        self.assertEqual(["iptables-restore", "--noflush"], calls[-1][0])
+        tcp_nat = (
+            f"-A ERPF-PRE-eth0 -p tcp -m tcp --dport 443 {iptables.rule_tag(RULE)} "
+            "-j DNAT --to-destination 10.0.0.2:8443"
+        )
+        self.assertIn(tcp_nat, payload)
+        self.assertIn(tcp_nat.replace("tcp", "udp"), payload)
 
-        self.assertTrue(any(cmd[:2] == ["sysctl", "-w"] for cmd in calls))
-        tcp_nat_check = [
-            "iptables",
-            "-t",
-            "nat",
-            "-C",
-            "PREROUTING",
-            "-i",
-            "eth0",
-            "-p",
-            "tcp",
-            "--dport",
-            "443",
-            "-j",
-            "DNAT",
-            "--to-destination",
-            "10.0.0.2:8443",
+    def test_port_range_and_list_compile_to_one_rule_per_protocol(self):
+        rules = [
+            dict(RULE, ext_port="27000-29000", int_port="27000-29000", protocol="udp"),
+            dict(RULE, ext_port="80,443", int_port="80,443", protocol="tcp"),
         ]
-        udp_nat_check = tcp_nat_check.copy()
-        udp_nat_check[8] = "udp"
-        self.assertIn(tcp_nat_check, calls)
-        self.assertIn(udp_nat_check, calls)
+
+        specs = [spec for rule in rules for _, spec in iptables.forward_specs(rule)]
+        udp, tcp = (iptables.rule_tag(rule) for rule in rules)
+
+        self.assertEqual(
+            [
+                "-A ERPF-PRE-eth0 -p udp -m udp --dport 27000:29000 "
+                f"{udp} -j DNAT --to-destination 10.0.0.2:27000-29000",
+                "-A ERPF-FWD-eth0 -d 10.0.0.2/32 -o wg0 -p udp -m udp --dport 27000:29000 "
+                f"{udp} -j ACCEPT",
+                "-A ERPF-PRE-eth0 -p tcp -m multiport --dports 80,443 "
+                f"{tcp} -j DNAT --to-destination 10.0.0.2",
+                "-A ERPF-FWD-eth0 -d 10.0.0.2/32 -o wg0 -p tcp -m multiport --dports 80,443 "
+                f"{tcp} -j ACCEPT",
+            ],
+            specs,
+        )
+        self.assertEqual([], iptables.legacy_specs(rules[0]))
+
+    def test_forward_creates_owned_chains_with_single_jump(self):
+        payload = self.run_with_fake([RULE])[-1][1]
+
+        self.assertIn(":ERPF-PREROUTING - [0:0]", payload)
+        self.assertIn(":ERPF-FWD-eth0 - [0:0]", payload)
+        self.assertIn("-A PREROUTING -j ERPF-PREROUTING", payload)
+        self.assertIn("-A FORWARD -j ERPF-FORWARD", payload)
+        self.assertIn("-A ERPF-PREROUTING -i eth0 -j ERPF-PRE-eth0", payload)
+        self.assertNotIn("-A PREROUTING -i eth0", payload)
+
+    def test_forwards_use_single_restore(self):
+        rules = []
+        for port in range(100):
+            rule = dict(RULE, ext_port=str(1000 + port), int_port=str(1000 + port))
+            rules.append(rule)
+
+        calls = self.run_with_fake(rules)
+
+        self.assertEqual(3, len(calls))
+        payload = calls[-1][1]
+        self.assertEqual(1, payload.count("-A ERPF-POSTROUTING -o wg0 -j MASQUERADE"))
+        self.assertEqual(200, payload.count("-j DNAT"))
+        self.assertEqual(2, payload.count("COMMIT"))
+
+    def test_live_rules_and_chains_are_skipped(self):
+        live_specs = iptables.desired_specs([RULE])
+        chains = iptables.missing_chains(live_specs, set())
+        live = iptables.build_restore_payload(live_specs, new_chains=chains)
+
+        calls = self.run_with_fake([RULE], live=live)
+
+        self.assertNotIn("iptables-restore", [cmd[0] for cmd, _ in calls])
@@ -0,0 +1,79 @@
+import tempfile
+import unittest
+from unittest import mock
+
+from app import create_app
+from app.services import iptables, metrics
+from app.services.stats import StatsCollector
+from app.services.store import RuleStore
+
+
+class TestMetrics(unittest.TestCase):
+    def test_histogram_renders_cumulative_buckets(self):
+        histogram = metrics.Histogram("test_seconds", "Test.", ["op"], buckets=(0.1, 1.0))
+        metrics.REGISTRY.remove(histogram)
+        for value in (0.05, 0.1, 0.5, 3.0):
+            histogram.observe(value, op="save")
+
+        lines = histogram.render()
+
+        self.assertIn('test_seconds_bucket{op="save",le="0.1"} 2', lines)
+        self.assertIn('test_seconds_bucket{op="save",le="1"} 3', lines)
+        self.assertIn('test_seconds_bucket{op="save",le="+Inf"} 4', lines)
+        self.assertIn('test_seconds_count{op="save"} 4', lines)
+        self.assertIn('test_seconds_sum{op="save"} 3.65', lines)
+
+    def test_run_is_counted_per_command(self):
+        before = metrics.COMMANDS.values.get(("iptables-save",), 0)
+
+        with mock.patch.object(iptables.subprocess, "check_output", return_value=""):
+            iptables.run(["iptables-save"])
+
+        self.assertEqual(before + 1, metrics.COMMANDS.values[("iptables-save",)])
+        self.assertIn(("iptables-save",), metrics.COMMAND_SECONDS.values)
+
+    def test_metrics_endpoint_serves_cached_values(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = RuleStore(f"{tmpdir}/rules.json")
+            rule = {
+                "id": "web",
+                "extif": "eth0",
+                "intif": "wg0",
+                "ext_port": "443",
+                "int_ip": "10.0.0.2",
+                "int_port": "8443",
+                "name": "Web",
+            }
+            store.apply_entries([{"op": "put", "rule": rule}])
+            collector = StatsCollector(store)
+            collector.record(
+                {
+                    "web": {
+                        "time": 1.0,
+                        "connections": 3,
+                        "packets": 40,
+                        "bytes": 5000,
+                        "active_flows": 2,
+                    }
+                }
+            )
+            client = create_app().test_client()
+            with (
+                mock.patch("app.routes.rule_store", store),
+                mock.patch("app.routes.stats_collector", collector),
+                mock.patch.object(iptables.subprocess, "check_output") as check_output,
+            ):
+                client.get("/api/v1/rules")
+                response = client.get("/metrics")
+
+        self.assertEqual(200, response.status_code)
+        check_output.assert_not_called()
+        body = response.get_data(as_text=True)
+        self.assertIn(
+            'erpf_rule_bytes_total{rule_id="web",name="Web",extif="eth0",'
+            'ext_port="443",target="10.0.0.2:8443"} 5000',
+            body,
+        )
+        self.assertIn(
+            'erpf_request_duration_seconds_count{method="GET",route="/api/v1/rules"}', body
+        )
@@ -0,0 +1,87 @@
+import os
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+from app.services import iptables, metrics
+from app.services.native import Libnftables, NativeKernel
+
+
+# Stands in for the ctypes handle of libnftables.so
+def fake_library(status=0, output=b"", error=b""):
+    commands = []
+    functions = {
+        "nft_ctx_new": lambda flags: 1,
+        "nft_ctx_buffer_output": lambda context: 0,
+        "nft_ctx_buffer_error": lambda context: 0,
+        "nft_ctx_get_output_buffer": lambda context: output,
+        "nft_ctx_get_error_buffer": lambda context: error,
+        "nft_run_cmd_from_buffer": lambda context, buffer: commands.append(buffer) or status,
+    }
+    return types.SimpleNamespace(**functions), commands
+
+
+class TestNative(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.proc_sys = tmpdir.name
+        os.makedirs(os.path.join(self.proc_sys, "net", "ipv4"))
+
+    def test_sysctl_is_written_to_proc(self):
+        kernel = NativeKernel(enabled=True, proc_sys=self.proc_sys)
+
+        output = kernel.run(["sysctl", "-w", "net.ipv4.ip_forward=1"])
+
+        self.assertEqual("net.ipv4.ip_forward = 1\n", output)
+        with open(os.path.join(self.proc_sys, "net", "ipv4", "ip_forward")) as handle:
+            self.assertEqual("1\n", handle.read())
+
+    def test_falls_back_when_not_possible_in_process(self):
+        loader = mock.Mock(return_value=None)
+        kernel = NativeKernel(enabled=True, loader=loader, proc_sys=self.proc_sys)
+
+        self.assertIsNone(kernel.run(["sysctl", "-w", "net.ipv6.conf.all.forwarding=1"]))
+        self.assertIsNone(kernel.run(["nft", "list", "tables"]))
+        self.assertIsNone(kernel.run(["nft", "-f", "-"], input="flush ruleset\n"))
+        self.assertIsNone(kernel.run(["iptables-save"]))
+        loader.assert_called_once()
+        self.assertIsNone(NativeKernel(enabled=False).run(["nft", "list", "tables"]))
+
+    def test_nft_commands_go_to_libnftables(self):
+        library, commands = fake_library(output=b"table ip erpf\n")
+        kernel = NativeKernel(enabled=True, loader=lambda: Libnftables(library))
+
+        self.assertEqual("table ip erpf\n", kernel.run(["nft", "list", "tables"]))
+        kernel.run(["nft", "-f", "-"], input="table ip erpf\ndelete table ip erpf\n")
+
+        self.assertEqual([b"list tables", b"table ip erpf\ndelete table ip erpf\n"], commands)
+
+    def test_nft_failure_raises_like_the_command(self):
+        library, _ = fake_library(status=1, error=b"Error: syntax error\n")
+        kernel = NativeKernel(enabled=True, loader=lambda: Libnftables(library))
+
+        with self.assertRaises(RuntimeError) as raised:
+            kernel.run(["nft", "-f", "-"], input="bogus\n")
+
+        self.assertIn("Command failed: nft -f -", str(raised.exception))
+        self.assertIn("syntax error", str(raised.exception))
+
+    def test_run_skips_the_subprocess_when_served_in_process(self):
+        kernel = NativeKernel(enabled=True, proc_sys=self.proc_sys)
+        forks = metrics.COMMANDS.values.get(("sysctl",), 0)
+        with (
+            mock.patch.object(iptables, "native_kernel", kernel),
+            mock.patch.object(iptables.subprocess, "check_output", return_value="") as fork,
+        ):
+            iptables.run(["sysctl", "-w", "net.ipv4.ip_forward=1"])
+            fork.assert_not_called()
+            # Only subprocesses are counted as commands
+            self.assertEqual(forks, metrics.COMMANDS.values.get(("sysctl",), 0))
+            iptables.run(["iptables-save"])
+            fork.assert_called_once()
+
+
+if __name__ == "__main__":
+    unittest.main()
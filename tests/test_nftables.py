@@ -0,0 +1,96 @@
+import unittest
+from unittest import mock
+
+from app.services import backend, nftables, reconciler
+
+
+RULE = {
+    "extif": "eth0",
+    "intif": "wg0",
+    "ext_port": "443",
+    "int_ip": "10.0.0.2",
+    "int_port": "8443",
+    "protocol": "both",
+}
+
+
+class TestNftablesRuleset(unittest.TestCase):
+    def test_render_ruleset_uses_verdict_map(self):
+        rules = [RULE, dict(RULE, ext_port="80", int_port="80", protocol="tcp")]
+
+        ruleset = nftables.render_ruleset(rules)
+
+        self.assertIn("dnat ip to iifname . meta l4proto . th dport map @fwd_dnat", ruleset)
+        self.assertIn('"eth0" . tcp . 443 : 10.0.0.2 . 8443', ruleset)
+        self.assertIn('"eth0" . udp . 443 : 10.0.0.2 . 8443', ruleset)
+        self.assertIn('"eth0" . tcp . 80 : 10.0.0.2 . 80', ruleset)
+        self.assertNotIn('"eth0" . udp . 80', ruleset)
+        self.assertEqual(1, ruleset.splitlines().count('            "wg0"'))
+
+    def test_port_ranges_are_interval_elements(self):
+        rules = [
+            dict(RULE, ext_port="27000-29000", int_port="27015", protocol="udp"),
+            dict(RULE, ext_port="80,8000-8010", int_port="80,8000-8010", protocol="tcp"),
+        ]
+
+        elements = nftables.map_elements(rules)
+
+        self.assertEqual(['"eth0" . udp . 27000-29000 : 10.0.0.2 . 27015'], elements["fwd_dnat"])
+        self.assertEqual(
+            ['"eth0" . tcp . 80 : 10.0.0.2', '"eth0" . tcp . 8000-8010 : 10.0.0.2'],
+            elements["fwd_dnat_keep"],
+        )
+        self.assertIn('"eth0" . "wg0" . 10.0.0.2 . tcp . 8000-8010', elements["fwd_allow"])
+        self.assertIn("flags interval", nftables.render_ruleset(rules))
+
+    def test_balanced_forward_uses_numgen_map(self):
+        rule = dict(
+            RULE,
+            protocol="tcp",
+            backends=[
+                {"int_ip": "10.0.0.2", "int_port": "8443", "weight": 1},
+                {"int_ip": "10.0.0.3", "int_port": "8443", "weight": 3},
+            ],
+        )
+
+        self.assertEqual(
+            [
+                'iifname "eth0" meta l4proto tcp th dport 443 dnat ip addr . port to '
+                "numgen random mod 4 map { 0 : 10.0.0.2 . 8443, 1-3 : 10.0.0.3 . 8443 }"
+            ],
+            nftables.balance_rules([rule]),
+        )
+        elements = nftables.map_elements([rule])
+        self.assertEqual([], elements["fwd_dnat"])
+        self.assertIn('"eth0" . "wg0" . 10.0.0.3 . tcp . 8443', elements["fwd_allow"])
+
+    def test_disabled_rules_are_not_rendered(self):
+        elements = nftables.map_elements([dict(RULE, enabled=False)])
+
+        self.assertEqual([], elements["fwd_dnat"])
+
+    def test_reconcile_replaces_table_in_one_transaction(self):
+        calls = []
+
+        def fake_run(cmd, input=None):
+            calls.append((cmd, input))
+            return ""
+
+        rules = [dict(RULE, ext_port=str(port)) for port in range(1000, 1500)]
+        with mock.patch.object(nftables, "run", fake_run):
+            additions, deletions = nftables.reconcile(rules)
+
+        self.assertEqual(["sysctl", "nft"], [cmd[0] for cmd, _ in calls])
+        payload = calls[-1][1]
+        self.assertTrue(payload.startswith("table ip erpf\ndelete table ip erpf\n"))
+        self.assertEqual(1000, len(additions))
+        self.assertEqual([], deletions)
+
+
+class TestBackend(unittest.TestCase):
+    def test_iptables_is_default(self):
+        self.assertEqual(reconciler.reconcile, backend.get_backend())
+
+    def test_unknown_backend_raises(self):
+        with self.assertRaises(RuntimeError):
+            backend.get_backend("pf")
@@ -1,8 +1,11 @@
 import json
+import os
 import tempfile
 import unittest
+from unittest import mock
 
 from app.services import persistence
+from app.services.store import RuleStore
 
 
 class TestPersistence(unittest.TestCase):
@@ -19,7 +22,46 @@ class TestPersistence(unittest.TestCase):
             finally:
                 persistence.RULES_FILE = original_rules_file
 
-    def test_restore_persistent_rules_skips_disabled(self):
+    def test_save_is_atomic_and_folds_journal(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            rules_path = f"{tmpdir}/rules.json"
+            persistence.save_persisted_rules([{"id": "a"}], rules_path)
+            persistence.append_journal([{"op": "remove", "ids": ["a"]}], rules_path)
+
+            with mock.patch.object(persistence.os, "replace", side_effect=OSError("disk")):
+                with self.assertRaises(RuntimeError):
+                    persistence.save_persisted_rules([{"id": "b"}], rules_path)
+
+            with open(rules_path) as handle:
+                self.assertEqual([{"id": "a"}], json.load(handle))
+            self.assertEqual(["rules.journal", "rules.json"], sorted(os.listdir(tmpdir)))
+
+            persistence.save_persisted_rules([{"id": "b"}], rules_path)
+            self.assertEqual(["rules.json"], os.listdir(tmpdir))
+
+    def test_load_replays_journal_and_ignores_torn_line(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            rules_path = f"{tmpdir}/rules.json"
+            persistence.save_persisted_rules(
+                [{"id": "a", "enabled": True}, {"id": "b"}], rules_path
+            )
+            persistence.append_journal(
+                [
+                    {"op": "update", "id": "a", "fields": {"enabled": False}},
+                    {"op": "put", "rule": {"id": "c"}},
+                ],
+                rules_path,
+            )
+            persistence.append_journal([{"op": "remove", "ids": ["b"]}], rules_path)
+            with open(persistence.journal_path(rules_path), "a") as handle:
+                handle.write('{"op": "remove", "ids"')
+
+            rules, entries = persistence.load_snapshot_and_journal(rules_path)
+
+            self.assertEqual([{"id": "a", "enabled": False}, {"id": "c"}], rules)
+            self.assertEqual(3, entries)
+
+    def test_restore_persistent_rules_reconciles_all_rules(self):
         with tempfile.TemporaryDirectory() as tmpdir:
             rules_path = f"{tmpdir}/rules.json"
             rules = [
@@ -42,30 +84,24 @@ class TestPersistence(unittest.TestCase):
                     "enabled": False,
                 },
             ]
+            broken = dict(rules[0], ext_port="81", int_ip="10.0.0.256")
             with open(rules_path, "w") as handle:
-                json.dump(rules, handle)
+                json.dump(rules + [broken], handle)
 
-            original_rules_file = persistence.RULES_FILE
-            original_apply_rule = persistence.apply_rule
-            original_run = persistence.run
-            calls = {"apply_rule": [], "run": []}
+            original_reconcile = persistence.reconcile
+            calls = []
 
-            def fake_apply_rule(rule):
-                calls["apply_rule"].append(rule)
+            def fake_reconcile(rules):
+                calls.append(list(rules))
+                return [], []
 
-            def fake_run(cmd):
-                calls["run"].append(cmd)
-                return ""
-
-            persistence.RULES_FILE = rules_path
-            persistence.apply_rule = fake_apply_rule
-            persistence.run = fake_run
+            persistence.reconcile = fake_reconcile
             try:
-                persistence.restore_persistent_rules()
+                persistence.restore_persistent_rules(RuleStore(rules_path))
             finally:
-                persistence.RULES_FILE = original_rules_file
-                persistence.apply_rule = original_apply_rule
-                persistence.run = original_run
+                persistence.reconcile = original_reconcile
 
-            self.assertEqual(1, len(calls["apply_rule"]))
-            self.assertEqual("eth0", calls["apply_rule"][0]["extif"])
+            self.assertEqual(1, len(calls))
+            # Rules saved without an id get one from the store on the way
+            self.assertTrue(all(rule.pop("id") for rule in calls[0]))
+            self.assertEqual(rules, calls[0])
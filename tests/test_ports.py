@@ -0,0 +1,31 @@
+import unittest
+
+from app.services import ports
+
+
+class TestPorts(unittest.TestCase):
+    def test_parse_and_normalize(self):
+        self.assertEqual([(443, 443)], ports.parse_ports(443))
+        self.assertEqual([(27000, 29000)], ports.parse_ports("27000 - 29000"))
+        self.assertEqual("80,443,1000-1010", ports.normalize_ports("443, 1000-1010,80"))
+
+    def test_invalid_specs_are_rejected(self):
+        too_many = ",".join(str(port) for port in range(1, 17))
+        for value in ("", "0", "70000", "30-20", "80,80", "1-10,5", "a", too_many):
+            with self.subTest(value=value), self.assertRaises(ValueError):
+                ports.parse_ports(value)
+
+    def test_target_is_single_port_or_same_ports(self):
+        ports.check_target("27000-29000", "27015")
+        ports.check_target("27000-29000", "27000-29000")
+        with self.assertRaises(ValueError):
+            ports.check_target("27000-29000", "37000-39000")
+
+    def test_iptables_forms(self):
+        self.assertEqual("-m udp --dport 27000:29000", ports.iptables_match("udp", "27000-29000"))
+        self.assertEqual(
+            "-m multiport --dports 80,443,8000:8010",
+            ports.iptables_match("tcp", "80,443,8000-8010"),
+        )
+        self.assertEqual("10.0.0.5:27000-29000", ports.dnat_target("10.0.0.5", "27000-29000"))
+        self.assertEqual("10.0.0.5", ports.dnat_target("10.0.0.5", "80,443"))
@@ -0,0 +1,195 @@
+import unittest
+
+from app.services import iptables, reconciler
+from app.services.snapshot import fingerprint_index, parse_save
+
+RULE = {
+    "extif": "eth0",
+    "intif": "wg0",
+    "ext_port": "443",
+    "int_ip": "10.0.0.2",
+    "int_port": "8443",
+    "protocol": "both",
+}
+
+SAVE_OUTPUT = """# Generated by iptables-save v1.8.9
+*nat
+:PREROUTING ACCEPT [0:0]
+:POSTROUTING ACCEPT [0:0]
+:ERPF-PREROUTING - [0:0]
+:ERPF-POSTROUTING - [0:0]
+:ERPF-PRE-eth0 - [0:0]
+:ERPF-PRE-eth1 - [0:0]
+-A PREROUTING -j ERPF-PREROUTING
+-A PREROUTING -i eth0 -p tcp -m tcp --dport 22 -j DNAT --to-destination 10.0.0.9:22
+-A POSTROUTING -j ERPF-POSTROUTING
+-A POSTROUTING -o wg0 -j MASQUERADE
+-A ERPF-PREROUTING -i eth0 -j ERPF-PRE-eth0
+-A ERPF-PREROUTING -i eth1 -j ERPF-PRE-eth1
+[5:300] -A ERPF-PRE-eth0 -p tcp -m tcp --dport 443 -j DNAT --to-destination 10.0.0.2:8443
+-A ERPF-PRE-eth0 -p udp -m udp --dport 443 -j DNAT --to-destination 10.0.0.2:8443
+-A ERPF-PRE-eth0 -p udp -m udp --dport 443 -j DNAT --to-destination 10.0.0.2:8443
+-A ERPF-PRE-eth1 -p tcp -m tcp --dport 80 -j DNAT --to-destination 10.0.0.3:80
+-A ERPF-POSTROUTING -o wg0 -j MASQUERADE
+COMMIT
+*filter
+:FORWARD DROP [0:0]
+-A FORWARD -d 10.0.0.2/32 -i eth0 -o wg0 -p udp -m udp --dport 8443 -j ACCEPT
+COMMIT
+"""
+
+
+class TestSnapshot(unittest.TestCase):
+    def test_parse_save_reads_chains_rules_and_counters(self):
+        snapshot = parse_save(SAVE_OUTPUT)
+
+        self.assertEqual("DROP", snapshot["filter"]["chains"]["FORWARD"])
+        self.assertEqual("-", snapshot["nat"]["chains"]["ERPF-PRE-eth0"])
+        self.assertEqual(11, len(snapshot["nat"]["rules"]))
+        counted = snapshot["nat"]["rules"][6]
+        self.assertEqual("ERPF-PRE-eth0", counted["chain"])
+        self.assertEqual((5, 300), counted["counters"])
+        self.assertTrue(counted["spec"].startswith("-A ERPF-PRE-eth0 -p tcp"))
+        self.assertIsNone(counted["fingerprint"])
+
+    def test_fingerprint_index_finds_every_kernel_rule_of_a_forward(self):
+        rule = dict(RULE, protocol="tcp")
+        specs = iptables.desired_specs([rule, dict(RULE, ext_port="80")])
+        snapshot = parse_save(
+            iptables.build_restore_payload(specs, new_chains=iptables.missing_chains(specs, set()))
+        )
+
+        entries = fingerprint_index(snapshot)[iptables.rule_fingerprint(rule)]
+
+        self.assertEqual(
+            iptables.forward_specs(rule), [(table, entry["spec"]) for table, entry in entries]
+        )
+        self.assertEqual(
+            iptables.rule_fingerprint(rule), iptables.rule_fingerprint(dict(rule, name="web"))
+        )
+
+
+class TestReconciler(unittest.TestCase):
+    def plan(self, rules):
+        snapshot = parse_save(SAVE_OUTPUT)
+        return reconciler.plan_changes(rules, snapshot)
+
+    def test_plan_removes_stale_protocol_duplicates_and_interfaces(self):
+        rule = dict(RULE, protocol="tcp")
+
+        additions, deletions, new_chains, removed_chains = self.plan([rule])
+
+        udp_nat = (
+            "nat",
+            "-A ERPF-PRE-eth0 -p udp -m udp --dport 443 "
+            "-j DNAT --to-destination 10.0.0.2:8443",
+        )
+        self.assertEqual(2, deletions.count(udp_nat))
+        self.assertIn(("nat", "-A ERPF-PREROUTING -i eth1 -j ERPF-PRE-eth1"), deletions)
+        self.assertEqual([("nat", "ERPF-PRE-eth1")], removed_chains)
+        # Legacy built-in FORWARD spec from an older release is migrated away
+        self.assertIn(
+            (
+                "filter",
+                "-A FORWARD -d 10.0.0.2/32 -i eth0 -o wg0 -p udp -m udp "
+                "--dport 8443 -j ACCEPT",
+            ),
+            deletions,
+        )
+        self.assertIn(("filter", "ERPF-FWD-eth0"), new_chains)
+        # Untagged specs from before fingerprint tagging are replaced
+        self.assertIn(
+            (
+                "nat",
+                "-A ERPF-PRE-eth0 -p tcp -m tcp --dport 443 "
+                "-j DNAT --to-destination 10.0.0.2:8443",
+            ),
+            deletions,
+        )
+        nat_additions = [spec for table, spec in additions if table == "nat"]
+        self.assertEqual(1, len(nat_additions))
+        self.assertIn(iptables.rule_tag(rule), nat_additions[0])
+
+    def test_changing_backends_rebuilds_the_balance_chain(self):
+        rule = dict(
+            RULE,
+            protocol="tcp",
+            backends=[
+                {"int_ip": "10.0.0.2", "int_port": "8443", "weight": 1},
+                {"int_ip": "10.0.0.3", "int_port": "8443", "weight": 1},
+            ],
+        )
+        chain = iptables.balance_chain(rule)
+        tag = iptables.rule_tag(rule)
+        self.assertEqual(
+            [
+                (
+                    "nat",
+                    f"-A {chain} -p tcp -m statistic --mode random --probability 0.50000000000 "
+                    f"{tag} -j DNAT --to-destination 10.0.0.2:8443",
+                ),
+                ("nat", f"-A {chain} -p tcp {tag} -j DNAT --to-destination 10.0.0.3:8443"),
+            ],
+            iptables.balance_specs(rule),
+        )
+        specs = iptables.desired_specs([rule])
+        snapshot = parse_save(
+            iptables.build_restore_payload(
+                specs, new_chains=iptables.missing_chains(specs, set())
+            )
+        )
+
+        extra = dict(rule["backends"][0], int_ip="10.0.0.4")
+        changed = dict(rule, backends=rule["backends"] + [extra])
+        additions, deletions, new_chains, removed_chains = reconciler.plan_changes(
+            [changed], snapshot
+        )
+
+        new_chain = iptables.balance_chain(changed)
+        self.assertEqual([("nat", new_chain)], new_chains)
+        self.assertEqual([("nat", chain)], removed_chains)
+        self.assertIn(
+            ("nat", f"-A {chain} -p tcp {tag} -j DNAT --to-destination 10.0.0.3:8443"), deletions
+        )
+        balance = [spec for table, spec in additions if spec.startswith(f"-A {new_chain}")]
+        self.assertEqual(3, len(balance))
+        self.assertIn("--probability 0.33333333349", balance[0])
+        self.assertIn("--probability 0.50000000000", balance[1])
+        self.assertNotIn("statistic", balance[2])
+
+        additions, deletions, _, removed_chains = reconciler.plan_changes([], snapshot)
+        self.assertIn(("nat", chain), removed_chains)
+        self.assertEqual([], additions)
+
+    def test_plan_never_touches_foreign_rules(self):
+        additions, deletions, _, removed_chains = self.plan([dict(RULE, enabled=False)])
+
+        self.assertEqual([], additions)
+        self.assertNotIn(("nat", "-A POSTROUTING -o wg0 -j MASQUERADE"), deletions)
+        self.assertFalse(any("--dport 22" in spec for _, spec in deletions))
+        self.assertIn(("nat", "-A PREROUTING -j ERPF-PREROUTING"), deletions)
+        self.assertIn(("nat", "ERPF-PREROUTING"), removed_chains)
+
+    def test_reconcile_reads_and_writes_once(self):
+        calls = []
+
+        def fake_run(cmd, input=None):
+            calls.append((cmd, input))
+            if cmd[0] == "iptables-save":
+                return SAVE_OUTPUT
+            return ""
+
+        rules = [dict(RULE, ext_port=str(port)) for port in range(1000, 1200)]
+        original_run = iptables.run
+        iptables.run = fake_run
+        try:
+            reconciler.reconcile(rules)
+        finally:
+            iptables.run = original_run
+
+        commands = [cmd[0] for cmd, _ in calls]
+        self.assertEqual(["sysctl", "iptables-save", "iptables-restore"], commands)
+        payload = calls[-1][1]
+        self.assertIn("-D ERPF-PRE-eth0 -p tcp -m tcp --dport 443", payload)
+        self.assertIn("-X ERPF-PRE-eth1", payload)
+        self.assertLess(payload.index("-D ERPF-PRE-eth0"), payload.index("-A ERPF-PRE-eth0"))
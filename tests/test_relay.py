@@ -0,0 +1,166 @@
+import socket
+import threading
+import time
+import unittest
+from unittest import mock
+
+from app.services import relay as relay_module
+from app.services.relay import Relay, relay_listeners
+
+
+def free_port(kind=socket.SOCK_STREAM):
+    with socket.socket(socket.AF_INET, kind) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class EchoServer:
+    def __init__(self):
+        self.tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp.bind(("127.0.0.1", 0))
+        self.tcp.listen()
+        self.port = self.tcp.getsockname()[1]
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind(("127.0.0.1", self.port))
+        threading.Thread(target=self._serve_tcp, daemon=True).start()
+        threading.Thread(target=self._serve_udp, daemon=True).start()
+
+    def _serve_tcp(self):
+        while True:
+            try:
+                conn, _ = self.tcp.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._echo, args=(conn,), daemon=True).start()
+
+    def _echo(self, conn):
+        with conn:
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    return
+                conn.sendall(data)
+
+    def _serve_udp(self):
+        while True:
+            try:
+                data, addr = self.udp.recvfrom(65536)
+            except OSError:
+                return
+            self.udp.sendto(data, addr)
+
+    def close(self):
+        self.tcp.close()
+        self.udp.close()
+
+
+def make_rule(ext_port, int_port, **fields):
+    rule = {
+        "id": "echo",
+        "extif": "lo",
+        "intif": "lo",
+        "ext_port": str(ext_port),
+        "int_ip": "127.0.0.1",
+        "int_port": str(int_port),
+        "protocol": "both",
+    }
+    rule.update(fields)
+    return rule
+
+
+def tcp_roundtrip(port, payload):
+    with socket.create_connection(("127.0.0.1", port), timeout=2) as sock:
+        sock.sendall(payload)
+        sock.shutdown(socket.SHUT_WR)
+        received = b""
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                return received
+            received += data
+
+
+class TestRelay(unittest.TestCase):
+    def setUp(self):
+        self.echo = EchoServer()
+        self.addCleanup(self.echo.close)
+        self.relay = Relay(bind=("127.0.0.1",), idle_timeout=2, udp_timeout=0.2)
+        self.addCleanup(self.relay.stop)
+
+    def test_listeners_cover_every_port_and_protocol(self):
+        rules = [
+            make_rule("8000-8001", 9000),
+            make_rule(8000, 9000, id="shadowed", protocol="tcp"),
+            make_rule(8100, 9000, id="off", enabled=False),
+            make_rule("27000-29000", "27000-29000", id="wide"),
+        ]
+
+        with mock.patch.object(relay_module, "RELAY_MAX_PORTS", 100):
+            listeners = relay_listeners(rules, lambda extif: ["10.0.0.1"])
+
+        self.assertEqual(
+            {
+                ("tcp", "10.0.0.1", 8000): "echo",
+                ("tcp", "10.0.0.1", 8001): "echo",
+                ("udp", "10.0.0.1", 8000): "echo",
+                ("udp", "10.0.0.1", 8001): "echo",
+            },
+            listeners,
+        )
+
+    def test_relays_tcp_and_udp_to_the_backend(self):
+        port = free_port()
+        added, removed = self.relay.reconcile([make_rule(port, self.echo.port)])
+
+        self.assertEqual([f"tcp 127.0.0.1:{port}", f"udp 127.0.0.1:{port}"], sorted(added))
+        self.assertEqual([], removed)
+        payload = bytes(range(256)) * 1024
+        self.assertEqual(payload, tcp_roundtrip(port, payload))
+
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(2)
+            sock.sendto(b"ping", ("127.0.0.1", port))
+            self.assertEqual(b"ping", sock.recv(64))
+        self.assertEqual(1, self.relay.connections("echo"))
+        # The UDP session expires once idle
+        deadline = time.monotonic() + 2
+        while self.relay.connections("echo") and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(0, self.relay.connections("echo"))
+
+    def test_copy_fallback_without_splice(self):
+        port = free_port()
+        self.relay.reconcile([make_rule(port, self.echo.port, protocol="tcp")])
+
+        with mock.patch.object(relay_module, "SPLICE", False):
+            self.assertEqual(b"x" * 200000, tcp_roundtrip(port, b"x" * 200000))
+
+    def test_connection_limit_refuses_extra_clients(self):
+        port = free_port()
+        self.relay.reconcile([make_rule(port, self.echo.port, protocol="tcp", max_connections=1)])
+
+        with socket.create_connection(("127.0.0.1", port), timeout=2) as first:
+            first.sendall(b"a")
+            self.assertEqual(b"a", first.recv(1))
+            with socket.create_connection(("127.0.0.1", port), timeout=2) as second:
+                self.assertEqual(b"", second.recv(1))
+
+    def test_failed_bind_keeps_the_running_listeners(self):
+        port = free_port()
+        self.relay.reconcile([make_rule(port, self.echo.port, protocol="tcp")])
+        taken = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addCleanup(taken.close)
+        taken.bind(("127.0.0.1", 0))
+        taken.listen()
+        busy = taken.getsockname()[1]
+
+        with self.assertRaises(RuntimeError):
+            self.relay.reconcile([make_rule(busy, self.echo.port, id="busy", protocol="tcp")])
+
+        self.assertEqual(b"still", tcp_roundtrip(port, b"still"))
+        added, removed = self.relay.reconcile([])
+        self.assertEqual(([], [f"tcp 127.0.0.1:{port}"]), (added, removed))
+
+
+if __name__ == "__main__":
+    unittest.main()
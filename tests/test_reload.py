@@ -0,0 +1,139 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from app.services import persistence
+from app.services.reload import RulesWatcher, diff_rules
+from app.services.store import RuleStore
+
+RULE = {
+    "id": "web",
+    "extif": "eth0",
+    "intif": "wg0",
+    "ext_port": "443",
+    "int_ip": "10.0.0.2",
+    "int_port": "8443",
+    "protocol": "tcp",
+    "enabled": True,
+}
+
+
+class TestReload(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.path = os.path.join(tmpdir.name, "rules.json")
+        self.write_rules([RULE])
+        self.store = RuleStore(self.path, journal=False)
+        self.queue = mock.Mock()
+        self.queue.submit.return_value.id = "job1"
+        self.watcher = RulesWatcher(self.store, self.queue, interval=2)
+
+    # Written to a temporary name and renamed over rules.json, with a new
+    # mtime even within the filesystem's timestamp granularity
+    def write_rules(self, rules):
+        tmp_path = self.path + ".new"
+        with open(tmp_path, "w") as handle:
+            json.dump(rules, handle)
+        if os.path.exists(self.path):
+            stat = os.stat(self.path)
+            os.utime(tmp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+        os.replace(tmp_path, self.path)
+
+    def test_validate_rules_names_the_broken_rule(self):
+        persistence.validate_rules([RULE, dict(RULE, id="b", ext_port="80")])
+        broken = [
+            ({"rules": [RULE]}, "JSON array"),
+            ([RULE, dict(RULE, ext_port="70000")], "rule 2"),
+            ([dict(RULE, int_ip="10.0.0")], "rule 1"),
+            ([RULE, RULE], "repeats the id web"),
+            ([dict(RULE, backends=[{"int_ip": "10.0.0.2"}])], "rule 1"),
+        ]
+        for rules, message in broken:
+            with self.subTest(message=message):
+                with self.assertRaises(ValueError) as raised:
+                    persistence.validate_rules(rules)
+                self.assertIn(message, str(raised.exception))
+
+    def test_external_edit_applies_only_what_changed(self):
+        self.store.rules()
+        self.assertIsNone(self.watcher.check())
+
+        other = dict(RULE, id="ssh", ext_port="2222", int_port="22")
+        self.write_rules([dict(RULE, int_port="9443"), other])
+        event = self.watcher.check()
+
+        self.assertEqual(
+            (["ssh"], [], ["web"]), (event["added"], event["removed"], event["changed"])
+        )
+        self.queue.submit.assert_called_once()
+        self.assertEqual([], self.queue.submit.call_args[0][0])
+        self.assertEqual("job1", event["job"])
+        self.assertEqual(2, len(self.store.rules()))
+        self.assertIsNone(self.watcher.check())
+
+    def test_rules_pushed_without_ids_keep_theirs(self):
+        other = dict(RULE, id="ssh", ext_port="2222", int_port="22")
+        self.write_rules([RULE, other])
+        self.watcher.check()
+        self.queue.submit.reset_mock()
+        without_ids = [{k: v for k, v in rule.items() if k != "id"} for rule in (other, RULE)]
+
+        self.write_rules(without_ids)
+        self.assertIsNone(self.watcher.check())
+        self.write_rules(without_ids)
+        self.assertIsNone(self.watcher.check())
+
+        self.queue.submit.assert_not_called()
+        self.assertEqual(["ssh", "web"], [rule["id"] for rule in self.store.rules()])
+        self.write_rules(without_ids + [dict(without_ids[1], ext_port="444")])
+        self.assertEqual(1, len(self.watcher.check()["added"]))
+
+    def test_own_writes_are_not_reloaded(self):
+        self.store.apply_entries([{"op": "put", "rule": dict(RULE, id="ssh", ext_port="2222")}])
+
+        self.assertIsNone(self.watcher.check())
+        self.queue.submit.assert_not_called()
+
+    def test_invalid_file_keeps_the_rules_in_use(self):
+        self.store.rules()
+        self.write_rules([dict(RULE, protocol="icmp")])
+
+        self.assertIsNone(self.watcher.check())
+        self.assertEqual([RULE], self.store.rules())
+        self.assertIn("protocol", self.watcher.status()["error"])
+        self.queue.submit.assert_not_called()
+
+        with open(self.path, "w") as handle:
+            handle.write('[{"id": "web", ')
+        self.assertEqual([RULE], self.store.rules())
+
+        self.write_rules([dict(RULE, ext_port="444")])
+        self.assertEqual(["web"], self.watcher.check()["changed"])
+        self.assertIsNone(self.watcher.status()["error"])
+
+    def test_diff_rules(self):
+        before = [RULE, dict(RULE, id="old")]
+        after = [dict(RULE, name="renamed"), dict(RULE, id="new")]
+
+        self.assertEqual((["new"], ["old"], ["web"]), diff_rules(before, after))
+
+    def test_inotify_picks_up_a_replaced_file(self):
+        applied = threading.Event()
+        self.queue.submit.side_effect = lambda entries, on_done: applied.set() or mock.Mock()
+        self.watcher.start()
+        self.addCleanup(self.watcher.stop)
+        if self.watcher.mode != "inotify":
+            self.skipTest("inotify is not available")
+
+        self.write_rules([RULE, dict(RULE, id="ssh", ext_port="2222")])
+
+        self.assertTrue(applied.wait(5))
+        self.assertEqual(["ssh"], self.watcher.status()["events"][0]["added"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,68 +1,161 @@
+import json
+import tempfile
 import unittest
 from unittest import mock
 
 from app import create_app
+from app.services.changes import ChangeQueue
+from app.services.interfaces import InterfaceInventory
+from app.services.store import RuleStore
 
 
 class TestRoutes(unittest.TestCase):
     def setUp(self):
         self.app = create_app()
         self.client = self.app.test_client()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.rules_path = f"{self.tmpdir.name}/rules.json"
+        self.store = RuleStore(self.rules_path)
+        self.queue = ChangeQueue(self.store)
+        for target, value in (
+            ("app.routes.rule_store", self.store),
+            ("app.routes.change_queue", self.queue),
+        ):
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch("app.services.changes.reconcile", return_value=([], []))
+        self.reconcile = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    # Mutations return before the queue commits them
+    def post(self, *args, **kwargs):
+        response = self.client.post(*args, **kwargs)
+        self.queue.join()
+        return response
+
+    def write_rules(self, rules):
+        with open(self.rules_path, "w") as handle:
+            json.dump(rules, handle)
+
+    def saved_rules(self):
+        with open(self.rules_path) as handle:
+            return json.load(handle)
 
     def test_add_rule_persists_rule(self):
-        with (
-            mock.patch("app.routes.apply_rule"),
-            mock.patch("app.routes.load_persisted_rules", return_value=[]),
-            mock.patch("app.routes.save_persisted_rules") as save_rules,
-        ):
-            response = self.client.post(
-                "/add",
-                data={
-                    "extif": "eth0",
-                    "intif": "wg0",
-                    "ext_port": "443",
-                    "int_ip": "10.0.0.2",
-                    "int_port": "8443",
-                    "protocol": "both",
-                    "name": "test",
-                },
-            )
+        response = self.post(
+            "/add",
+            data={
+                "extif": "eth0",
+                "intif": "wg0",
+                "ext_port": "443",
+                "int_ip": "10.0.0.2",
+                "int_port": "8443",
+                "protocol": "both",
+                "name": "test",
+            },
+        )
 
         self.assertEqual(302, response.status_code)
-        saved_rules = save_rules.call_args[0][0]
+        saved_rules = self.saved_rules()
         self.assertEqual(1, len(saved_rules))
         self.assertEqual("eth0", saved_rules[0]["extif"])
         self.assertEqual("test", saved_rules[0]["name"])
 
+    def test_add_port_range_is_normalized_and_validated(self):
+        form = {
+            "extif": "eth0",
+            "intif": "wg0",
+            "ext_port": "27000 - 29000",
+            "int_ip": "10.0.0.5",
+            "int_port": "27000-29000",
+            "protocol": "udp",
+        }
+        self.post("/add", data=form)
+        self.post("/add", data=dict(form, ext_port="100-200", int_port="300-400"))
+
+        saved_rules = self.saved_rules()
+        self.assertEqual(1, len(saved_rules))
+        self.assertEqual("27000-29000", saved_rules[0]["ext_port"])
+
+    def test_add_with_extra_backends_is_load_balanced(self):
+        self.post(
+            "/add",
+            data={
+                "extif": "eth0",
+                "intif": "wg0",
+                "ext_port": "443",
+                "int_ip": "10.0.0.2",
+                "int_port": "8443",
+                "protocol": "tcp",
+                "weight": "2",
+                "backends": "10.0.0.3\n\n10.0.0.4:9443 3\n",
+            },
+        )
+
+        self.assertEqual(
+            [
+                {"int_ip": "10.0.0.2", "int_port": "8443", "weight": 2},
+                {"int_ip": "10.0.0.3", "int_port": "8443", "weight": 1},
+                {"int_ip": "10.0.0.4", "int_port": "9443", "weight": 3},
+            ],
+            self.saved_rules()[0]["backends"],
+        )
+
     def test_index_renders_template(self):
         with (
-            mock.patch("app.routes.netifaces.interfaces", return_value=["lo", "eth0"]),
-            mock.patch("app.routes.load_persisted_rules", return_value=[]),
+            mock.patch("app.routes.interface_inventory", InterfaceInventory()),
+            mock.patch("netifaces.interfaces", return_value=["lo", "eth0"]),
         ):
             response = self.client.get("/")
 
         self.assertEqual(200, response.status_code)
+        self.assertIn('<option value="eth0"', response.get_data(as_text=True))
 
-    def test_add_rule_handles_apply_error(self):
-        with (
-            mock.patch("app.routes.apply_rule", side_effect=RuntimeError("boom")),
-            mock.patch("app.routes.load_persisted_rules", return_value=[]),
-            mock.patch("app.routes.save_persisted_rules") as save_rules,
-        ):
-            response = self.client.post(
-                "/add",
-                data={
+    def test_index_shows_one_filtered_page(self):
+        self.write_rules(
+            [
+                {
+                    "id": f"r{port}",
                     "extif": "eth0",
                     "intif": "wg0",
-                    "ext_port": "443",
+                    "ext_port": str(port),
                     "int_ip": "10.0.0.2",
-                    "int_port": "8443",
-                    "protocol": "tcp",
-                },
+                    "int_port": str(port),
+                    "name": f"rule-{port}",
+                }
+                for port in range(1000, 1120)
+            ]
+        )
+
+        with mock.patch("app.routes.interface_inventory", InterfaceInventory()):
+            body = self.client.get("/?port_min=1010&sort=ext_port&order=desc&page=2").get_data(
+                as_text=True
             )
 
+        self.assertIn("51–100 of 110 rules", body)
+        self.assertIn("rule-1069", body)
+        self.assertNotIn("rule-1070", body)
+        self.assertNotIn("rule-1009", body)
+        self.assertIn("page=3", body)
+
+    def test_add_rule_handles_apply_error(self):
+        self.reconcile.side_effect = RuntimeError("boom")
+        response = self.post(
+            "/add",
+            data={
+                "extif": "eth0",
+                "intif": "wg0",
+                "ext_port": "443",
+                "int_ip": "10.0.0.2",
+                "int_port": "8443",
+                "protocol": "tcp",
+            },
+        )
+
         self.assertEqual(302, response.status_code)
-        save_rules.assert_not_called()
+        self.assertEqual([], self.store.rules())
 
     def test_delete_rule_updates_rules(self):
         rule = {
@@ -73,15 +166,13 @@ class TestRoutes(unittest.TestCase):
             "int_port": "8443",
             "protocol": "both",
         }
-        with (
-            mock.patch("app.routes.load_persisted_rules", return_value=[rule]),
-            mock.patch("app.routes.save_persisted_rules") as save_rules,
-            mock.patch("app.routes.run"),
-        ):
-            response = self.client.post("/del", data=rule)
+        self.write_rules([rule])
+        self.reconcile.side_effect = RuntimeError("boom")
+        response = self.post("/del", data=rule)
 
         self.assertEqual(302, response.status_code)
-        self.assertEqual([], save_rules.call_args[0][0])
+        self.assertEqual([], self.saved_rules())
+        self.assertFalse(self.reconcile.call_args[0][0][0]["enabled"])
 
     def test_enable_rule_sets_enabled(self):
         rule = {
@@ -93,15 +184,11 @@ class TestRoutes(unittest.TestCase):
             "protocol": "tcp",
             "enabled": False,
         }
-        with (
-            mock.patch("app.routes.load_persisted_rules", return_value=[rule]),
-            mock.patch("app.routes.save_persisted_rules") as save_rules,
-            mock.patch("app.routes.apply_rule"),
-        ):
-            response = self.client.post("/enable", data=rule)
+        self.write_rules([rule])
+        response = self.post("/enable", data=rule)
 
         self.assertEqual(302, response.status_code)
-        updated_rules = save_rules.call_args[0][0]
+        updated_rules = self.saved_rules()
         self.assertTrue(updated_rules[0]["enabled"])
 
     def test_disable_rule_sets_disabled(self):
@@ -114,13 +201,79 @@ class TestRoutes(unittest.TestCase):
             "protocol": "both",
             "enabled": True,
         }
-        with (
-            mock.patch("app.routes.load_persisted_rules", return_value=[rule]),
-            mock.patch("app.routes.save_persisted_rules") as save_rules,
-            mock.patch("app.routes.run"),
-        ):
-            response = self.client.post("/disable", data=rule)
+        self.write_rules([rule])
+        response = self.post("/disable", data=rule)
 
         self.assertEqual(302, response.status_code)
-        updated_rules = save_rules.call_args[0][0]
+        updated_rules = self.saved_rules()
         self.assertFalse(updated_rules[0]["enabled"])
+
+    def test_resync_reconciles_persisted_rules(self):
+        rules = [
+            {
+                "id": "r1",
+                "extif": "eth0",
+                "intif": "wg0",
+                "ext_port": "443",
+                "int_ip": "10.0.0.2",
+                "int_port": "8443",
+            }
+        ]
+        self.write_rules(rules)
+        with mock.patch("app.routes.reconcile", return_value=([], [])) as reconcile:
+            response = self.post("/resync")
+
+        self.assertEqual(302, response.status_code)
+        # Loaded in canonical form, with the defaults filled in
+        reconcile.assert_called_once_with([dict(rules[0], protocol="both", enabled=True)])
+
+    def test_edit_rule_by_id(self):
+        rule = {
+            "id": "abc123",
+            "extif": "eth0",
+            "intif": "wg0",
+            "ext_port": "443",
+            "int_ip": "10.0.0.2",
+            "int_port": "8443",
+            "protocol": "both",
+            "enabled": False,
+        }
+        self.write_rules([rule])
+        response = self.post(
+            "/edit", data=dict(rule, rule_id="abc123", ext_port="444")
+        )
+
+        self.assertEqual(302, response.status_code)
+        self.assertEqual("444", self.reconcile.call_args[0][0][0]["ext_port"])
+        updated = self.saved_rules()[0]
+        self.assertEqual("abc123", updated["id"])
+        self.assertEqual("444", updated["ext_port"])
+        self.assertFalse(updated["enabled"])
+
+    def test_edit_keeps_fields_the_form_does_not_show(self):
+        rule = {
+            "id": "abc123",
+            "extif": "eth0",
+            "intif": "wg0",
+            "ext_port": "443",
+            "int_ip": "10.0.0.2",
+            "int_port": "8443",
+            "protocol": "both",
+            "enabled": True,
+            "health_check": {"type": "http", "path": "/healthz"},
+            "max_connections": 10,
+            "name": "web",
+        }
+        self.write_rules([rule])
+        form = {
+            field: rule[field] for field in ("extif", "intif", "int_ip", "int_port", "protocol")
+        }
+        self.post("/edit", data=dict(form, rule_id="abc123", ext_port="444", health_check="http"))
+
+        updated = self.saved_rules()[0]
+        self.assertEqual({"type": "http", "path": "/healthz"}, updated["health_check"])
+        self.assertEqual(10, updated["max_connections"])
+        self.assertNotIn("name", updated)
+
+        self.post("/edit", data=dict(form, rule_id="abc123", ext_port="444", health_check="tcp"))
+        self.assertEqual({"type": "tcp"}, self.saved_rules()[0]["health_check"])
@@ -0,0 +1,110 @@
+import sys
+import unittest
+from unittest import mock
+
+from app import config
+from app.services.rule import KEY_FIELDS, Rule
+from app.services.store import rule_key
+
+RULE = {
+    "id": "web",
+    "extif": "eth0",
+    "intif": "wg0",
+    "ext_port": "443",
+    "int_ip": "10.0.0.2",
+    "int_port": "8443",
+    "protocol": "tcp",
+    "enabled": True,
+}
+
+
+class TestRule(unittest.TestCase):
+    def test_parses_addresses_and_ports(self):
+        rule = Rule.from_dict(dict(RULE, ext_port=" 27000 - 29000", int_port="27000-29000"))
+
+        self.assertEqual(((27000, 29000),), rule.ext_port)
+        self.assertEqual(0x0A000002, int(rule.int_ip))
+        self.assertEqual(("tcp",), rule.protocols)
+        self.assertEqual("27000-29000", rule.to_dict()["ext_port"])
+
+    def test_round_trips_the_stored_form(self):
+        balanced = dict(
+            RULE,
+            name="web",
+            backends=[
+                {"int_ip": "10.0.0.2", "int_port": "8443", "weight": 2},
+                {"int_ip": "10.0.0.3", "int_port": "8443", "weight": 1},
+            ],
+            health_check={"type": "http", "path": "/health"},
+            max_connections=10,
+            down=["10.0.0.3:8443"],
+        )
+        for data in (RULE, balanced):
+            with self.subTest(rule=data.get("name")):
+                rule = Rule.from_dict(data)
+                self.assertEqual(data, rule.to_dict())
+                self.assertEqual(rule_key(data), rule.key())
+
+        # Defaults are filled in, a single backend is a plain forward
+        minimal = {field: RULE[field] for field in KEY_FIELDS}
+        single = dict(minimal, backends=[{"int_ip": "10.0.0.2", "int_port": "8443"}])
+        self.assertEqual(
+            dict(minimal, protocol="both", enabled=True), Rule.from_dict(single).to_dict()
+        )
+
+    def test_rejects_what_the_kernel_would(self):
+        broken = [
+            (dict(RULE, int_ip="10.0.0.256"), "int_ip"),
+            (dict(RULE, int_ip=167772162), "int_ip"),
+            (dict(RULE, ext_port="0"), "ext_port"),
+            (dict(RULE, ext_port="80-70"), "ext_port"),
+            (dict(RULE, ext_port="80,90", int_port="100-200"), "int_port"),
+            (dict(RULE, protocol="icmp"), "protocol"),
+            (dict(RULE, extif=""), "missing fields: extif"),
+            (dict(RULE, extif="eth0\n-A INPUT -j ACCEPT\n#"), "extif"),
+            (dict(RULE, extif="eth0\n"), "extif"),
+            (dict(RULE, intif="wg0 -j ACCEPT"), "intif"),
+            (dict(RULE, intif="a" * 16), "intif"),
+            (dict(RULE, intif=["wg0"]), "intif"),
+            (dict(RULE, enabled="yes"), "enabled"),
+            (dict(RULE, backends=[RULE, RULE]), "distinct"),
+            (dict(RULE, backends=[dict(RULE, weight=0)]), "weight"),
+            (dict(RULE, health_check={"type": "icmp"}), "health_check"),
+            (dict(RULE, max_connections=True), "max_connections"),
+        ]
+        for data, message in broken:
+            with self.subTest(message=message):
+                with self.assertRaises(ValueError) as raised:
+                    Rule.from_dict(data)
+                self.assertIn(message, str(raised.exception))
+
+    def test_relay_backend_caps_the_ports_of_a_forward(self):
+        wide = Rule.from_dict(dict(RULE, ext_port="27000-29000", int_port="27000-29000"))
+        wide.check_relay_ports()
+
+        with (
+            mock.patch.object(config, "FIREWALL_BACKEND", "relay"),
+            mock.patch.object(config, "RELAY_MAX_PORTS", 100),
+        ):
+            # Loading never drops a wide rule; only saving one is refused
+            Rule.from_dict(wide.to_dict())
+            Rule.from_dict(dict(RULE, ext_port="27000-27099")).check_relay_ports()
+            with self.assertRaises(ValueError) as raised:
+                wide.check_relay_ports()
+        self.assertIn("at most 100 per forward, not 2001", str(raised.exception))
+
+    def test_equal_rules_hash_alike_and_are_compact(self):
+        rule = Rule.from_dict(RULE)
+        same = Rule.from_dict(dict(RULE, ext_port=443, int_port="8443"))
+        other = Rule.from_dict(dict(RULE, protocol="udp"))
+
+        self.assertEqual(rule, same)
+        self.assertEqual(1, len({rule, same}))
+        self.assertNotEqual(rule, other)
+        self.assertEqual(rule.key(), other.key())
+        self.assertFalse(hasattr(rule, "__dict__"))
+        self.assertLess(sys.getsizeof(rule), sys.getsizeof(RULE))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,225 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import main
+from app import create_app
+from app.services import persistence
+from app.services.changes import ChangeQueue
+from app.services.relay import relay_listeners
+from app.services.store import RuleStore
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Modules the web UI has to come up without
+HEAVY_MODULES = ("netifaces", "asyncio", "app.services.relay")
+# Generous, so only a real regression on a slow machine trips it
+MAX_STARTUP_SECONDS = 5
+# Imports the app and creates it in a fresh interpreter, as main() does
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+from app import create_app
+create_app()
+seconds = time.perf_counter() - start
+print(json.dumps({"seconds": seconds, "modules": sorted(sys.modules)}))
+"""
+RULE = {
+    "id": "web",
+    "extif": "eth0",
+    "intif": "wg0",
+    "ext_port": "443",
+    "int_ip": "10.0.0.2",
+    "int_port": "8443",
+    "protocol": "tcp",
+    "enabled": True,
+}
+
+
+class TestStartup(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.data_dir = tmpdir.name
+        self.rules_path = os.path.join(tmpdir.name, "rules.json")
+
+    def test_app_starts_quickly_without_heavy_modules(self):
+        env = dict(os.environ, DATA_DIR=self.data_dir, FIREWALL_BACKEND="iptables")
+        output = subprocess.check_output(
+            [sys.executable, "-c", STARTUP_SCRIPT], cwd=ROOT, env=env, text=True
+        )
+        result = json.loads(output.splitlines()[-1])
+
+        self.assertLess(result["seconds"], MAX_STARTUP_SECONDS)
+        for module in HEAVY_MODULES:
+            self.assertNotIn(module, result["modules"])
+
+    def test_restore_reports_progress(self):
+        persistence.save_persisted_rules(
+            [RULE, dict(RULE, id="bad", protocol="icmp")], self.rules_path
+        )
+        progress = persistence.RestoreProgress()
+        self.assertEqual("idle", progress.to_dict()["state"])
+
+        store = RuleStore(self.rules_path)
+        with mock.patch.object(
+            persistence, "reconcile", return_value=(["a", "b"], [])
+        ) as apply:
+            persistence.restore_persistent_rules(store, progress)
+
+        apply.assert_called_once_with([RULE])
+        state = progress.to_dict()
+        self.assertEqual(
+            ("done", 2, 2, 1, 2, 0),
+            tuple(
+                state[field]
+                for field in ("state", "rules", "checked", "invalid", "added", "removed")
+            ),
+        )
+        self.assertLessEqual(state["started"], state["finished"])
+
+        with mock.patch.object(persistence, "reconcile", side_effect=RuntimeError("no nat")):
+            persistence.restore_persistent_rules(store, progress)
+        state = progress.to_dict()
+        self.assertEqual(("failed", "no nat"), (state["state"], state["error"]))
+
+    def test_restore_skips_malformed_disabled_rules(self):
+        persistence.save_persisted_rules(
+            [RULE, {"extif": "eth0", "ext_port": "81", "enabled": False}, "web"],
+            self.rules_path,
+        )
+        progress = persistence.RestoreProgress()
+
+        with mock.patch.object(persistence, "reconcile", return_value=([], [])) as apply:
+            persistence.restore_persistent_rules(RuleStore(self.rules_path), progress)
+
+        apply.assert_called_once_with([RULE])
+        self.assertEqual(("done", 2), (progress.to_dict()["state"], progress.to_dict()["invalid"]))
+
+    def test_restore_gives_legacy_rules_an_id(self):
+        legacy = {key: value for key, value in RULE.items() if key != "id"}
+        persistence.save_persisted_rules([legacy], self.rules_path)
+        store = RuleStore(self.rules_path)
+        progress = persistence.RestoreProgress()
+
+        with mock.patch.object(persistence, "reconcile", return_value=([], [])) as apply:
+            persistence.restore_persistent_rules(store, progress)
+
+        self.assertEqual("done", progress.to_dict()["state"])
+        (rule,) = apply.call_args[0][0]
+        self.assertEqual(rule, store.get(rule["id"]))
+        # The relay keys its listeners by rule id
+        listeners = relay_listeners([rule], lambda extif: ["10.0.0.1"])
+        self.assertEqual({rule["id"]}, set(listeners.values()))
+
+    def test_restore_normalizes_integer_ports(self):
+        persistence.save_persisted_rules(
+            [dict(RULE, ext_port=80, int_port=8080), dict(RULE, id="ssh", ext_port="22")],
+            self.rules_path,
+        )
+        progress = persistence.RestoreProgress()
+
+        with mock.patch.object(persistence, "reconcile", return_value=([], [])) as apply:
+            persistence.restore_persistent_rules(RuleStore(self.rules_path), progress)
+
+        self.assertEqual("done", progress.to_dict()["state"])
+        self.assertEqual(
+            [("80", "8080"), ("22", "8443")],
+            [(rule["ext_port"], rule["int_port"]) for rule in apply.call_args[0][0]],
+        )
+
+    def test_reads_are_served_while_a_change_waits_for_the_restore(self):
+        persistence.save_persisted_rules([RULE], self.rules_path)
+        store = RuleStore(self.rules_path)
+        queue = ChangeQueue(store)
+        applying = threading.Event()
+        release = threading.Event()
+
+        def slow_reconcile(rules):
+            applying.set()
+            release.wait(5)
+            return [], []
+
+        restore = threading.Thread(
+            target=persistence.restore_persistent_rules,
+            args=(store, persistence.RestoreProgress()),
+        )
+        with (
+            mock.patch.object(persistence, "reconcile", side_effect=slow_reconcile),
+            mock.patch("app.services.changes.reconcile", return_value=([], [])),
+        ):
+            restore.start()
+            self.assertTrue(applying.wait(5))
+            change = queue.submit([{"op": "update", "id": "web", "fields": {"name": "web"}}])
+            # The change waits for the restore, the reads do not
+            started = time.monotonic()
+            self.assertEqual(1, store.query(search="eth0")[1])
+            self.assertEqual(RULE, store.get("web"))
+            self.assertLess(time.monotonic() - started, 1)
+            self.assertFalse(change.done.wait(0.2))
+            release.set()
+            restore.join(5)
+            self.assertTrue(change.wait(5).persisted)
+
+        self.assertEqual("web", store.get("web")["name"])
+
+    def test_progress_endpoint(self):
+        progress = persistence.RestoreProgress()
+        progress.start()
+        progress.update(state="checking", rules=10, checked=4)
+
+        with mock.patch("app.api.restore_progress", progress):
+            response = create_app().test_client().get("/api/v1/restore")
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(("checking", 4), (response.json["state"], response.json["checked"]))
+
+    def test_background_restore_does_not_hold_up_serving(self):
+        release = threading.Event()
+        restored = threading.Event()
+        watching = threading.Event()
+        served = []
+
+        def slow_restore(store):
+            release.wait(5)
+            restored.set()
+
+        def serve(app):
+            served.append(restored.is_set())
+            release.set()
+            self.assertTrue(restored.wait(5))
+
+        watchers = [
+            main.stats_collector,
+            main.interface_inventory,
+            main.health_checker,
+            main.drift_watcher,
+            main.rules_watcher,
+        ]
+        with (
+            mock.patch.object(main, "STARTUP_RESTORE", "background"),
+            mock.patch.object(main, "restore_persistent_rules", side_effect=slow_restore),
+            mock.patch.object(main, "serve", side_effect=serve),
+            mock.patch.object(main.rule_store, "compact"),
+            mock.patch.object(main.sys, "platform", "linux"),
+        ):
+            for watcher in watchers:
+                for method in ("start", "stop"):
+                    patcher = mock.patch.object(watcher, method)
+                    patcher.start()
+                    self.addCleanup(patcher.stop)
+            main.rules_watcher.start.side_effect = watching.set
+            main.main()
+            # The watchers start once the rules are in the kernel
+            self.assertTrue(watching.wait(5))
+
+        self.assertEqual([False], served)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,150 @@
+import unittest
+
+from app.services import iptables
+from app.services.snapshot import parse_save
+from app.services.stats import (
+    StatsCollector,
+    collect_samples,
+    count_flows,
+    count_traffic,
+    parse_conntrack,
+)
+
+
+RULE = {
+    "id": "web",
+    "extif": "eth0",
+    "intif": "wg0",
+    "ext_port": "443",
+    "int_ip": "10.0.0.2",
+    "int_port": "8443",
+    "protocol": "both",
+}
+
+TAG = "-m comment --comment erpf-e427ae4ab86ea936"
+
+SAVE_OUTPUT = f"""# Generated by iptables-save v1.8.9
+*nat
+:PREROUTING ACCEPT [0:0]
+:ERPF-PRE-eth0 - [0:0]
+[12:720] -A ERPF-PRE-eth0 -p tcp -m tcp --dport 443 {TAG} -j DNAT --to-destination 10.0.0.2:8443
+[3:180] -A ERPF-PRE-eth0 -p udp -m udp --dport 443 {TAG} -j DNAT --to-destination 10.0.0.2:8443
+[9:540] -A ERPF-PRE-eth0 -p tcp -m tcp --dport 22 -j DNAT --to-destination 10.0.0.9:22
+COMMIT
+*filter
+:FORWARD DROP [0:0]
+:ERPF-FWD-eth0 - [0:0]
+[400:52000] -A ERPF-FWD-eth0 -d 10.0.0.2/32 -o wg0 -p tcp -m tcp --dport 8443 {TAG} -j ACCEPT
+[10:1000] -A ERPF-FWD-eth0 -d 10.0.0.2/32 -o wg0 -p udp -m udp --dport 8443 {TAG} -j ACCEPT
+COMMIT
+"""
+
+PROC_CONNTRACK = """\
+ipv4     2 tcp      6 431999 ESTABLISHED src=203.0.113.5 dst=198.51.100.1 sport=51000 \
+dport=443 src=10.0.0.2 dst=10.8.0.1 sport=8443 dport=51000 [ASSURED] mark=0 zone=0 use=2
+ipv4     2 udp      17 28 src=203.0.113.6 dst=198.51.100.1 sport=40000 dport=443 \
+src=10.0.0.2 dst=10.8.0.1 sport=8443 dport=40000 mark=0 zone=0 use=2
+ipv4     2 tcp      6 60 TIME_WAIT src=203.0.113.5 dst=198.51.100.1 sport=51001 \
+dport=22 src=10.0.0.9 dst=10.8.0.1 sport=22 dport=51001 [ASSURED] mark=0 zone=0 use=2
+"""
+
+CONNTRACK_L = """\
+tcp      6 431999 ESTABLISHED src=203.0.113.7 dst=198.51.100.1 sport=52000 dport=443 \
+src=10.0.0.2 dst=10.8.0.1 sport=8443 dport=52000 [ASSURED] mark=0 use=1
+conntrack v1.4.7 (conntrack-tools): 1 flow entries have been shown.
+"""
+
+
+class TestConntrack(unittest.TestCase):
+    def test_parse_proc_format(self):
+        flows = parse_conntrack(PROC_CONNTRACK)
+
+        self.assertEqual(3, len(flows))
+        self.assertEqual("ESTABLISHED", flows[0]["state"])
+        self.assertEqual("443", flows[0]["original"]["dport"])
+        self.assertEqual("10.0.0.2", flows[0]["reply"]["src"])
+        self.assertIsNone(flows[1]["state"])
+        self.assertEqual("TIME_WAIT", flows[2]["state"])
+
+    def test_parse_conntrack_tool_format(self):
+        flows = parse_conntrack(CONNTRACK_L)
+
+        self.assertEqual(1, len(flows))
+        self.assertEqual("8443", flows[0]["reply"]["sport"])
+
+    def test_count_flows_matches_rule_target(self):
+        counts = count_flows([RULE], parse_conntrack(PROC_CONNTRACK + CONNTRACK_L))
+
+        self.assertEqual({"web": 3}, counts)
+
+    def test_count_flows_matches_port_ranges(self):
+        rule = dict(RULE, id="game", ext_port="440-450", int_port="440-450")
+
+        counts = count_flows([rule], parse_conntrack(PROC_CONNTRACK))
+
+        self.assertEqual({}, counts)
+        rule["int_port"] = "8443"
+        self.assertEqual({"game": 2}, count_flows([rule], parse_conntrack(PROC_CONNTRACK)))
+
+
+class TestStats(unittest.TestCase):
+    def test_collect_samples_sums_counters_per_rule(self):
+        samples = collect_samples([RULE], SAVE_OUTPUT, PROC_CONNTRACK, now=100.0)
+
+        self.assertEqual(
+            {
+                "time": 100.0,
+                "connections": 15,
+                "packets": 410,
+                "bytes": 53000,
+                "active_flows": 2,
+            },
+            samples["web"],
+        )
+
+    def test_traffic_is_found_by_fingerprint_tag(self):
+        self.assertEqual(TAG, iptables.rule_tag(RULE))
+        rule = dict(
+            RULE,
+            protocol="tcp",
+            backends=[
+                {"int_ip": "10.0.0.2", "int_port": "8443", "weight": 1},
+                {"int_ip": "10.0.0.3", "int_port": "8443", "weight": 1},
+            ],
+        )
+        snapshot = parse_save(
+            "*nat\n"
+            + "".join(
+                f"[5:300] {spec}\n"
+                for table, spec in iptables.forward_specs(rule) + iptables.balance_specs(rule)
+                if table == "nat"
+            )
+            + "COMMIT\n"
+        )
+
+        self.assertEqual(
+            {"web": {"connections": 5, "packets": 0, "bytes": 0}},
+            count_traffic([rule], snapshot),
+        )
+
+    def test_rates_use_ring_buffer(self):
+        collector = StatsCollector(store=None, history=3)
+        for second, total in enumerate([0, 1000, 3000, 6000]):
+            collector.record(
+                {
+                    "web": {
+                        "time": float(second),
+                        "connections": 0,
+                        "packets": 0,
+                        "bytes": total,
+                        "active_flows": 1,
+                    }
+                }
+            )
+
+        stats = collector.rule_stats("web")
+        self.assertEqual(3000.0, stats["bytes_per_second"])
+        self.assertEqual([1000, 3000, 6000], [point["bytes"] for point in stats["history"]])
+
+        collector.record({})
+        self.assertIsNone(collector.rule_stats("web"))
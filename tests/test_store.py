@@ -0,0 +1,178 @@
+import fcntl
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from app.services import persistence
+from app.services.store import RuleStore, rule_key
+
+
+RULE = {
+    "extif": "eth0",
+    "intif": "wg0",
+    "ext_port": "443",
+    "int_ip": "10.0.0.2",
+    "int_port": "8443",
+    "protocol": "both",
+}
+
+
+def disable(rule_id, enabled=False):
+    return {"op": "update", "id": rule_id, "fields": {"enabled": enabled}}
+
+
+class TestRuleStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.path = f"{self.tmpdir.name}/rules.json"
+        self.store = RuleStore(self.path)
+
+    def write_rules(self, rules):
+        with open(self.path, "w") as handle:
+            json.dump(rules, handle)
+
+    def test_assigns_and_persists_ids(self):
+        self.write_rules([RULE])
+
+        rule = self.store.find(rule_key(RULE))
+
+        self.assertIs(rule, self.store.get(rule["id"]))
+        with open(self.path) as handle:
+            self.assertEqual(rule["id"], json.load(handle)[0]["id"])
+
+    def test_loads_rules_in_canonical_form(self):
+        self.write_rules(
+            [dict(RULE, id="a", ext_port=80, int_port=8080), dict(RULE, id="bad", intif="wg 0")]
+        )
+
+        self.assertEqual(
+            [dict(RULE, id="a", ext_port="80", int_port="8080", enabled=True)],
+            self.store.rules(),
+        )
+
+        self.write_rules([dict(RULE, id="a", ext_port=81, int_port=8081)])
+        stat = os.stat(self.path)
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+        rule = self.store.get("a")
+        self.assertEqual(("81", "8081"), (rule["ext_port"], rule["int_port"]))
+
+    def test_upgrade_keeps_invalid_rules_on_disk(self):
+        long_name = dict(RULE, ext_port="80", name="x" * 80)
+        self.write_rules([RULE, long_name, "web"])
+
+        rules = self.store.rules()
+        self.store.apply_entries([{"op": "put", "rule": dict(RULE, id="ssh", ext_port="22")}])
+
+        self.assertEqual(1, len(rules))
+        self.assertEqual([long_name, "web"], self.store.invalid_rules())
+        with open(self.path) as handle:
+            saved = json.load(handle)
+        self.assertEqual([rules[0]["id"], "ssh"], [rule["id"] for rule in saved[:2]])
+        self.assertEqual([long_name, "web"], saved[2:])
+
+        # A pushed file may carry them on; the rules it changes still reload
+        self.write_rules([dict(saved[0], ext_port="444"), long_name, "web"])
+        stat = os.stat(self.path)
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+        self.assertEqual(["444"], [rule["ext_port"] for rule in self.store.rules()])
+        self.assertIsNone(self.store.reload_error)
+
+    def test_reads_file_once_until_it_changes(self):
+        self.write_rules([dict(RULE, id="a")])
+
+        with mock.patch.object(
+            persistence, "load_snapshot_and_journal", wraps=persistence.load_snapshot_and_journal
+        ) as load:
+            for _ in range(5):
+                self.store.rules()
+            self.assertEqual(1, load.call_count)
+
+            self.write_rules([dict(RULE, id="a"), dict(RULE, id="b", ext_port="80")])
+            stat = os.stat(self.path)
+            os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+
+            self.assertEqual(2, len(self.store.rules()))
+            self.assertEqual(2, load.call_count)
+
+    def test_query_filters_sorts_and_pages_from_indexes(self):
+        self.write_rules(
+            [
+                dict(RULE, id=f"r{port}", ext_port=str(port), int_ip=f"10.0.0.{port % 3 + 1}")
+                for port in range(1000, 1100)
+            ]
+            + [dict(RULE, id="ssh", extif="eth1", ext_port="22", protocol="tcp", name="SSH")]
+        )
+
+        rules, total = self.store.query(
+            extif="eth0", int_ip="10.0.0.2", port_min=1010, port_max=1030, limit=3
+        )
+        self.assertEqual(7, total)
+        self.assertEqual(["1012", "1015", "1018"], [rule["ext_port"] for rule in rules])
+
+        rules, total = self.store.query(sort="ext_port", descending=True, offset=1, limit=2)
+        self.assertEqual(101, total)
+        self.assertEqual(["1098", "1097"], [rule["ext_port"] for rule in rules])
+
+        rules, _ = self.store.query(sort="ext_port", limit=1)
+        self.assertEqual("ssh", rules[0]["id"])
+        self.assertEqual(["ssh"], [rule["id"] for rule in self.store.query(search="ssh")[0]])
+        # Search words match from their start, and every one of them has to
+        self.assertEqual(["ssh"], [rule["id"] for rule in self.store.query(search="Eth1 S")[0]])
+        self.assertEqual(0, self.store.query(search="sh")[1])
+        self.assertEqual(33, self.store.query(search="10.0.0.3", extif="eth0")[1])
+        self.assertEqual(1, self.store.query(search="eth0 1042")[1])
+        self.assertEqual(1, self.store.query(protocol="tcp", enabled=True)[1])
+        self.assertEqual(0, self.store.query(enabled=False)[1])
+        with self.assertRaises(ValueError):
+            self.store.query(sort="bogus")
+
+    def test_writes_through_without_reloading(self):
+        self.write_rules([dict(RULE, id="a")])
+        self.store.rules()
+
+        with mock.patch.object(persistence, "load_snapshot_and_journal") as load:
+            self.store.apply_entries([disable("a")])
+            self.store.apply_entries([{"op": "put", "rule": dict(RULE, id="b", ext_port="80")}])
+            self.store.apply_entries([{"op": "remove", "ids": ["a"]}])
+
+            load.assert_not_called()
+        self.assertEqual(["b"], [rule["id"] for rule in self.store.rules()])
+        with open(self.path) as handle:
+            self.assertEqual(["80"], [rule["ext_port"] for rule in json.load(handle)])
+
+    def test_journal_appends_and_compacts(self):
+        self.write_rules([dict(RULE, id="a")])
+        store = RuleStore(self.path, journal=True, compact_entries=3)
+        store.rules()
+
+        with mock.patch.object(persistence, "save_persisted_rules") as save:
+            store.apply_entries([disable("a")])
+            store.apply_entries([disable("a", enabled=True)])
+            save.assert_not_called()
+        with open(persistence.journal_path(self.path)) as handle:
+            self.assertEqual(2, len(handle.readlines()))
+        self.assertTrue(RuleStore(self.path).get("a")["enabled"])
+
+        store.apply_entries([disable("a")])
+        store._compactor.join()
+
+        self.assertFalse(os.path.exists(persistence.journal_path(self.path)))
+        with open(self.path) as handle:
+            self.assertFalse(json.load(handle)[0]["enabled"])
+
+    def test_transaction_is_reentrant_and_excludes_other_processes(self):
+        self.write_rules([dict(RULE, id="a")])
+
+        with self.store.transaction():
+            with self.store.transaction():
+                self.store.apply_entries([disable("a")])
+            lock_path = f"{self.tmpdir.name}/rules.lock"
+            with open(lock_path) as handle:
+                with self.assertRaises(BlockingIOError):
+                    fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+        with open(lock_path) as handle:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)